@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the pipeline stages on a synthetic multilingual corpus and compares the results
+with a stored baseline.
+
+The corpus is generated from a seed, so every run with the same corpus options measures
+the same data: every language has its own alphabet (from one of several scripts), its own
+letter frequencies and a Zipf-distributed vocabulary, and the number of lines per language
+follows a Zipf distribution with exponent --skew. The corpus is kept in <work_dir>/corpus
+and only regenerated when its options change.
+
+Every stage runs in a child process, whose wall time, CPU time and peak RSS are measured:
+  split       split_dataset.py on the corpus
+  build       create_ngram_model_<mode>.py for every model and engine
+  serialize   write_model_counts on the counts of every built model
+  evaluate    evaluate_predictions.py with the local classifier (prediction included)
+The results (time, lines/s, n-grams/s, peak RSS, output size) are written as JSON. With
+--baseline, every result is compared with the baseline result of the same stage, model and
+engine; more CPU time (which depends much less on the load of the machine than wall time),
+higher peak RSS and changed outputs are flagged as regressions, and the exit status is 1 if
+there are any.
+
+Usage:
+  python benchmark.py <work_dir> [--lines N] [--languages N] [--skew S] [--seed SEED]
+      [--models byte:1-3,codepoint:1-2,token:1] [--engines python,numpy]
+      [--stages split,build,serialize,evaluate] [--repeat N] [--output FILE]
+      [--baseline FILE] [--time-tolerance F] [--memory-tolerance F]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from create_ngram_models import parse_model_list
+from util.model_io import iter_model_tuples, write_model_counts
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_VERSION = 1
+DEFAULT_MODELS = "byte:1-3,codepoint:1-2,token:1"
+STAGES = ("split", "build", "serialize", "evaluate")
+ENGINES = ("python", "numpy")
+SPLIT_RATIO = 0.8
+# Alphabets of the synthetic languages as (first code point, number of letters, word
+# lengths); languages take turns on the scripts.
+SCRIPTS = [
+    (0x61, 26, (2, 9)),  # Latin
+    (0x430, 32, (2, 10)),  # Cyrillic
+    (0x3B1, 25, (2, 9)),  # Greek
+    (0x627, 36, (2, 7)),  # Arabic
+    (0x915, 37, (2, 6)),  # Devanagari
+    (0x4E00, 3000, (1, 3)),  # CJK ideographs
+]
+VOCABULARY_SIZE = 5000
+SENTENCE_WORDS = (3, 25)
+GENERATE_BATCH_LINES = 10000
+# Time differences below this many seconds are never flagged, since they are within the
+# noise of process startup.
+MIN_TIME_DIFFERENCE = 0.05
+
+
+def language_code(index):
+    return f"l{index:02d}"
+
+
+def synthetic_vocabulary(rng, script):
+    """
+    Returns the words of a synthetic language and their cumulative Zipf weights.
+    """
+    first, size, (min_length, max_length) = script
+    # Every language uses its own subset of the script with its own letter frequencies.
+    letters = [chr(first + i) for i in rng.sample(range(size), max(2, size * 3 // 4))]
+    letter_weights = [1.0 / (rank + 1) ** 0.8 for rank in range(len(letters))]
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        length = rng.randint(min_length, max_length)
+        words.add("".join(rng.choices(letters, letter_weights, k=length)))
+    words = sorted(words)
+    rng.shuffle(words)
+    cumulative = []
+    total = 0.0
+    for rank in range(len(words)):
+        total += 1.0 / (rank + 1)
+        cumulative.append(total)
+    return words, cumulative
+
+
+def generate_corpus(corpus_dir, lines, languages, skew, seed):
+    """
+    Writes a synthetic corpus of lines "<language>\\t<sentence>" to one TSV file per
+    language in corpus_dir.
+
+    Returns:
+      dict: Number of lines per language code.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) ** skew for rank in range(languages)]
+    total_weight = sum(weights)
+    line_counts = {}
+    for index in range(languages):
+        code = language_code(index)
+        words, cumulative = synthetic_vocabulary(rng, SCRIPTS[index % len(SCRIPTS)])
+        remaining = line_counts[code] = max(1, round(lines * weights[index] / total_weight))
+        with open(os.path.join(corpus_dir, f"{code}.tsv"), "w", encoding="utf-8") as f:
+            while remaining:
+                batch = min(remaining, GENERATE_BATCH_LINES)
+                lengths = [rng.randint(*SENTENCE_WORDS) for _ in range(batch)]
+                sentence_words = iter(rng.choices(words, cum_weights=cumulative, k=sum(lengths)))
+                f.write(
+                    "".join(
+                        f"{code}\t{' '.join(next(sentence_words) for _ in range(length))}\n"
+                        for length in lengths
+                    )
+                )
+                remaining -= batch
+    return line_counts
+
+
+def prepare_corpus(work_dir, args):
+    """
+    Generates the corpus in <work_dir>/corpus unless it exists with the same options.
+
+    Returns:
+      dict: The corpus options and statistics, as recorded in the results.
+    """
+    corpus_dir = os.path.join(work_dir, "corpus")
+    info_file = os.path.join(work_dir, "corpus.json")
+    options = {
+        "lines": args.lines,
+        "languages": args.languages,
+        "skew": args.skew,
+        "seed": args.seed,
+        "vocabulary_size": VOCABULARY_SIZE,
+    }
+    if os.path.exists(info_file):
+        with open(info_file, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info["options"] == options:
+            return info
+    for name in os.listdir(corpus_dir) if os.path.isdir(corpus_dir) else []:
+        if name.endswith(".tsv"):
+            os.remove(os.path.join(corpus_dir, name))
+
+    print(f"Generating a corpus of {args.lines} lines in {args.languages} languages...")
+    line_counts = generate_corpus(corpus_dir, args.lines, args.languages, args.skew, args.seed)
+    size = sum(
+        os.path.getsize(os.path.join(corpus_dir, name)) for name in os.listdir(corpus_dir)
+    )
+    info = {
+        "options": options,
+        "lines": sum(line_counts.values()),
+        "bytes": size,
+        "lines_per_language": line_counts,
+    }
+    with open(info_file, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+        f.write("\n")
+    return info
+
+
+def run_stage(command, cwd):
+    """
+    Runs a stage in a child process.
+
+    Returns:
+      tuple: (wall time and CPU time (user and system) in seconds, peak RSS of the child in
+      bytes, output of the child).
+
+    Raises:
+      RuntimeError: If the child fails.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read().decode("utf-8", "replace")
+    process.stdout.close()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"'{' '.join(command)}' exited with code {process.returncode}:\n{output[-2000:]}"
+        )
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return seconds, usage.ru_utime + usage.ru_stime, peak_rss, output
+
+
+def measure(command, cwd, repeat):
+    """
+    Runs a stage repeat times and returns the run with the shortest CPU time.
+    """
+    return min((run_stage(command, cwd) for _ in range(repeat)), key=lambda run: run[1])
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+
+
+def count_lines(path):
+    with open(path, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b""))
+
+
+def model_totals(model_file):
+    """
+    Returns the number of tuples and the total count (the number of n-grams counted) of a
+    binary model file.
+    """
+    tuples = total = 0
+    for _, _, count in iter_model_tuples(model_file):
+        tuples += 1
+        total += count
+    return tuples, total
+
+
+def serialize_stage(model_file, output_file):
+    """
+    Body of the serialize stage, run in the child: loads the counts of a model and prints
+    the time write_model_counts takes to write them.
+    """
+    model_counts = {
+        (class_id, ngram): count for class_id, ngram, count in iter_model_tuples(model_file)
+    }
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    write_model_counts(model_counts, output_file)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "cpu_seconds": time.process_time() - start_cpu}))
+
+
+def result_key(result):
+    return " ".join(str(result[k]) for k in ("stage", "model", "engine") if result.get(k))
+
+
+def run_benchmarks(work_dir, args, corpus):
+    """
+    Runs the selected stages and returns their results.
+    """
+    results = []
+    train_file = os.path.join(work_dir, "train.tsv")
+    test_file = os.path.join(work_dir, "test.tsv")
+    mapping_file = os.path.join(work_dir, "class_id.json")
+
+    def record(result):
+        results.append(result)
+        print(format_result(result))
+
+    if "split" in args.stages or not os.path.exists(train_file):
+        command = script("split_dataset.py") + ["corpus", train_file, test_file, str(SPLIT_RATIO)]
+        seconds, cpu_seconds, rss, _ = measure(command, work_dir, args.repeat)
+        if "split" in args.stages:
+            record(
+                {
+                    "stage": "split",
+                    "seconds": seconds,
+                    "cpu_seconds": cpu_seconds,
+                    "lines_per_second": corpus["lines"] / seconds,
+                    "peak_rss_bytes": rss,
+                    "output_bytes": os.path.getsize(train_file) + os.path.getsize(test_file),
+                }
+            )
+    train_lines = count_lines(train_file)
+    test_lines = count_lines(test_file)
+
+    model_dir = os.path.join(work_dir, "models")
+    for engine in args.engines:
+        os.makedirs(os.path.join(model_dir, engine), exist_ok=True)
+        for mode, n in args.models:
+            name = f"{mode}_{n}"
+            model_file = os.path.join(model_dir, engine, f"{name}.bin")
+            models_xml = os.path.join(model_dir, engine, f"{name}.xml")
+            if "build" in args.stages or not os.path.exists(models_xml):
+                command = script(f"create_ngram_model_{mode}.py") + [
+                    train_file,
+                    model_file,
+                    str(n),
+                    mapping_file,
+                    "--engine",
+                    engine,
+                    "--nb-models-xml",
+                    models_xml,
+                ]
+                seconds, cpu_seconds, rss, _ = measure(command, work_dir, args.repeat)
+                if "build" in args.stages:
+                    tuples, ngrams = model_totals(model_file)
+                    record(
+                        {
+                            "stage": "build",
+                            "model": f"{mode}:{n}",
+                            "engine": engine,
+                            "seconds": seconds,
+                            "cpu_seconds": cpu_seconds,
+                            "lines_per_second": train_lines / seconds,
+                            "ngrams_per_second": ngrams / seconds,
+                            "peak_rss_bytes": rss,
+                            "output_bytes": os.path.getsize(model_file),
+                            "tuples": tuples,
+                        }
+                    )
+
+    # The serialize and evaluate stages use the models of the first engine; the engines
+    # build identical models.
+    first_engine = args.engines[0]
+    for mode, n in args.models:
+        name = f"{mode}_{n}"
+        model_file = os.path.join(model_dir, first_engine, f"{name}.bin")
+        if "serialize" in args.stages:
+            output_file = os.path.join(model_dir, f"{name}.serialized.bin")
+            command = script("benchmark.py") + ["--serialize-stage", model_file, output_file]
+            # Only the write is timed, not the loading of the counts.
+            runs = []
+            for _ in range(args.repeat):
+                _, _, rss, output = run_stage(command, work_dir)
+                runs.append((json.loads(output.splitlines()[-1]), rss))
+            write, rss = min(runs, key=lambda run: run[0]["cpu_seconds"])
+            tuples, _ = model_totals(model_file)
+            size = os.path.getsize(output_file)
+            os.remove(output_file)
+            record(
+                {
+                    "stage": "serialize",
+                    "model": f"{mode}:{n}",
+                    "seconds": write["seconds"],
+                    "cpu_seconds": write["cpu_seconds"],
+                    "tuples_per_second": tuples / write["seconds"],
+                    "megabytes_per_second": size / write["seconds"] / 1e6,
+                    "peak_rss_bytes": rss,
+                    "output_bytes": size,
+                }
+            )
+        if "evaluate" in args.stages:
+            eval_dir = os.path.join(work_dir, "eval", name)
+            command = script("evaluate_predictions.py") + [
+                test_file,
+                name,
+                mapping_file,
+                "results.txt",
+                eval_dir,
+                "--local-models",
+                os.path.join(model_dir, first_engine, f"{name}.xml"),
+            ]
+            seconds, cpu_seconds, rss, _ = measure(command, work_dir, args.repeat)
+            with open(os.path.join(eval_dir, "results.txt"), "r", encoding="utf-8") as f:
+                accuracy = float(f.readline().split(":")[1].strip().rstrip("%"))
+            record(
+                {
+                    "stage": "evaluate",
+                    "model": f"{mode}:{n}",
+                    "seconds": seconds,
+                    "cpu_seconds": cpu_seconds,
+                    "lines_per_second": test_lines / seconds,
+                    "peak_rss_bytes": rss,
+                    "accuracy": accuracy,
+                }
+            )
+    return results
+
+
+def format_result(result):
+    parts = [
+        f"{result_key(result):<26}",
+        f"{result['seconds']:7.2f}s (CPU {result['cpu_seconds']:6.2f}s)",
+    ]
+    for key, label in (
+        ("lines_per_second", "lines/s"),
+        ("ngrams_per_second", "n-grams/s"),
+        ("tuples_per_second", "tuples/s"),
+    ):
+        if key in result:
+            parts.append(f"{result[key]:12,.0f} {label}")
+    parts.append(f"peak RSS {result['peak_rss_bytes'] / 1e6:7.1f} MB")
+    if "output_bytes" in result:
+        parts.append(f"output {result['output_bytes'] / 1e6:7.2f} MB")
+    if "accuracy" in result:
+        parts.append(f"accuracy {result['accuracy']:.2f}%")
+    return "  ".join(parts)
+
+
+def compare_with_baseline(results, baseline, time_tolerance, memory_tolerance):
+    """
+    Compares results with the results of a baseline run.
+
+    Returns:
+      list: Regression messages.
+    """
+    baseline_results = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    print("Comparison with the baseline:")
+    for result in results:
+        key = result_key(result)
+        base = baseline_results.get(key)
+        if base is None:
+            print(f"  {key}: not in the baseline")
+            continue
+        time_change = result["cpu_seconds"] / base["cpu_seconds"] - 1
+        memory_change = result["peak_rss_bytes"] / base["peak_rss_bytes"] - 1
+        flags = []
+        if (
+            time_change > time_tolerance
+            and result["cpu_seconds"] - base["cpu_seconds"] > MIN_TIME_DIFFERENCE
+        ):
+            flags.append(f"CPU time +{time_change * 100:.0f}%")
+        if memory_change > memory_tolerance:
+            flags.append(f"peak RSS +{memory_change * 100:.0f}%")
+        if "output_bytes" in base and result.get("output_bytes") != base["output_bytes"]:
+            flags.append(f"output size {base['output_bytes']} -> {result.get('output_bytes')}")
+        if "accuracy" in base and result.get("accuracy") != base["accuracy"]:
+            flags.append(f"accuracy {base['accuracy']:.2f}% -> {result.get('accuracy'):.2f}%")
+        status = "REGRESSION: " + ", ".join(flags) if flags else "ok"
+        print(
+            f"  {key:<26} CPU time {time_change * 100:+6.1f}%  "
+            f"peak RSS {memory_change * 100:+6.1f}%  {status}"
+        )
+        regressions.extend(f"{key}: {flag}" for flag in flags)
+    return regressions
+
+
+def parse_list(choices):
+    def parse(value):
+        items = [item.strip() for item in value.split(",") if item.strip()]
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(
+                    f"invalid value '{item}', expected one of {', '.join(choices)}"
+                )
+        return items
+
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline stages on a synthetic corpus."
+    )
+    parser.add_argument("work_dir", nargs="?", help="Directory for the corpus and the outputs.")
+    parser.add_argument(
+        "--lines", type=int, default=100000, help="Lines of the corpus (default: 100000)."
+    )
+    parser.add_argument(
+        "--languages", type=int, default=20, help="Languages of the corpus (default: 20)."
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=1.0,
+        help="Zipf exponent of the lines per language; 0 gives every language the same "
+        "number of lines (default: 1.0).",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus (default: 0).")
+    parser.add_argument(
+        "--models",
+        type=parse_model_list,
+        default=parse_model_list(DEFAULT_MODELS),
+        help=f"Models to benchmark as <mode>:<n> or <mode>:<first n>-<last n> "
+        f"(default: {DEFAULT_MODELS}).",
+    )
+    parser.add_argument(
+        "--engines",
+        type=parse_list(ENGINES),
+        default=["python"],
+        help="Comma-separated counting engines of the build stage (default: python).",
+    )
+    parser.add_argument(
+        "--stages",
+        type=parse_list(STAGES),
+        default=list(STAGES),
+        help=f"Comma-separated stages to run (default: {','.join(STAGES)}).",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per stage; the fastest counts (default: 3)."
+    )
+    parser.add_argument(
+        "--output", default=None, help="Results file (default: <work_dir>/benchmark.json)."
+    )
+    parser.add_argument("--baseline", default=None, help="Results file to compare with.")
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.15,
+        help="Flag stages whose CPU time exceeds the baseline by more than this fraction "
+        "(default: 0.15).",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.10,
+        help="Flag stages whose peak RSS exceeds the baseline by more than this fraction "
+        "(default: 0.10).",
+    )
+    parser.add_argument("--serialize-stage", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serialize_stage:
+        serialize_stage(*args.serialize_stage)
+        return
+    if args.work_dir is None:
+        parser.error("the following arguments are required: work_dir")
+    if args.lines < 1 or args.languages < 1 or args.repeat < 1 or args.skew < 0:
+        parser.error("--lines, --languages and --repeat must be positive and --skew non-negative")
+    if not args.engines:
+        parser.error("--engines must name at least one engine")
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    corpus = prepare_corpus(work_dir, args)
+    print(f"Corpus: {corpus['lines']} lines, {corpus['bytes'] / 1e6:.1f} MB")
+    try:
+        results = run_benchmarks(work_dir, args, corpus)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        import numpy
+
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    output = {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "numpy": numpy_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "corpus": corpus,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    output_file = args.output or os.path.join(work_dir, "benchmark.json")
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+        f.write("\n")
+    print(f"Results written to {output_file}")
+
+    if baseline is not None:
+        if baseline["corpus"]["options"] != corpus["options"]:
+            print("Warning: the baseline was measured on a corpus with different options.")
+        regressions = compare_with_baseline(
+            results, baseline, args.time_tolerance, args.memory_tolerance
+        )
+        if regressions:
+            print(f"{len(regressions)} regression(s) found.")
+            sys.exit(1)
+        print("No regressions found.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Compares the throughput of the streaming model writer against the original serializer,
+which builds the whole model in one bytearray with four struct.pack calls per tuple.
+
+The model counts are loaded from an existing binary model file (for example the shipped
+models/byte/trigram/lang_byte_3.bin) and written back with each serializer.
+
+Usage:
+  python benchmark_serialize.py <model.bin> [--repeat N]
+"""
+
+import argparse
+import filecmp
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+
+from util.model_io import iter_model_tuples, write_model_counts
+
+
+def legacy_serialize_model(model_counts, output_file):
+    """
+    The serializer used by the create_ngram_model_* scripts before the streaming writer.
+    """
+    binary_output = bytearray()
+    for (class_id, ngram), count in model_counts.items():
+        binary_output += struct.pack("I", class_id)
+        binary_output += struct.pack("I", len(ngram))
+        binary_output += ngram
+        binary_output += struct.pack("I", count)
+
+    with open(output_file, "wb") as f_out:
+        f_out.write(binary_output)
+
+
+def streaming_serialize_model(model_counts, output_file):
+    write_model_counts(model_counts, output_file)
+
+
+def sorted_streaming_serialize_model(model_counts, output_file):
+    write_model_counts(model_counts, output_file, sort=True)
+
+
+def time_writer(writer, model_counts, output_file, repeat):
+    """
+    Returns the best wall time of repeat runs and the peak traced memory of one extra run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        writer(model_counts, output_file)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    writer(model_counts, output_file)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the binary model serializers.")
+    parser.add_argument("model_file", help="Binary model file to load and re-serialize.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per writer (default: 5).")
+    args = parser.parse_args()
+
+    model_counts = {(class_id, ngram): count for class_id, ngram, count in iter_model_tuples(args.model_file)}
+    size = os.path.getsize(args.model_file)
+    print(f"Model: {args.model_file} ({len(model_counts)} tuples, {size / 1e6:.2f} MB)")
+
+    writers = [
+        ("legacy bytearray", legacy_serialize_model),
+        ("streaming", streaming_serialize_model),
+        ("streaming sorted", sorted_streaming_serialize_model),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outputs = {}
+        baseline = None
+        for name, writer in writers:
+            output_file = os.path.join(tmp_dir, name.replace(" ", "_") + ".bin")
+            seconds, peak = time_writer(writer, model_counts, output_file, args.repeat)
+            outputs[name] = output_file
+            if baseline is None:
+                baseline = seconds
+            print(
+                f"  {name:<18} {seconds * 1000:8.1f} ms  {len(model_counts) / seconds / 1e6:6.2f} M tuples/s  "
+                f"{size / seconds / 1e6:7.1f} MB/s  peak memory {peak / 1e6:6.2f} MB  "
+                f"speedup {baseline / seconds:4.2f}x"
+            )
+
+        if not filecmp.cmp(outputs["legacy bytearray"], outputs["streaming"], shallow=False):
+            print("Error: streaming output differs from the legacy output.")
+            raise SystemExit(1)
+        print("Streaming output is identical to the legacy output.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Compiles a training TSV file into a corpus cache: the valid examples are parsed, validated
+and UTF-8 encoded once and stored as a memory-mappable class ID array, offsets array and
+payload. The builders read the cache with --corpus-cache instead of parsing the TSV file;
+the cache is recompiled automatically when the TSV or mapping file changes. The stats of the
+run are written to <cache_dir>/stats.json.
+
+Usage:
+  python compile_corpus.py <train.tsv> <lang_mapping.json> <cache_dir> [--force]
+"""
+
+import argparse
+import os
+
+from util.corpus_cache import compile_corpus, open_corpus_cache
+from util.helpers import RunStats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compiles a training TSV file into a corpus cache.")
+    parser.add_argument("train_file", help="TSV file with training data.")
+    parser.add_argument("lang_mapping_file", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument("cache_dir", help="Directory for the corpus cache.")
+    parser.add_argument(
+        "--force", action="store_true", help="Recompile the cache even if it is up to date."
+    )
+    args = parser.parse_args()
+
+    stats = RunStats("compile_corpus")
+    with stats.stage("parse"):
+        if args.force:
+            progress = stats.progress("Compiling")
+            cache = compile_corpus(
+                args.train_file, args.lang_mapping_file, args.cache_dir, stats.skipped, progress
+            )
+        else:
+            cache = open_corpus_cache(
+                args.cache_dir, args.train_file, args.lang_mapping_file, stats.skipped
+            )
+    header = cache.header
+    print(
+        f"Corpus cache '{args.cache_dir}': {header['num_examples']} examples, "
+        f"{header['skipped_lines']} skipped lines, {len(cache.payload) / 1e6:.2f} MB of text."
+    )
+    stats.set(examples=header["num_examples"], payload_bytes=len(cache.payload))
+    stats.write(os.path.join(args.cache_dir, "stats.json"))
+
+
+if __name__ == "__main__":
+    main()
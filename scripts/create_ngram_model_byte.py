@@ -19,13 +19,37 @@ The n-gram model is built as follows:
       <unsigned int: count>
 
 Usage:
-  python encode_and_serialize_ngram_model_byte.py <train.tsv> <output_model.bin> <n> <lang_mapping.json>
+  python create_ngram_model_byte.py <train.tsv> <output_model.bin> <n> <lang_mapping.json> [--workers N]
+      [--max-memory SIZE] [--tmp-dir DIR] [--sort] [--min-count N] [--top-k K]
+      [--feature-selection {chi2,ig} --num-features N] [--update EXISTING_MODEL]
+      [--nb-models-xml FILE] [--model-name NAME] [--corpus-cache DIR]
+      [--engine {python,numpy}]
+      [--max-per-class N] [--sample-seed SEED]
 """
 
-import sys
 import collections
-import struct
-from util.helpers import load_language_mapping
+
+from util.counting import (
+    ExternalCounts,
+    SentenceCounter,
+    add_model_file_counts,
+    count_training_file,
+)
+from util.corpus_cache import open_corpus_cache
+from util.helpers import (
+    RunStats,
+    create_builder_argument_parser,
+    load_language_mapping,
+    load_update_meta,
+    validate_builder_arguments,
+    write_build_metadata,
+    write_build_stats,
+)
+from util.model_io import write_model_counts
+from util.pruning import PrunedCounts, print_size_report
+
+START_TOKEN = b"\x01"
+END_TOKEN = b"\xff"
 
 def generate_byte_ngrams(byte_seq, n):
     """
@@ -34,7 +58,37 @@ def generate_byte_ngrams(byte_seq, n):
     """
     return [byte_seq[i:i+n] for i in range(len(byte_seq) - n + 1)]
 
-def encode_ngram_model(train_file, n, lang_mapping_file):
+def sentence_ngrams(sentence, n):
+    """
+    Pads a sentence with the boundary bytes and returns its byte-level n-grams.
+    """
+    # Encode sentence to bytes using UTF-8
+    sentence_bytes = sentence.encode("utf-8")
+
+    # Create padded byte sequence
+    padded = START_TOKEN * (n - 1) + sentence_bytes + END_TOKEN * (n - 1)
+
+    if len(padded) < n:
+        return []
+
+    # Generate byte-level n-grams
+    return generate_byte_ngrams(padded, n)
+
+def encode_ngram_model(
+    train_file,
+    n,
+    lang_mapping_file,
+    workers=1,
+    max_memory=None,
+    tmp_dir=None,
+    class_counts=None,
+    corpus_cache=None,
+    engine="python",
+    stats=None,
+    max_per_class=None,
+    sample_seed=0,
+    sampled_counts=None,
+):
     """
     Reads training data and returns a dictionary with keys (class_id, ngram) and values as counts.
     This function tokenizes each sentence at the byte level.
@@ -42,49 +96,43 @@ def encode_ngram_model(train_file, n, lang_mapping_file):
       start token: 0x01
       end token:   0xFF
     Each is repeated (n-1) times as boundaries.
+    With workers > 1 the training file is counted in parallel chunks.
+    With max_memory set, the counts are spilled to sorted runs on disk and the returned
+    ExternalCounts yields them merged in (class_id, ngram) order.
+    The number of training examples per class is added to class_counts if given.
+    With corpus_cache (a CorpusCache of the same data) the TSV file is not parsed.
+    With stats (a RunStats) the skipped lines are counted and progress lines are printed.
+    With max_per_class set, only a seeded stratified sample of at most max_per_class examples
+    of every class is counted; class_counts still gets the full counts and sampled_counts
+    the sampled ones.
+    With engine="numpy" (n <= 8) the n-grams are counted with vectorized NumPy code; the
+    returned counts yield the same tuples in the same order as the default engine; its
+    batch arrays are not bounded by max_memory.
     """
     lang_mapping = load_language_mapping(lang_mapping_file)
-    model_counts = collections.defaultdict(int)
-
-    start_token = b"\x01"
-    end_token = b"\xff"
-
-    with open(train_file, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.rstrip("\n")
-            parts = line.split("\t")
-            if len(parts) < 2:
-                print(f"Warning: line '{line}' does not have enough parts; skipping.")
-                continue
-
-            lang_code = parts[0].strip()
-            sentence = " ".join(parts[1:]).strip()
-            if not sentence:
-                print(f"Warning: empty sentence in line '{line}'; skipping.")
-                continue
-            if lang_code not in lang_mapping:
-                print(f"Warning: language code '{lang_code}' not in mapping; skipping.")
-                continue
-
-            class_id = lang_mapping[lang_code]
-            # Encode sentence to bytes using UTF-8
-            sentence_bytes = sentence.encode("utf-8")
-
-            # Create padded byte sequence
-            padded = start_token * (n - 1) + sentence_bytes + end_token * (n - 1)
-
-            if len(padded) < n:
-                continue
-
-            # Generate byte-level n-grams
-            ngrams = generate_byte_ngrams(padded, n)
-            for ngram in ngrams:
-                model_counts[(class_id, ngram)] += 1
-    
-
-    return model_counts
-
-def serialize_model(model_counts, output_file):
+    if engine == "numpy":
+        from util.numpy_counting import NumpyByteCounter
+
+        counter = NumpyByteCounter(START_TOKEN, END_TOKEN)
+    else:
+        counter = SentenceCounter(sentence_ngrams)
+    return count_training_file(
+        train_file,
+        n,
+        lang_mapping,
+        counter,
+        workers,
+        max_memory,
+        tmp_dir,
+        class_counts,
+        corpus_cache,
+        stats,
+        max_per_class,
+        sample_seed,
+        sampled_counts,
+    )
+
+def serialize_model(model_counts, output_file, sort=False):
     """
     Serializes the model counts dictionary into binary format and writes it to output_file.
     Format for each tuple:
@@ -92,34 +140,88 @@ def serialize_model(model_counts, output_file):
       <unsigned int: length of ngram in bytes>
       <ngram in utf-8 bytes>
       <unsigned int: count>
+    With sort=True the tuples are written sorted by class_id and then ngram.
     """
-    binary_output = bytearray()
-    for (class_id, ngram), count in model_counts.items():
-        binary_output += struct.pack("I", class_id)
-        binary_output += struct.pack("I", len(ngram))
-        binary_output += ngram
-        binary_output += struct.pack("I", count)
-
-    with open(output_file, "wb") as f_out:
-        f_out.write(binary_output)
-    print(f"Conversion complete. Written binary model to '{output_file}'. Total tuples: {len(model_counts)}")
+    total = write_model_counts(model_counts, output_file, sort=sort)
+    print(f"Conversion complete. Written binary model to '{output_file}'. Total tuples: {total}")
 
 def main():
-    if len(sys.argv) != 5:
-        print("Usage: python encode_and_serialize_ngram_model_byte.py <train.tsv> <output_model.bin> <n> <lang_mapping.json>")
-        sys.exit(1)
-
-    train_file = sys.argv[1]
-    output_file = sys.argv[2]
-    try:
-        n = int(sys.argv[3])
-    except ValueError:
-        print("Error: n must be an integer.")
-        sys.exit(1)
-    lang_mapping_file = sys.argv[4]
-
-    model_counts = encode_ngram_model(train_file, n, lang_mapping_file)
-    serialize_model(model_counts, output_file)
+    parser = create_builder_argument_parser(
+        "Encodes a byte-level n-gram model from training data and serializes it to a binary file."
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="Counting engine; numpy (requires NumPy, n <= 8, not with --max-memory) vectorizes "
+        "the n-gram extraction.",
+    )
+    args = parser.parse_args()
+    validate_builder_arguments(parser, args)
+    lang_mapping = load_language_mapping(args.lang_mapping_file)
+    update_meta = load_update_meta(parser, args, "byte", lang_mapping)
+    stats = RunStats("create_ngram_model_byte")
+    corpus_cache = None
+    if args.corpus_cache:
+        with stats.stage("parse"):
+            corpus_cache = open_corpus_cache(
+                args.corpus_cache, args.train_file, args.lang_mapping_file, stats.skipped
+            )
+    class_counts = collections.Counter()
+    sampled_counts = collections.Counter()
+    if update_meta is not None:
+        class_counts.update(update_meta["class_examples"])
+    if args.engine == "numpy":
+        try:
+            from util.numpy_counting import MAX_N
+        except ImportError:
+            parser.error("--engine numpy requires NumPy to be installed")
+        if args.n > MAX_N:
+            parser.error(f"--engine numpy supports n <= {MAX_N}")
+        if args.max_memory is not None:
+            parser.error(
+                "--engine numpy vectorizes large batches whose temporary arrays are not "
+                "bounded by --max-memory; use --engine python with --max-memory"
+            )
+
+    # Without a corpus cache the training file is parsed while it is counted.
+    with stats.stage("count"):
+        model_counts = encode_ngram_model(
+            args.train_file,
+            args.n,
+            args.lang_mapping_file,
+            workers=args.workers,
+            max_memory=args.max_memory,
+            tmp_dir=args.tmp_dir,
+            class_counts=class_counts,
+            corpus_cache=corpus_cache,
+            engine=args.engine,
+            stats=stats,
+            max_per_class=args.max_per_class,
+            sample_seed=args.sample_seed,
+            sampled_counts=sampled_counts,
+        )
+    if args.update:
+        with stats.stage("update"):
+            model_counts = add_model_file_counts(
+                model_counts, args.update, text=False, max_memory=args.max_memory
+            )
+    pruned_counts = PrunedCounts(
+        model_counts,
+        min_count=args.min_count,
+        top_k=args.top_k,
+        feature_selection=args.feature_selection,
+        num_features=args.num_features,
+    )
+    with stats.stage("serialize"):
+        serialize_model(pruned_counts, args.output_file, sort=args.sort)
+    class_names = {v: k for k, v in lang_mapping.items()}
+    print_size_report(pruned_counts, class_names)
+    with stats.stage("metadata"):
+        write_build_metadata(args, "byte", lang_mapping, class_counts, pruned_counts, update_meta)
+    if isinstance(model_counts, ExternalCounts):
+        model_counts.close()
+    write_build_stats(args, stats, class_counts, pruned_counts, sampled_counts)
 
 if __name__ == "__main__":
     main()
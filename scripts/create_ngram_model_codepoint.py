@@ -19,13 +19,36 @@ The n-gram model is built as follows:
       <unsigned int: count>
 
 Usage:
-  python create_ngram_model_codepoint.py <train.tsv> <output_model.bin> <n> <lang_mapping.json>
+  python create_ngram_model_codepoint.py <train.tsv> <output_model.bin> <n> <lang_mapping.json> [--workers N]
+      [--max-memory SIZE] [--tmp-dir DIR] [--sort] [--min-count N] [--top-k K]
+      [--feature-selection {chi2,ig} --num-features N] [--update EXISTING_MODEL]
+      [--nb-models-xml FILE] [--model-name NAME] [--corpus-cache DIR] [--engine {python,numpy}]
+      [--max-per-class N] [--sample-seed SEED]
 """
 
-import sys
 import collections
-import struct
-from util.helpers import load_language_mapping  # assumes your helper exists
+
+from util.counting import (
+    ExternalCounts,
+    SentenceCounter,
+    add_model_file_counts,
+    count_training_file,
+)
+from util.corpus_cache import open_corpus_cache
+from util.helpers import (
+    RunStats,
+    create_builder_argument_parser,
+    load_language_mapping,
+    load_update_meta,
+    validate_builder_arguments,
+    write_build_metadata,
+    write_build_stats,
+)
+from util.model_io import write_model_counts
+from util.pruning import PrunedCounts, print_size_report
+
+START_TOKEN = "\U0010fffe"
+END_TOKEN = "\U0010ffff"
 
 
 def generate_codepoint_ngrams(codepoints, n):
@@ -36,7 +59,39 @@ def generate_codepoint_ngrams(codepoints, n):
     return ["".join(codepoints[i : i + n]) for i in range(len(codepoints) - n + 1)]
 
 
-def encode_ngram_model(train_file, n, lang_mapping_file):
+def sentence_ngrams(sentence, n):
+    """
+    Pads a sentence with the boundary code points and returns its code point n-grams.
+    """
+    # Create start and end boundary tokens repeated (n-1) times.
+    start_tokens = [START_TOKEN] * (n - 1)
+    end_tokens = [END_TOKEN] * (n - 1)
+
+    # Split the sentence into individual Unicode code points.
+    codepoints = list(sentence)
+    tokens = start_tokens + codepoints + end_tokens
+
+    if len(tokens) < n:
+        return []
+
+    return generate_codepoint_ngrams(tokens, n)
+
+
+def encode_ngram_model(
+    train_file,
+    n,
+    lang_mapping_file,
+    workers=1,
+    max_memory=None,
+    tmp_dir=None,
+    class_counts=None,
+    corpus_cache=None,
+    engine="python",
+    stats=None,
+    max_per_class=None,
+    sample_seed=0,
+    sampled_counts=None,
+):
     """
     Reads training data and returns a dictionary with keys (class_id, ngram) and values as counts.
     Instead of tokenizing by whitespace, this function tokenizes the sentence into its individual Unicode code points.
@@ -44,54 +99,45 @@ def encode_ngram_model(train_file, n, lang_mapping_file):
       start token: U+10FFFE
       end token:   U+10FFFF
     Each is repeated (n-1) times as boundaries.
+    With workers > 1 the training file is counted in parallel chunks.
+    With max_memory set, the counts are spilled to sorted runs on disk and the returned
+    ExternalCounts yields them merged in (class_id, ngram) order.
+    The number of training examples per class is added to class_counts if given.
+    With corpus_cache (a CorpusCache of the same data) the TSV file is not parsed.
+    With stats (a RunStats) the skipped lines are counted and progress lines are printed.
+    With max_per_class set, only a seeded stratified sample of at most max_per_class examples
+    of every class is counted; class_counts still gets the full counts and sampled_counts
+    the sampled ones.
+    With engine="numpy" every code point is interned to an integer id and the n-grams are
+    counted as packed integer keys with vectorized NumPy code; the returned counts yield
+    the same tuples in the same order as the default engine; its batch arrays and
+    vocabulary are not bounded by max_memory.
     """
     lang_mapping = load_language_mapping(lang_mapping_file)
-    model_counts = collections.defaultdict(int)
-
-    start_token = "\U0010fffe"
-    end_token = "\U0010ffff"
-
-    with open(train_file, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.rstrip("\n")
-            parts = line.split("\t")
-            if len(parts) < 2:
-                print(f"Warning: line '{line}' does not have enough parts; skipping.")
-                continue
-            lang_code = parts[0].strip()
-            sentence = " ".join(parts[1:]).strip()
-            if not sentence:
-                print(f"Warning: empty sentence in line '{line}'; skipping.")
-                continue
-            if lang_code not in lang_mapping:
-                print(f"Warning: language code '{lang_code}' not in mapping; skipping.")
-                continue
-            class_id = lang_mapping[lang_code]
-
-            # Create start and end boundary tokens repeated (n-1) times.
-            start_tokens = [start_token] * (n - 1)
-            end_tokens = [end_token] * (n - 1)
-
-            # Split the sentence into individual Unicode code points.
-            codepoints = list(sentence)
-            tokens = start_tokens + codepoints + end_tokens
-
-            if len(tokens) < n:
-                continue
-
-            ngrams = generate_codepoint_ngrams(tokens, n)
-            for ngram in ngrams:
-                model_counts[(class_id, ngram)] += 1
-
-        # write out the model counts to human-readable format
-    with open("model_counts.txt", "w", encoding="utf-8") as f_out:
-        for (class_id, ngram), count in model_counts.items():
-            f_out.write(f"{class_id}\t{ngram}\t{count}\n")
-
-    return model_counts
-
-
-def serialize_model(model_counts, output_file):
+    if engine == "numpy":
+        from util.numpy_counting import NumpyCodepointCounter
+
+        counter = NumpyCodepointCounter(START_TOKEN, END_TOKEN)
+    else:
+        counter = SentenceCounter(sentence_ngrams)
+    return count_training_file(
+        train_file,
+        n,
+        lang_mapping,
+        counter,
+        workers,
+        max_memory,
+        tmp_dir,
+        class_counts,
+        corpus_cache,
+        stats,
+        max_per_class,
+        sample_seed,
+        sampled_counts,
+    )
+
+
+def serialize_model(model_counts, output_file, sort=False):
     """
     Serializes the model counts dictionary into binary format and writes it to output_file.
     Format for each tuple:
@@ -99,40 +145,91 @@ def serialize_model(model_counts, output_file):
       <unsigned int: length of ngram in bytes>
       <ngram in utf-8 bytes>
       <unsigned int: count>
+    With sort=True the tuples are written sorted by class_id and then ngram.
     """
-    binary_output = bytearray()
-    for (class_id, ngram), count in model_counts.items():
-        binary_output += struct.pack("I", class_id)
-        ngram_bytes = ngram.encode("utf-8")
-        binary_output += struct.pack("I", len(ngram_bytes))
-        binary_output += ngram_bytes
-        binary_output += struct.pack("I", count)
-
-    with open(output_file, "wb") as f_out:
-        f_out.write(binary_output)
+    total = write_model_counts(model_counts, output_file, sort=sort)
     print(
-        f"Conversion complete. Written binary model to '{output_file}'. Total tuples: {len(model_counts)}"
+        f"Conversion complete. Written binary model to '{output_file}'. Total tuples: {total}"
     )
 
 
 def main():
-    if len(sys.argv) != 5:
-        print(
-            "Usage: python create_ngram_model_codepoint.py <train.tsv> <output_model.bin> <n> <lang_mapping.json>"
+    parser = create_builder_argument_parser(
+        "Encodes a code point level n-gram model from training data and serializes it to a binary file."
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="Counting engine; numpy (requires NumPy, n <= 8, not with --max-memory) interns "
+        "the units to integer ids and counts packed n-gram keys.",
+    )
+    args = parser.parse_args()
+    validate_builder_arguments(parser, args)
+    lang_mapping = load_language_mapping(args.lang_mapping_file)
+    update_meta = load_update_meta(parser, args, "codepoint", lang_mapping)
+    stats = RunStats("create_ngram_model_codepoint")
+    corpus_cache = None
+    if args.corpus_cache:
+        with stats.stage("parse"):
+            corpus_cache = open_corpus_cache(
+                args.corpus_cache, args.train_file, args.lang_mapping_file, stats.skipped
+            )
+    class_counts = collections.Counter()
+    sampled_counts = collections.Counter()
+    if update_meta is not None:
+        class_counts.update(update_meta["class_examples"])
+    if args.engine == "numpy":
+        try:
+            from util.numpy_counting import MAX_N
+        except ImportError:
+            parser.error("--engine numpy requires NumPy to be installed")
+        if args.n > MAX_N:
+            parser.error(f"--engine numpy supports n <= {MAX_N}")
+        if args.max_memory is not None:
+            parser.error(
+                "--engine numpy vectorizes large batches whose temporary arrays are not "
+                "bounded by --max-memory; use --engine python with --max-memory"
+            )
+
+    # Without a corpus cache the training file is parsed while it is counted.
+    with stats.stage("count"):
+        model_counts = encode_ngram_model(
+            args.train_file,
+            args.n,
+            args.lang_mapping_file,
+            workers=args.workers,
+            max_memory=args.max_memory,
+            tmp_dir=args.tmp_dir,
+            class_counts=class_counts,
+            corpus_cache=corpus_cache,
+            engine=args.engine,
+            stats=stats,
+            max_per_class=args.max_per_class,
+            sample_seed=args.sample_seed,
+            sampled_counts=sampled_counts,
         )
-        sys.exit(1)
-
-    train_file = sys.argv[1]
-    output_file = sys.argv[2]
-    try:
-        n = int(sys.argv[3])
-    except ValueError:
-        print("Error: n must be an integer.")
-        sys.exit(1)
-    lang_mapping_file = sys.argv[4]
-
-    model_counts = encode_ngram_model(train_file, n, lang_mapping_file)
-    serialize_model(model_counts, output_file)
+    if args.update:
+        with stats.stage("update"):
+            model_counts = add_model_file_counts(
+                model_counts, args.update, text=True, max_memory=args.max_memory
+            )
+    pruned_counts = PrunedCounts(
+        model_counts,
+        min_count=args.min_count,
+        top_k=args.top_k,
+        feature_selection=args.feature_selection,
+        num_features=args.num_features,
+    )
+    with stats.stage("serialize"):
+        serialize_model(pruned_counts, args.output_file, sort=args.sort)
+    class_names = {v: k for k, v in lang_mapping.items()}
+    print_size_report(pruned_counts, class_names)
+    with stats.stage("metadata"):
+        write_build_metadata(args, "codepoint", lang_mapping, class_counts, pruned_counts, update_meta)
+    if isinstance(model_counts, ExternalCounts):
+        model_counts.close()
+    write_build_stats(args, stats, class_counts, pruned_counts, sampled_counts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Builds several n-gram models (any combination of mode and n) from training data in a single
+pass. Every training line is parsed and validated once, and every sentence is encoded and
+padded once per mode; the n-grams of every requested n are taken from the same sequence.
+
+The sequence of a mode is padded for the largest requested n; the padded sequence of a
+smaller n is the middle part of it, so each model gets exactly the n-grams (in the same
+order) as the create_ngram_model_<mode>.py builder would give it.
+
+The models are written in the layout of the models/ directory, each with its nb_models.xml
+(with the priors of the training data) and .meta.json file:
+  <output_dir>/<mode>/<unigram|bigram|trigram|4-gram|...>/lang_<mode>_<n>.bin
+The stage times and counts of the run are written to <output_dir>/stats.json.
+
+Usage:
+  python create_ngram_models.py <train.tsv> <lang_mapping.json> <output_dir>
+      [--models byte:1-5,codepoint:1-3,token:1] [--workers N] [--sort] [--min-count N]
+      [--top-k K] [--feature-selection {chi2,ig} --num-features N] [--corpus-cache DIR]
+      [--max-per-class N] [--sample-seed SEED]
+"""
+
+import argparse
+import collections
+import os
+import time
+
+from util.corpus_cache import open_corpus_cache
+from util.counting import ENTRY_OVERHEAD_BYTES, SPILL_CHECK_SENTENCES, count_training_file
+from util.helpers import RunStats, load_language_mapping, validate_builder_arguments
+from util.model_io import write_model_counts
+from util.model_meta import model_entry, write_model_meta, write_nb_models_xml
+from util.pruning import FEATURE_SELECTION_METHODS, PrunedCounts, print_size_report
+
+import create_ngram_model_byte
+import create_ngram_model_codepoint
+import create_ngram_model_token
+
+# The model matrix shipped in models/.
+DEFAULT_MODELS = "byte:1-5,codepoint:1-3,token:1"
+ORDER_NAMES = {1: "unigram", 2: "bigram", 3: "trigram"}
+
+
+def parse_model_list(spec):
+    """
+    Parses a model list such as "byte:1-5,codepoint:1-3,token:1".
+
+    Returns:
+      list: (mode, n) pairs in the given order, without duplicates.
+    """
+    models = []
+    for part in spec.split(","):
+        mode, _, orders = part.strip().partition(":")
+        if mode not in ("byte", "codepoint", "token") or not orders:
+            raise argparse.ArgumentTypeError(f"invalid model '{part}', expected <mode>:<n>[-<n>]")
+        first, _, last = orders.partition("-")
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid n in '{part}'")
+        if first < 1 or last < first:
+            raise argparse.ArgumentTypeError(f"invalid n range in '{part}'")
+        for n in range(first, last + 1):
+            if (mode, n) not in models:
+                models.append((mode, n))
+    return models
+
+
+def byte_sequence(sentence, max_n):
+    module = create_ngram_model_byte
+    padding = max_n - 1
+    return module.START_TOKEN * padding + sentence.encode("utf-8") + module.END_TOKEN * padding
+
+
+def codepoint_sequence(sentence, max_n):
+    module = create_ngram_model_codepoint
+    padding = max_n - 1
+    return [module.START_TOKEN] * padding + list(sentence) + [module.END_TOKEN] * padding
+
+
+def token_sequence(sentence, max_n):
+    module = create_ngram_model_token
+    padding = max_n - 1
+    return [module.START_TOKEN] * padding + sentence.split() + [module.END_TOKEN] * padding
+
+
+# Padded sequence and n-gram constructor of every mode.
+MODE_SEQUENCES = {
+    "byte": (byte_sequence, None),
+    "codepoint": (codepoint_sequence, "".join),
+    "token": (token_sequence, " ".join),
+}
+
+
+class MultiModelCounter:
+    """
+    Counting backend that counts the n-grams of several (mode, n) models at once. Its counts
+    are a dictionary mapping every (mode, n) to the counts dictionary of that model.
+    """
+
+    batch_size = SPILL_CHECK_SENTENCES
+
+    def __init__(self, models):
+        self.models = models
+        # For every mode: the largest n and the requested orders.
+        self.modes = {}
+        for mode, n in models:
+            self.modes.setdefault(mode, []).append(n)
+
+    def new_counts(self):
+        return {model: collections.defaultdict(int) for model in self.models}
+
+    def count(self, examples, n, model_counts):
+        modes = [
+            (
+                MODE_SEQUENCES[mode][0],
+                MODE_SEQUENCES[mode][1],
+                max(orders),
+                [(order, model_counts[(mode, order)]) for order in orders],
+            )
+            for mode, orders in self.modes.items()
+        ]
+        for class_id, sentence in examples:
+            for sequence_function, join, max_n, orders in modes:
+                padded = sequence_function(sentence, max_n)
+                length = len(padded)
+                for order, counts in orders:
+                    # The sequence padded for order is padded[max_n - order : length - (max_n - order)].
+                    offset = max_n - order
+                    end = length - offset - order + 1
+                    if join is None:
+                        for i in range(offset, end):
+                            counts[(class_id, padded[i : i + order])] += 1
+                    else:
+                        for i in range(offset, end):
+                            counts[(class_id, join(padded[i : i + order]))] += 1
+
+    def merge(self, model_counts, partial_counts):
+        for model, partial in partial_counts.items():
+            counts = model_counts[model]
+            for key, count in partial.items():
+                counts[key] += count
+        return model_counts
+
+    def entry_bytes(self, model_counts):
+        return ENTRY_OVERHEAD_BYTES
+
+    def distinct_keys(self, model_counts):
+        return sum(len(counts) for counts in model_counts.values())
+
+
+def model_directory(output_dir, mode, n):
+    return os.path.join(output_dir, mode, ORDER_NAMES.get(n, f"{n}-gram"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds several n-gram models from training data in a single pass."
+    )
+    parser.add_argument("train_file", help="TSV file with training data.")
+    parser.add_argument("lang_mapping_file", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument("output_dir", help="Directory the models are written to.")
+    parser.add_argument(
+        "--models",
+        type=parse_model_list,
+        default=parse_model_list(DEFAULT_MODELS),
+        help=f"Comma-separated models to build as <mode>:<n> or <mode>:<first n>-<last n> "
+        f"(default: {DEFAULT_MODELS}).",
+    )
+    parser.add_argument(
+        "--name-prefix", default="lang", help="Prefix of the model names (default: lang)."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to count n-grams (default: 1).",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="Write the tuples sorted by class ID and then n-gram, so the output is deterministic.",
+    )
+    parser.add_argument(
+        "--min-count", type=int, default=1, help="Drop tuples seen fewer than this many times."
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=None, help="Keep only the K most frequent n-grams per class."
+    )
+    parser.add_argument(
+        "--feature-selection",
+        choices=FEATURE_SELECTION_METHODS,
+        default=None,
+        help="Keep only the --num-features most discriminative n-grams of every model.",
+    )
+    parser.add_argument(
+        "--num-features", type=int, default=None, help="Number of n-grams kept by --feature-selection."
+    )
+    parser.add_argument(
+        "--max-per-class",
+        type=int,
+        default=None,
+        help="Count only a seeded stratified sample of at most N training examples of every "
+        "class; the priors are still computed from all examples.",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed of the hash that samples the examples of --max-per-class (default: 0).",
+    )
+    parser.add_argument(
+        "--corpus-cache",
+        metavar="DIR",
+        default=None,
+        help="Read the training data from a compiled corpus cache in DIR, compiling it first "
+        "if it is missing or out of date.",
+    )
+    args = parser.parse_args()
+    validate_builder_arguments(parser, args)
+
+    lang_mapping = load_language_mapping(args.lang_mapping_file)
+    class_names = {v: k for k, v in lang_mapping.items()}
+    class_counts = collections.Counter()
+    sampled_counts = collections.Counter()
+    stats = RunStats("create_ngram_models")
+    corpus_cache = None
+    if args.corpus_cache:
+        with stats.stage("parse"):
+            corpus_cache = open_corpus_cache(
+                args.corpus_cache, args.train_file, args.lang_mapping_file, stats.skipped
+            )
+
+    start = time.perf_counter()
+    with stats.stage("count"):
+        all_counts = count_training_file(
+            args.train_file,
+            None,
+            lang_mapping,
+            MultiModelCounter(args.models),
+            args.workers,
+            class_counts=class_counts,
+            corpus_cache=corpus_cache,
+            stats=stats,
+            max_per_class=args.max_per_class,
+            sample_seed=args.sample_seed,
+            sampled_counts=sampled_counts,
+        )
+    examples = sum(class_counts.values())
+    if args.max_per_class is not None:
+        examples = f"{sum(sampled_counts.values())} of {examples}"
+    print(
+        f"Counted {len(args.models)} models from {examples} training examples "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
+    if args.max_per_class is not None:
+        stats.set(
+            max_per_class=args.max_per_class,
+            sample_seed=args.sample_seed,
+            sampled_examples=sum(sampled_counts.values()),
+        )
+
+    models = {}
+    for mode, n in args.models:
+        directory = model_directory(args.output_dir, mode, n)
+        os.makedirs(directory, exist_ok=True)
+        model_file = os.path.join(directory, f"{args.name_prefix}_{mode}_{n}.bin")
+        pruned_counts = PrunedCounts(
+            all_counts.pop((mode, n)),
+            min_count=args.min_count,
+            top_k=args.top_k,
+            feature_selection=args.feature_selection,
+            num_features=args.num_features,
+        )
+        with stats.stage("serialize"):
+            total = write_model_counts(pruned_counts, model_file, sort=args.sort)
+        print(f"Written binary model to '{model_file}'. Total tuples: {total}")
+        print_size_report(pruned_counts, class_names)
+        with stats.stage("metadata"):
+            write_model_meta(
+                model_file, mode, n, lang_mapping, class_counts, pruned_counts.describe()
+            )
+            write_nb_models_xml(
+                os.path.join(directory, "nb_models.xml"),
+                [model_entry(model_file, mode, n, class_counts)],
+            )
+        models[f"{mode}:{n}"] = {
+            "distinct_keys": pruned_counts.input_tuples,
+            "tuples": pruned_counts.output_tuples,
+            "model_bytes": os.path.getsize(model_file),
+        }
+
+    stats.set(
+        workers=args.workers,
+        examples=sum(class_counts.values()),
+        distinct_keys=sum(model["distinct_keys"] for model in models.values()),
+        tuples=sum(model["tuples"] for model in models.values()),
+        models=models,
+    )
+    stats.write(os.path.join(args.output_dir, "stats.json"))
+
+
+if __name__ == "__main__":
+    main()
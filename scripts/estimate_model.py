@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Estimates the number of tuples, the .bin size and the peak memory of the builders for n-gram
+models before building them (requires NumPy).
+
+The training data is read once, like the builders read it, and the padded n-grams of every
+requested (mode, n) are hashed with vectorized NumPy code instead of being counted:
+  - A HyperLogLog sketch per class (see util/sketches.py) estimates the number of distinct
+    (class, n-gram) tuples, which is the number of tuples of the model, and one more sketch
+    estimates the number of distinct n-grams.
+  - A bottom-k sample of the distinct tuples gives their average n-gram length in bytes,
+    and the average size of the n-gram objects the builders keep in memory.
+The .bin size follows from the number of tuples and their average size, and the peak memory
+of a serial build from memory models of the two counting engines that were calibrated on
+builds of the models in models/.
+
+Usage:
+  python estimate_model.py <train.tsv> <lang_mapping.json> [--models byte:1-5,codepoint:1-3,token:1]
+      [--precision P] [--sample-size K] [--memory-limit SIZE] [--per-class] [--json FILE]
+      [--corpus-cache DIR]
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+import create_ngram_model_byte
+import create_ngram_model_codepoint
+import create_ngram_model_token
+from create_ngram_models import DEFAULT_MODELS, parse_model_list
+from util.corpus_cache import open_corpus_cache
+from util.counting import TrainingFile, iter_batches
+from util.helpers import RunStats, load_language_mapping, parse_size
+from util.model_io import COUNT, HEADER
+from util.numpy_counting import (
+    BATCH_SENTENCES,
+    INTERNED_BATCH_SENTENCES,
+    MAX_N,
+    MAX_UNIT_BITS,
+    WORD_ENTRY_BYTES,
+    key_words,
+    pad_units,
+    window_positions,
+)
+from util.sketches import BottomKSample, HyperLogLog, mix64
+
+# Number of sentences hashed at once.
+SKETCH_BATCH_SENTENCES = 4096
+DEFAULT_PRECISION = 14
+DEFAULT_SAMPLE_SIZE = 4096
+# Multiplier of the polynomial hash of the unit hashes of an n-gram (the 64-bit FNV prime).
+NGRAM_HASH_MULTIPLIER = np.uint64(0x100000001B3)
+# Bytes of a tuple in the .bin file besides its n-gram.
+TUPLE_OVERHEAD_BYTES = HEADER.size + COUNT.size
+
+# Memory models of a serial build, fitted to the peak RSS of builds of 1- to 5-gram models;
+# the estimates were within MEMORY_MODEL_ERROR of the measured peaks.
+MEMORY_MODEL_ERROR = 0.2
+# Python engine: interpreter and modules.
+PYTHON_BASE_BYTES = 22 << 20
+# Python engine: the dictionary entry and key tuple of a tuple, besides the n-gram object.
+PYTHON_ENTRY_BYTES = {"byte": 150, "codepoint": 100, "token": 100}
+# NumPy engine: interpreter, NumPy and the arrays that do not depend on the data.
+NUMPY_BASE_BYTES = {"byte": 36 << 20, "codepoint": 35 << 20, "token": 36 << 20}
+# NumPy engine: temporaries per n-gram window of a counted batch.
+NUMPY_WINDOW_BYTES = {"byte": 68, "codepoint": 180, "token": 180}
+NUMPY_BATCH_SENTENCES = {
+    "byte": BATCH_SENTENCES,
+    "codepoint": INTERNED_BATCH_SENTENCES,
+    "token": INTERNED_BATCH_SENTENCES,
+}
+# NumPy engine: the key, count and position arrays of a tuple and the temporaries of
+# compacting and serializing them.
+NUMPY_TUPLE_BYTES = {"byte": 105, "codepoint": 135, "token": 100}
+# NumPy engine: the vocabulary entry of a distinct unit, besides the unit object.
+NUMPY_UNIT_BYTES = 100
+
+
+class ByteUnits:
+    """
+    Units of byte models: the bytes of the UTF-8 encoded sentence.
+    """
+
+    start_id = create_ngram_model_byte.START_TOKEN[0]
+    end_id = create_ngram_model_byte.END_TOKEN[0]
+
+    def sentence_units(self, sentences):
+        encoded = [sentence.encode("utf-8") for sentence in sentences]
+        ids = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+        return ids, np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+
+    def ngram(self, ids):
+        return bytes(ids)
+
+    def distinct_units(self):
+        # Bytes are packed into the keys without interning.
+        return 0
+
+    def vocabulary_bytes(self):
+        return 0
+
+
+class CodepointUnits:
+    """
+    Units of code point models: the code points of the sentence.
+    """
+
+    start_id = ord(create_ngram_model_codepoint.START_TOKEN)
+    end_id = ord(create_ngram_model_codepoint.END_TOKEN)
+
+    def __init__(self):
+        self.seen = np.zeros(sys.maxunicode + 1, dtype=bool)
+        self.seen[[self.start_id, self.end_id]] = True
+
+    def sentence_units(self, sentences):
+        ids = np.frombuffer("".join(sentences).encode("utf-32-le"), dtype=np.uint32)
+        self.seen[ids] = True
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        return ids.astype(np.uint64), lengths
+
+    def ngram(self, ids):
+        return "".join(map(chr, ids))
+
+    def distinct_units(self):
+        return int(self.seen.sum())
+
+    def vocabulary_bytes(self):
+        # At most a few thousand distinct code points.
+        return 0
+
+
+class TokenUnits:
+    """
+    Units of token models: the whitespace tokens of the sentence, interned to ids.
+    """
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.tokens = []
+        self.start_id, self.end_id = self.intern(
+            [create_ngram_model_token.START_TOKEN, create_ngram_model_token.END_TOKEN]
+        ).tolist()
+
+    def intern(self, tokens):
+        vocabulary = self.vocabulary
+        for token in dict.fromkeys(tokens):
+            if token not in vocabulary:
+                vocabulary[token] = len(self.tokens)
+                self.tokens.append(token)
+        return np.fromiter(map(vocabulary.__getitem__, tokens), dtype=np.uint64, count=len(tokens))
+
+    def sentence_units(self, sentences):
+        tokens = [sentence.split() for sentence in sentences]
+        ids = self.intern([token for sentence_tokens in tokens for token in sentence_tokens])
+        return ids, np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+
+    def ngram(self, ids):
+        return " ".join(self.tokens[i] for i in ids)
+
+    def distinct_units(self):
+        return len(self.tokens)
+
+    def vocabulary_bytes(self):
+        return sum(NUMPY_UNIT_BYTES + sys.getsizeof(token) for token in self.tokens)
+
+
+MODE_UNITS = {"byte": ByteUnits, "codepoint": CodepointUnits, "token": TokenUnits}
+
+
+class ModelSketch:
+    """
+    Sketches of the (class, n-gram) tuples of one (mode, n) model.
+
+    Parameters:
+      n (int): N-gram size.
+      num_classes (int): Number of class rows; the tuples of class row r are added to
+        sketch row r, and all n-grams to row num_classes.
+    """
+
+    def __init__(self, n, num_classes, precision, sample_size):
+        self.n = n
+        self.num_classes = num_classes
+        self.sketch = HyperLogLog(num_classes + 1, precision)
+        self.sample = BottomKSample(sample_size, n)
+        self.windows = np.zeros(num_classes, dtype=np.int64)
+        self.class_salts = mix64(np.arange(num_classes, dtype=np.uint64) + np.uint64(1))
+
+    def add(self, units, lengths, class_rows):
+        """
+        Adds the n-gram windows of a batch of padded sentences.
+
+        Parameters:
+          units (np.ndarray): Unit ids of the padded sentences, concatenated.
+          lengths (np.ndarray): Number of units of every padded sentence.
+          class_rows (np.ndarray): Class row of every sentence.
+        """
+        n = self.n
+        positions, windows = window_positions(lengths, n)
+        unit_hashes = mix64(units)
+        hashes = np.zeros(len(positions), dtype=np.uint64)
+        for j in range(n):
+            hashes *= NGRAM_HASH_MULTIPLIER
+            hashes += unit_hashes[positions + j]
+        ngram_hashes = mix64(hashes)
+        rows = np.repeat(class_rows, windows)
+        tuple_hashes = mix64(ngram_hashes ^ self.class_salts[rows])
+
+        self.windows += np.bincount(rows, minlength=self.num_classes)
+        self.sketch.add(rows, tuple_hashes)
+        self.sketch.add(np.full(len(ngram_hashes), self.num_classes), ngram_hashes)
+
+        def sample_units(mask):
+            starts = positions if mask is None else positions[mask]
+            return units[starts[:, None] + np.arange(n)].astype(np.int64)
+
+        self.sample.add(tuple_hashes, sample_units)
+
+
+def estimate_model(mode, n, model_sketch, units, examples):
+    """
+    Turns the sketches of a model into estimates; examples is the number of training
+    examples.
+
+    Returns:
+      dict: Estimated tuples (also per class row), distinct n-grams, .bin size and peak
+      memory of both engines, with their relative errors (about two standard errors).
+    """
+    sketch = model_sketch.sketch
+    estimates = sketch.estimates()
+    # A class cannot have more tuples than n-gram windows.
+    class_tuples = np.minimum(estimates[:-1], model_sketch.windows)
+    sample = model_sketch.sample
+    if len(sample) < sample.k:
+        # The sample holds every distinct tuple.
+        tuples = len(sample)
+        tuples_error = 0.0
+    else:
+        tuples = float(class_tuples.sum())
+        tuples_error = 2 * sketch.relative_error
+
+    ngrams = [units.ngram(ids) for ids in sample.values.tolist()]
+    if ngrams:
+        tuple_bytes = np.array(
+            [
+                TUPLE_OVERHEAD_BYTES + len(ngram if mode == "byte" else ngram.encode("utf-8"))
+                for ngram in ngrams
+            ],
+            dtype=np.float64,
+        )
+        object_bytes = np.mean([sys.getsizeof(ngram) for ngram in ngrams])
+        mean_tuple_bytes = float(tuple_bytes.mean())
+        size_error = 0.0
+        if tuples_error:
+            mean_error = 2 * tuple_bytes.std() / math.sqrt(len(ngrams)) / mean_tuple_bytes
+            size_error = math.hypot(tuples_error, mean_error)
+    else:
+        object_bytes = mean_tuple_bytes = size_error = 0.0
+
+    python_ngram_bytes = tuples * (PYTHON_ENTRY_BYTES[mode] + object_bytes)
+    numpy_memory = None
+    numpy_key_words = 1
+    if n <= MAX_N:
+        # Interned ids that do not fit one 64-bit word per n-gram are packed into several.
+        if units.distinct_units() > 1 << min(MAX_UNIT_BITS, 64 // n):
+            numpy_key_words = key_words(n, MAX_UNIT_BITS)
+        extra_word_bytes = WORD_ENTRY_BYTES * (numpy_key_words - 1)
+        windows_per_example = model_sketch.windows.sum() / max(examples, 1)
+        batch_windows = min(examples, NUMPY_BATCH_SENTENCES[mode]) * windows_per_example
+        numpy_memory = (
+            NUMPY_BASE_BYTES[mode]
+            + batch_windows * (NUMPY_WINDOW_BYTES[mode] + extra_word_bytes)
+            + tuples * (NUMPY_TUPLE_BYTES[mode] + extra_word_bytes)
+            + units.vocabulary_bytes()
+        )
+    return {
+        "mode": mode,
+        "n": n,
+        "windows": int(model_sketch.windows.sum()),
+        "tuples": int(round(tuples)),
+        "tuples_error": tuples_error,
+        "class_tuples": [int(round(t)) for t in class_tuples],
+        "distinct_ngrams": int(round(min(estimates[-1], tuples))),
+        "model_bytes": int(round(tuples * mean_tuple_bytes)),
+        "model_bytes_error": size_error,
+        "python_memory_bytes": int(PYTHON_BASE_BYTES + python_ngram_bytes),
+        "python_ngram_bytes": python_ngram_bytes,
+        "numpy_memory_bytes": None if numpy_memory is None else int(numpy_memory),
+        "numpy_key_words": numpy_key_words,
+        "memory_error": math.hypot(tuples_error, MEMORY_MODEL_ERROR),
+    }
+
+
+def estimate_models(
+    source, models, lang_mapping, precision, sample_size, class_counts, stats=None
+):
+    """
+    Sketches all models in one pass over the training examples of source. With stats (a
+    util.helpers.RunStats) the skipped lines are counted and progress lines are printed.
+
+    Returns:
+      list: The estimate_model dictionaries of models, in order.
+    """
+    class_ids = sorted(set(lang_mapping.values()))
+    class_rows = np.zeros(class_ids[-1] + 1 if class_ids else 1, dtype=np.int64)
+    class_rows[class_ids] = np.arange(len(class_ids))
+    orders = collections.defaultdict(list)
+    for mode, n in models:
+        orders[mode].append(n)
+    units = {mode: MODE_UNITS[mode]() for mode in orders}
+    sketches = {
+        model: ModelSketch(model[1], len(class_ids), precision, sample_size) for model in models
+    }
+
+    skipped = progress = None
+    if stats is not None:
+        skipped = stats.skipped
+        progress = stats.progress("Sketching")
+    examples = source.iter_examples(class_counts=class_counts, skipped=skipped, progress=progress)
+    for batch in iter_batches(examples, SKETCH_BATCH_SENTENCES):
+        rows = class_rows[np.fromiter((c for c, _ in batch), dtype=np.int64, count=len(batch))]
+        sentences = [sentence for _, sentence in batch]
+        for mode, mode_orders in orders.items():
+            mode_units = units[mode]
+            ids, lengths = mode_units.sentence_units(sentences)
+            for n in mode_orders:
+                padded, padded_lengths = pad_units(
+                    ids, lengths, n - 1, mode_units.start_id, mode_units.end_id
+                )
+                sketches[(mode, n)].add(padded, padded_lengths, rows)
+
+    num_examples = sum(class_counts.values())
+    return [
+        estimate_model(mode, n, sketches[(mode, n)], units[mode], num_examples)
+        for mode, n in models
+    ]
+
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _megabytes(size):
+    return f"{size / 1e6:.2f} MB"
+
+
+def _error(error):
+    return f"±{error * 100:.0f}%" if error >= 0.01 else "exact" if error == 0 else "±1%"
+
+
+def print_estimates(estimates, class_names, memory_limit, per_class):
+    for e in estimates:
+        print(f"{e['mode']}:{e['n']}")
+        print(
+            f"  Tuples: {e['tuples']} ({_error(e['tuples_error'])}) from {e['windows']} "
+            f"n-grams; distinct n-grams: {e['distinct_ngrams']}"
+        )
+        print(f"  Model size: {_megabytes(e['model_bytes'])} ({_error(e['model_bytes_error'])})")
+        memory = f"  Peak memory: {_megabytes(e['python_memory_bytes'])} (python engine)"
+        if e["numpy_memory_bytes"] is not None:
+            memory += f", {_megabytes(e['numpy_memory_bytes'])} (numpy engine)"
+        print(memory + f" ({_error(e['memory_error'])})")
+        if e["numpy_key_words"] > 1:
+            print(
+                f"  Note: the vocabulary does not fit 64-bit n-gram keys; the numpy engine packs "
+                f"every n-gram into {e['numpy_key_words']} words, which is slower."
+            )
+        needed = e["python_memory_bytes"]
+        if e["numpy_memory_bytes"] is not None:
+            needed = min(needed, e["numpy_memory_bytes"])
+        if memory_limit and needed > memory_limit:
+            print(
+                f"  Warning: exceeds the memory limit of {_megabytes(memory_limit)}; "
+                "build with --max-memory."
+            )
+        if per_class:
+            for row, tuples in enumerate(e["class_tuples"]):
+                if tuples:
+                    print(f"    {class_names[row]}: {tuples} tuples")
+
+    if len(estimates) > 1:
+        # create_ngram_models.py keeps the counts of all models in memory at once.
+        combined = PYTHON_BASE_BYTES + sum(e["python_ngram_bytes"] for e in estimates)
+        print(f"All models at once (create_ngram_models.py): peak memory {_megabytes(combined)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimates the size and build memory of n-gram models from training data."
+    )
+    parser.add_argument("train_file", help="TSV file with training data.")
+    parser.add_argument("lang_mapping_file", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument(
+        "--models",
+        type=parse_model_list,
+        default=parse_model_list(DEFAULT_MODELS),
+        help=f"Comma-separated models to estimate as <mode>:<n> or <mode>:<first n>-<last n> "
+        f"(default: {DEFAULT_MODELS}).",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=DEFAULT_PRECISION,
+        help=f"HyperLogLog precision: 2^P registers per class and model, relative standard "
+        f"error 1.04 / sqrt(2^P) (default: {DEFAULT_PRECISION}).",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=DEFAULT_SAMPLE_SIZE,
+        help=f"Tuples sampled per model to measure their size (default: {DEFAULT_SAMPLE_SIZE}).",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_size,
+        default=None,
+        help="Warn about models whose build needs more memory (default: the physical memory).",
+    )
+    parser.add_argument(
+        "--per-class", action="store_true", help="Also print the estimated tuples of every class."
+    )
+    parser.add_argument("--json", metavar="FILE", default=None, help="Write the estimates as JSON.")
+    parser.add_argument(
+        "--corpus-cache",
+        metavar="DIR",
+        default=None,
+        help="Read the training data from a compiled corpus cache in DIR, compiling it first "
+        "if it is missing or out of date.",
+    )
+    args = parser.parse_args()
+    if not 4 <= args.precision <= 18:
+        parser.error("--precision must be between 4 and 18")
+    if args.sample_size < 1:
+        parser.error("--sample-size must be positive")
+
+    lang_mapping = load_language_mapping(args.lang_mapping_file)
+    labels = {v: k for k, v in lang_mapping.items()}
+    class_names = [labels[class_id] for class_id in sorted(labels)]
+    stats = RunStats("estimate_model")
+    source = TrainingFile(args.train_file, lang_mapping)
+    if args.corpus_cache:
+        with stats.stage("parse"):
+            source = open_corpus_cache(
+                args.corpus_cache, args.train_file, args.lang_mapping_file, stats.skipped
+            )
+
+    class_counts = collections.Counter()
+    with stats.stage("sketch"):
+        estimates = estimate_models(
+            source,
+            args.models,
+            lang_mapping,
+            args.precision,
+            args.sample_size,
+            class_counts,
+            stats,
+        )
+    print(
+        f"Estimated {len(args.models)} models from {sum(class_counts.values())} training "
+        f"examples in {stats.stages['sketch']:.1f}s (errors are about two standard errors; "
+        "memory is for a serial build)."
+    )
+    memory_limit = args.memory_limit or physical_memory()
+    print_estimates(estimates, class_names, memory_limit, args.per_class)
+    stats.set(examples=sum(class_counts.values()))
+    stats.print_summary()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "train_file": args.train_file,
+                    "examples": sum(class_counts.values()),
+                    "precision": args.precision,
+                    "sample_size": args.sample_size,
+                    "models": [
+                        {k: v for k, v in e.items() if k != "python_ngram_bytes"}
+                        for e in estimates
+                    ],
+                    "run": stats.as_dict(),
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
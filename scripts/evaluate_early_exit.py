@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Measures early-exit scoring against full scoring on a test split (requires NumPy).
+
+Every sentence of the test file is classified by a model of an nb_models.xml file with the
+local reference classifier, once with full scoring (NaiveBayesModel.classify) and once for
+every early exit setting (NaiveBayesModel.classify_early_exit): a margin bound in nats and a
+maximum prefix in n-grams. An infinite bound only stops sentences whose prediction can no
+longer change. For every setting, the report gives the scoring time and speedup, the share
+of the n-grams that was scored, the accuracy and its change, and the share of predictions
+that agree with full scoring. The test sentences are read into memory first, so only the
+scoring is timed.
+
+Usage:
+  python evaluate_early_exit.py <test.tsv> <nb_models.xml> <class_id.json> [--model NAME]
+      [--bounds 5,10,20,inf] [--max-prefixes 0,64] [--step N] [--batch-size N] [--limit N]
+      [--json FILE]
+"""
+
+import argparse
+import itertools
+import json
+import math
+import sys
+import time
+
+from evaluate_predictions import iter_test_file
+from util.classifier import DEFAULT_BATCH_SIZE, DEFAULT_EXIT_STEP, NaiveBayesModel
+from util.helpers import RunStats, load_language_mapping
+from util.model_meta import load_model_configs
+
+DEFAULT_BOUNDS = "5,10,20,inf"
+DEFAULT_MAX_PREFIXES = "0,64"
+
+
+def parse_float_list(value):
+    try:
+        return [float(item) for item in value.split(",") if item]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list of numbers: '{value}'")
+
+
+def parse_int_list(value):
+    try:
+        return [int(item) for item in value.split(",") if item]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list of integers: '{value}'")
+
+
+def load_test_set(test_file, class_mapping, limit=None, skipped=None):
+    """
+    Reads the sentences of the test file whose language is in class_mapping.
+
+    Returns:
+      tuple: (sentences, true class ids, number of sentences with an unknown language).
+    """
+    sentences = []
+    labels = []
+    unknown = 0
+    for _, lang, sentence in itertools.islice(iter_test_file(test_file, skipped), limit):
+        if lang not in class_mapping:
+            unknown += 1
+            continue
+        sentences.append(sentence)
+        labels.append(class_mapping[lang])
+    return sentences, labels, unknown
+
+
+def score(model, sentences, batch_size, setting=None, step=DEFAULT_EXIT_STEP):
+    """
+    Classifies the sentences in batches with full scoring (setting None) or early exit
+    (setting a (bound, max_prefix) pair).
+
+    Returns:
+      tuple: (predicted classes, scored n-grams or None, seconds).
+    """
+    predicted = []
+    scored = [] if setting is not None else None
+    start = time.perf_counter()
+    for i in range(0, len(sentences), batch_size):
+        batch = sentences[i : i + batch_size]
+        if setting is None:
+            predicted += model.classify(batch)
+        else:
+            bound, max_prefix = setting
+            classes, counts = model.classify_early_exit(batch, bound, max_prefix, step)
+            predicted += classes
+            scored += counts
+    return predicted, scored, time.perf_counter() - start
+
+
+def format_setting(bound, max_prefix):
+    bound = "exact" if math.isinf(bound) else f"{bound:g}"
+    return f"bound {bound}, prefix {max_prefix or 'all'}"
+
+
+def print_report(rows):
+    header = ["setting", "time", "speedup", "n-grams", "accuracy", "change", "agreement"]
+    table = [header] + [
+        [
+            row["setting"],
+            f"{row['seconds']:.3f}s",
+            f"{row['speedup']:.2f}x",
+            f"{row['scored_share'] * 100:.1f}%",
+            f"{row['accuracy'] * 100:.2f}%",
+            f"{row['accuracy_change'] * 100:+.2f}pp",
+            f"{row['agreement'] * 100:.2f}%",
+        ]
+        for row in rows
+    ]
+    widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+    for line in table:
+        print(
+            "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(line, widths))
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares early-exit scoring with full scoring on a test split."
+    )
+    parser.add_argument("test_file", help="TSV file with test data (lang, sentence).")
+    parser.add_argument("models_xml", help="nb_models.xml file with the model.")
+    parser.add_argument("class_id_json", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument(
+        "--model", default=None, help="Model of the XML file (default: the first one)."
+    )
+    parser.add_argument(
+        "--bounds",
+        type=parse_float_list,
+        default=parse_float_list(DEFAULT_BOUNDS),
+        help="Comma-separated margin bounds in nats; inf only stops sentences whose prediction "
+        f"cannot change (default: {DEFAULT_BOUNDS}).",
+    )
+    parser.add_argument(
+        "--max-prefixes",
+        type=parse_int_list,
+        default=parse_int_list(DEFAULT_MAX_PREFIXES),
+        help="Comma-separated maximum numbers of n-grams scored per sentence, 0 for no limit "
+        f"(default: {DEFAULT_MAX_PREFIXES}).",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=DEFAULT_EXIT_STEP,
+        help=f"N-grams scored between two margin checks (default: {DEFAULT_EXIT_STEP}).",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Sentences classified at once (default: {DEFAULT_BATCH_SIZE}).",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Use only the first N lines of the test file."
+    )
+    parser.add_argument("--json", metavar="FILE", default=None, help="Write the report as JSON.")
+    args = parser.parse_args()
+    if args.step < 1 or args.batch_size < 1:
+        parser.error("--step and --batch-size must be positive")
+    if any(bound <= 0 for bound in args.bounds) or any(p < 0 for p in args.max_prefixes):
+        parser.error("--bounds must be positive and --max-prefixes non-negative")
+
+    stats = RunStats("evaluate_early_exit")
+    configs = load_model_configs(args.models_xml)
+    model_name = args.model or next(iter(configs), None)
+    if model_name not in configs:
+        print(f"Error: model '{model_name}' not found in '{args.models_xml}'.", file=sys.stderr)
+        sys.exit(1)
+    with stats.stage("load"):
+        model = NaiveBayesModel.from_config(configs[model_name])
+        class_mapping = load_language_mapping(args.class_id_json)
+        sentences, labels, unknown = load_test_set(
+            args.test_file, class_mapping, args.limit, stats.skipped
+        )
+    if not sentences:
+        print("Error: no test sentences with a language of the class mapping.", file=sys.stderr)
+        sys.exit(1)
+    total_ngrams = sum(model.ngram_count(sentence) for sentence in sentences)
+    print(
+        f"Scoring {len(sentences)} sentences ({total_ngrams} n-grams, {unknown} with an unknown "
+        f"language skipped) with '{model_name}' ({model.mode}, n={model.n}); the largest "
+        f"per-n-gram margin change is {model.max_swing:.2f} nats."
+    )
+
+    with stats.stage("full"):
+        full, _, full_seconds = score(model, sentences, args.batch_size)
+    full_correct = sum(p == t for p, t in zip(full, labels))
+    rows = [
+        {
+            "setting": "full scoring",
+            "bound": None,
+            "max_prefix": None,
+            "seconds": full_seconds,
+            "speedup": 1.0,
+            "scored_ngrams": total_ngrams,
+            "scored_share": 1.0,
+            "accuracy": full_correct / len(labels),
+            "accuracy_change": 0.0,
+            "agreement": 1.0,
+        }
+    ]
+    with stats.stage("early_exit"):
+        for bound, max_prefix in itertools.product(args.bounds, args.max_prefixes):
+            setting = (bound, max_prefix or None)
+            predicted, scored, seconds = score(
+                model, sentences, args.batch_size, setting, args.step
+            )
+            correct = sum(p == t for p, t in zip(predicted, labels))
+            rows.append(
+                {
+                    "setting": format_setting(bound, max_prefix),
+                    "bound": None if math.isinf(bound) else bound,
+                    "max_prefix": max_prefix or None,
+                    "seconds": seconds,
+                    "speedup": full_seconds / seconds if seconds > 0 else 0.0,
+                    "scored_ngrams": sum(scored),
+                    "scored_share": sum(scored) / total_ngrams if total_ngrams else 0.0,
+                    "accuracy": correct / len(labels),
+                    "accuracy_change": (correct - full_correct) / len(labels),
+                    "agreement": sum(p == f for p, f in zip(predicted, full)) / len(full),
+                }
+            )
+    print_report(rows)
+
+    stats.set(model=model_name, sentences=len(sentences), ngrams=total_ngrams)
+    stats.print_summary()
+    if args.json:
+        report = {
+            "model": model_name,
+            "mode": model.mode,
+            "n": model.n,
+            "sentences": len(sentences),
+            "ngrams": total_ngrams,
+            "max_swing": model.max_swing,
+            "step": args.step,
+            "settings": rows,
+            "run": stats.as_dict(),
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Written the report to '{args.json}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,10 @@
 """
 Evaluates predictions from ClickHouse.
 Usage:
-  python evaluate_predictions.py <test.tsv> <model_name> <class_id.json> <results_file> <directory>
+  python evaluate_predictions.py <test.tsv> <model_name>[,<model_name>...] <class_id.json>
+      <results_file> <directory>
+      [--local-models nb_models.xml] [--batch-size N] [--workers N] [--chunk-size N]
+      [--retries N] [--stream [--client CMD]]
 
 Workflow:
   1. Reads a test.tsv file with two tab-separated columns: <lang_name> <sentence>
@@ -10,41 +13,83 @@ Workflow:
   3. Creates bulk_input.tsv in the given directory (columns: sentence_id, model_name, sentence)
      where model_name is provided as an argument to be used in the ClickHouse prediction.
   4. Calls an external bash script (predict.sh) that uses ClickHouse to read
-     bulk_input.tsv and produce predictions.tsv (columns: sentence_id, input, predicted_class)
-  5. Uses the class mapping (from class_id.json) to compare predicted classes to true labels.
-  6. Computes overall and per-class accuracy.
-  7. Writes the results in the results_file.
+     bulk_input.tsv and produce predictions.tsv (columns: sentence_id, input, predicted_class),
+     with --workers concurrent clients (see predict.py).
+     With --local-models, predictions.tsv is produced by the local reference classifier
+     (util/classifier.py) from the models in the given nb_models.xml instead.
+  5. Streams the test file and predictions.tsv side by side, joins them by sentence_id and
+     uses the class mapping (from class_id.json) to compare predicted classes to true labels
+     in a confusion matrix (util/evaluation.py, requires NumPy).
+  6. Computes overall and per-class accuracy, per-class precision, recall and F1 and the top
+     confusions. Missing predictions and unknown classes are counted, not fatal.
+  7. Writes the results in the results_file and the confusion matrix in
+     confusion_matrix.tsv in the given directory, and the stage times and counts of the run
+     next to the results file (<results>.stats.json).
+
+Only the confusion matrix is kept in memory, so memory does not grow with the test set.
+
+With --stream, steps 2 to 5 are replaced by a streaming runner that writes no intermediate
+files: the test file is read in chunks of --chunk-size sentences, every chunk is piped to the
+stdin of clickhouse-client as an external table (see util/clickhouse_client.py) or classified
+by the local classifier, and the predictions are scored as each chunk comes back. --workers
+chunks are predicted at once, and their predictions are scored in the order of the test file.
+
+With a comma-separated list of model names, all the models are evaluated in one pass over the
+test file with the streaming runner: every chunk is sent once, and each sentence is predicted
+by every model in the same query (one naiveBayesClassifier column per model, see
+MultiModelClickHousePredictor) or by every local model. Each model gets its own confusion
+matrix; its results and confusion_matrix.tsv are written to <directory>/<model_name>/, and
+results_file in <directory> is a Markdown report comparing the models, with per-language
+accuracy tables in the format of models/*/README.md.
 """
 
 import sys
 import os
+import argparse
 import json
+import itertools
 import subprocess
+import threading
 from collections import defaultdict
 
+from util.clickhouse_client import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_RETRIES,
+    ClickHouseClientError,
+    ClickHousePredictor,
+    MultiModelClickHousePredictor,
+    load_client_command,
+    predict_chunks,
+)
+from util.evaluation import ConfusionMatrix, comparison_report_lines
+from util.helpers import RunStats, stats_file_path
 
-def load_test_file(test_file):
+
+def iter_test_file(test_file, skipped=None):
     """
-    Read test.tsv (two columns: lang, sentence) and attach incremental sentence_id.
+    Read test.tsv (two columns: lang, sentence) and yield (sentence_id, lang, sentence)
+    records with an incremental sentence_id. Lines without two columns are skipped and
+    counted in skipped (a SkippedLines) if given.
     """
-    data = []
     sentence_id = 1
     with open(test_file, "r", encoding="utf-8") as fin:
         for line in fin:
             line = line.rstrip("\n")
             parts = line.split("\t")
             if len(parts) < 2:
+                if skipped is not None:
+                    skipped.add("too few columns", f"line '{line}' does not have enough parts")
                 continue
             lang = parts[0].strip()
             sentence = parts[1].strip()
-            data.append((sentence_id, lang, sentence))
+            yield sentence_id, lang, sentence
             sentence_id += 1
-    return data
 
 
 def write_with_sentence_id(data, outfile):
     """
     Write TSV file with columns: sentence_id, lang, sentence.
+    data is an iterable of (sentence_id, lang, sentence) records.
     """
     with open(outfile, "w", encoding="utf-8", newline="\n") as fout:
         for rec in data:
@@ -63,11 +108,17 @@ def write_bulk_input(data, model_name, outfile):
             fout.write(line + "\n")
 
 
-def run_clickhouse_prediction(bulk_input_path, predictions_path):
+def run_clickhouse_prediction(
+    bulk_input_path,
+    predictions_path,
+    workers=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    retries=DEFAULT_RETRIES,
+):
     """
     Call the external bash prediction script.
     The script is assumed to have the following usage:
-      ./scripts/predict.sh <input_file> <prediction_file>
+      ./scripts/predict.sh <input_file> <prediction_file> [--workers N] [--chunk-size N] [--retries N]
     and it will write the predictions TSV to <prediction_file>.
     """
     bash_script = "./scripts/predict.sh"
@@ -76,6 +127,7 @@ def run_clickhouse_prediction(bulk_input_path, predictions_path):
         sys.exit(1)
 
     cmd = ["bash", bash_script, bulk_input_path, predictions_path]
+    cmd += ["--workers", str(workers), "--chunk-size", str(chunk_size), "--retries", str(retries)]
     print("Running ClickHouse prediction...")
     try:
         subprocess.run(cmd, check=True)
@@ -84,12 +136,196 @@ def run_clickhouse_prediction(bulk_input_path, predictions_path):
         sys.exit(1)
 
 
-def load_predictions(predictions_path):
+def run_local_prediction(bulk_input_path, predictions_path, models_xml, batch_size):
+    """
+    Predict bulk_input.tsv with the local reference classifier instead of ClickHouse.
+    The model named in each row is looked up in models_xml (an nb_models.xml file) and the
+    predictions are written in the same format as predict.sh: sentence_id, input, predicted_class.
+    """
+    from util.classifier import NaiveBayesModel
+    from util.model_meta import load_model_configs
+
+    configs = load_model_configs(models_xml)
+    models = {}
+
+    def flush(model_name, rows, fout):
+        if model_name not in models:
+            if model_name not in configs:
+                print(f"Error: model '{model_name}' not found in '{models_xml}'.", file=sys.stderr)
+                sys.exit(1)
+            models[model_name] = NaiveBayesModel.from_config(configs[model_name])
+        predicted = models[model_name].classify([sentence for _, sentence in rows])
+        for (sentence_id, sentence), predicted_class in zip(rows, predicted):
+            fout.write(f"{sentence_id}\t{sentence}\t{predicted_class}\n")
+
+    print("Running local prediction...")
+    with open(bulk_input_path, "r", encoding="utf-8") as fin, open(
+        predictions_path, "w", encoding="utf-8", newline="\n"
+    ) as fout:
+        rows = []
+        current_model = None
+        for line in fin:
+            sentence_id, model_name, sentence = line.rstrip("\n").split("\t", 2)
+            if rows and (model_name != current_model or len(rows) >= batch_size):
+                flush(current_model, rows, fout)
+                rows = []
+            current_model = model_name
+            rows.append((sentence_id, sentence))
+        if rows:
+            flush(current_model, rows, fout)
+
+
+class LocalPredictor:
+    """
+    Predicts chunks of sentences with the local reference classifier, with the same
+    interface as util.clickhouse_client.ClickHousePredictor.
+    """
+
+    def __init__(self, models_xml):
+        from util.model_meta import load_model_configs
+
+        self.models_xml = models_xml
+        self.configs = load_model_configs(models_xml)
+        self.models = {}
+        # Chunks are predicted from several threads with --workers.
+        self.lock = threading.Lock()
+
+    def predict(self, rows):
+        from util.classifier import NaiveBayesModel
+
+        by_model = defaultdict(list)
+        for sentence_id, model_name, sentence in rows:
+            by_model[model_name].append((sentence_id, sentence))
+        predictions = {}
+        for model_name, entries in by_model.items():
+            with self.lock:
+                if model_name not in self.models:
+                    if model_name not in self.configs:
+                        raise ValueError(f"model '{model_name}' not found in '{self.models_xml}'.")
+                    config = self.configs[model_name]
+                    self.models[model_name] = NaiveBayesModel.from_config(config)
+                model = self.models[model_name]
+            predicted = model.classify([sentence for _, sentence in entries])
+            for (sentence_id, _), predicted_class in zip(entries, predicted):
+                predictions[sentence_id] = str(predicted_class)
+        return predictions
+
+
+class LocalMultiModelPredictor:
+    """
+    Predicts chunks of sentences with several models of the local reference classifier, with
+    the same interface as util.clickhouse_client.MultiModelClickHousePredictor.
+    """
+
+    def __init__(self, models_xml, model_names):
+        from util.classifier import NaiveBayesModel
+        from util.model_meta import load_model_configs
+
+        configs = load_model_configs(models_xml)
+        for model_name in model_names:
+            if model_name not in configs:
+                raise ValueError(f"model '{model_name}' not found in '{models_xml}'.")
+        self.models = [NaiveBayesModel.from_config(configs[name]) for name in model_names]
+
+    def predict(self, rows):
+        sentences = [sentence for _, sentence in rows]
+        predicted = [[str(c) for c in model.classify(sentences)] for model in self.models]
+        return {sentence_id: classes for (sentence_id, _), classes in zip(rows, zip(*predicted))}
+
+
+def iter_chunks(records, chunk_size):
+    """
+    Split an iterable into lists of at most chunk_size items.
+    """
+    iterator = iter(records)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_streaming_evaluation(
+    test_file,
+    model_name,
+    predictor,
+    chunk_size,
+    confusion,
+    workers=1,
+    retries=DEFAULT_RETRIES,
+    skipped=None,
+    progress=None,
+):
+    """
+    Predict the test file chunk by chunk, workers chunks at once, and add every prediction to
+    confusion (a ConfusionMatrix) as soon as its chunk is returned. At most 2 * workers chunks
+    are in memory. Sentences the client returned no prediction for are counted as missing
+    and predictions of sentence IDs outside their chunk as extra, like evaluate_predictions
+    does. Invalid test lines are counted in skipped (a SkippedLines) if given, and progress
+    (a Progress) is advanced for every predicted chunk if given.
+    """
+    chunks = (
+        (chunk, [(sentence_id, model_name, sentence) for sentence_id, _, sentence in chunk])
+        for chunk in iter_chunks(iter_test_file(test_file, skipped), chunk_size)
+    )
+    num_sentences = 0
+    for chunk, predictions in predict_chunks(predictor, chunks, workers, retries):
+        matched = 0
+        for sentence_id, true_lang, _ in chunk:
+            predicted_class = predictions.get(sentence_id)
+            matched += predicted_class is not None
+            confusion.add(true_lang, predicted_class)
+        confusion.extra_predictions += len(predictions) - matched
+        num_sentences += len(chunk)
+        if progress is not None:
+            progress.update(num_sentences)
+    print(f"Predicted {num_sentences} sentences.")
+
+
+def run_multi_model_evaluation(
+    test_file,
+    predictor,
+    chunk_size,
+    confusions,
+    workers=1,
+    retries=DEFAULT_RETRIES,
+    skipped=None,
+    progress=None,
+):
     """
-    Load predictions from the TSV file produced by ClickHouse.
+    Like run_streaming_evaluation, but predicts every chunk with several models at once and
+    adds the prediction of the k-th model to confusions[k] (a list of ConfusionMatrix, in the
+    order of the models of predictor).
+    """
+    chunks = (
+        (chunk, [(sentence_id, sentence) for sentence_id, _, sentence in chunk])
+        for chunk in iter_chunks(iter_test_file(test_file, skipped), chunk_size)
+    )
+    missing = [None] * len(confusions)
+    num_sentences = 0
+    for chunk, predictions in predict_chunks(predictor, chunks, workers, retries):
+        matched = 0
+        for sentence_id, true_lang, _ in chunk:
+            predicted = predictions.get(sentence_id, missing)
+            matched += predicted is not missing
+            for confusion, predicted_class in zip(confusions, predicted):
+                confusion.add(true_lang, predicted_class)
+        for confusion in confusions:
+            confusion.extra_predictions += len(predictions) - matched
+        num_sentences += len(chunk)
+        if progress is not None:
+            progress.update(num_sentences)
+    print(f"Predicted {num_sentences} sentences with {len(confusions)} models.")
+
+
+def iter_predictions(predictions_path):
+    """
+    Stream predictions from the TSV file produced by ClickHouse.
     Each line is expected to be: sentence_id, input, predicted_class.
+    Yields (sentence_id, predicted_class) in file order; the file must be sorted by
+    sentence_id, as written by predict.py and run_local_prediction.
     """
-    preds = {}
+    previous = None
     with open(predictions_path, "r", encoding="utf-8") as fin:
         for line in fin:
             line = line.rstrip("\n")
@@ -100,89 +336,192 @@ def load_predictions(predictions_path):
                 sid = int(parts[0].strip())
             except ValueError:
                 continue
-            predicted_class = parts[2].strip()
-            preds[sid] = predicted_class
-    return preds
+            if previous is not None and sid <= previous:
+                raise ValueError(
+                    f"'{predictions_path}' is not sorted by sentence_id "
+                    f"({sid} follows {previous})."
+                )
+            previous = sid
+            yield sid, parts[2].strip()
 
 
-def compute_accuracy(data, predictions, class_mapping):
+def evaluate_predictions(records, predictions, confusion):
     """
-    Compare true language with predicted classes.
-    data is list of (sentence_id, true_lang, sentence).
-
-    The class_mapping is a dict mapping language code to numeric id.
-    We invert it to map numeric id (as a string) to language code.
-
-    Returns: overall_accuracy (float), per_class_stats dict mapping language -> (correct, total),
-             and predicted_counts dict mapping language -> predicted count.
+    Merge-join test records (sentence_id, true_lang, sentence) and predictions
+    (sentence_id, predicted_class), both sorted by sentence_id, into confusion
+    (a ConfusionMatrix). Test sentences without a prediction are counted as missing and
+    predictions of unknown sentence IDs as extra.
     """
-    # Invert mapping: numeric id (as string) -> language code.
-    inv_mapping = {str(v): k for k, v in class_mapping.items()}
-    total = 0
-    correct = 0
-    per_class_stats = defaultdict(lambda: [0, 0])  # true lang -> [correct, total]
-    predicted_counts = defaultdict(
-        int
-    )
-
-    # For each test sentence, count the total and update correct if predicted matches true label
-    for sid, true_lang, _ in data:
-        total += 1
-        per_class_stats[true_lang][1] += 1
-        if sid not in predictions:
-            print(f"Warning: sentence_id {sid} not found in predictions; skipping.")
-            exit(1)
-        predicted_id = predictions[sid]
-        predicted_lang = inv_mapping.get(predicted_id, None)
-        if predicted_lang is None:
-            print(f"Warning: predicted class '{predicted_id}' not in mapping; skipping.")
-            exit(1)
-        predicted_counts[predicted_lang] += 1
-        if predicted_lang == true_lang:
-            correct += 1
-            per_class_stats[true_lang][0] += 1
-
-    overall_accuracy = correct / total if total > 0 else 0.0
-    return overall_accuracy, per_class_stats, predicted_counts
-
-
-def write_results(
-    results_file, overall_accuracy, per_class_stats, predicted_counts, class_mapping
-):
+    predictions = iter(predictions)
+    prediction = next(predictions, None)
+    for sid, true_lang, _ in records:
+        while prediction is not None and prediction[0] < sid:
+            confusion.extra_predictions += 1
+            prediction = next(predictions, None)
+        if prediction is not None and prediction[0] == sid:
+            confusion.add(true_lang, prediction[1])
+            prediction = next(predictions, None)
+        else:
+            confusion.add(true_lang, None)
+    if prediction is not None:
+        confusion.extra_predictions += 1 + sum(1 for _ in predictions)
+
+
+def write_results(results_file, confusion):
     """
-    Write results to a text file.
+    Write the evaluation report of confusion (a ConfusionMatrix) to a text file.
     Format:
       Overall Accuracy: X%
       For each class:
          Language: <lang> (ID: <id>) - Accuracy: Y% (correct/total) - Predictions: Z
+      followed by per-class precision, recall and F1, the top confusions and the number of
+      missing and unknown predictions.
     """
     with open(results_file, "w", encoding="utf-8") as fout:
-        fout.write(f"Overall Accuracy: {overall_accuracy * 100:.2f}%\n")
-        fout.write("Per-class accuracy:\n")
-        for lang, (correct, total) in sorted(per_class_stats.items()):
-            lang_id = class_mapping.get(lang, "N/A")
-            accuracy = (correct / total * 100) if total > 0 else 0.0
-            predicted = predicted_counts.get(lang, 0)
-            fout.write(
-                f"Language: {lang} (ID: {lang_id}) - Accuracy: {accuracy:.2f}% ({correct}/{total}) - Predictions: {predicted}\n"
-            )
+        for line in confusion.report_lines():
+            fout.write(line + "\n")
     with open(results_file, "r", encoding="utf-8") as fin:
         for line in fin:
-            print(line.strip())
+            print(line.rstrip())
 
 
-def main():
-    if len(sys.argv) != 6:
-        print(
-            "Usage: python evaluate_predictions.py <test.tsv> <model_name> <class_id.json> <results_file> <directory>"
-        )
+def write_comparison_report(results_file, confusions):
+    """
+    Write the Markdown report comparing several models (a dict of model name to
+    ConfusionMatrix) to a text file and print it.
+    """
+    lines = comparison_report_lines(confusions)
+    with open(results_file, "w", encoding="utf-8") as fout:
+        for line in lines:
+            fout.write(line + "\n")
+    for line in lines:
+        print(line)
+
+
+def evaluate_models(args, model_names, class_mapping, stats):
+    """
+    Evaluate several models in one pass over the test file and write the results of every
+    model in its own subdirectory of args.directory, and the comparison report in
+    args.results_file_name.
+    """
+    confusions = {model_name: ConfusionMatrix(class_mapping) for model_name in model_names}
+    try:
+        if args.local_models:
+            predictor = LocalMultiModelPredictor(args.local_models, model_names)
+        else:
+            predictor = MultiModelClickHousePredictor(load_client_command(args.client), model_names)
+        print(f"Running streaming prediction with {len(model_names)} models...")
+        with stats.stage("predict"):
+            run_multi_model_evaluation(
+                args.test_file,
+                predictor,
+                args.chunk_size,
+                list(confusions.values()),
+                args.workers,
+                args.retries,
+                stats.skipped,
+                stats.progress("Predicting", unit="sentences"),
+            )
+    except (ClickHouseClientError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
-    test_file = sys.argv[1]
-    model_name = sys.argv[2]
-    class_id_json = sys.argv[3]
-    results_file_name = sys.argv[4]
-    directory = sys.argv[5]
+    results_file = os.path.join(args.directory, args.results_file_name)
+    with stats.stage("write"):
+        for model_name, confusion in confusions.items():
+            model_directory = os.path.join(args.directory, model_name)
+            os.makedirs(model_directory, exist_ok=True)
+            with open(
+                os.path.join(model_directory, args.results_file_name), "w", encoding="utf-8"
+            ) as fout:
+                for line in confusion.report_lines():
+                    fout.write(line + "\n")
+            confusion.write_tsv(os.path.join(model_directory, "confusion_matrix.tsv"))
+        write_comparison_report(results_file, confusions)
+
+    print("Evaluation complete.")
+    print(f"Comparison written to {results_file}")
+    models = {}
+    sentences = 0
+    for model_name, confusion in confusions.items():
+        metrics = confusion.metrics()
+        sentences = metrics["total"]
+        models[model_name] = {
+            "correct": metrics["total_correct"],
+            "accuracy": metrics["accuracy"],
+            "missing_predictions": int(confusion.missing.sum()),
+            "unknown_predictions": int(confusion.unknown.sum()),
+        }
+    stats.set(sentences=sentences, models=models)
+    stats.write(stats_file_path(results_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluates model predictions on a test dataset.")
+    parser.add_argument("test_file", help="TSV file with test data (lang, sentence).")
+    parser.add_argument(
+        "model_name",
+        help="Name of the model in the nb_models.xml file, or a comma-separated list of models "
+        "to evaluate in one pass over the test file.",
+    )
+    parser.add_argument("class_id_json", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument("results_file_name", help="Name of the results file.")
+    parser.add_argument("directory", help="Directory where the results will be saved.")
+    parser.add_argument(
+        "--local-models",
+        metavar="NB_MODELS_XML",
+        default=None,
+        help="Predict with the local reference classifier (requires NumPy) using the models "
+        "in this nb_models.xml file instead of ClickHouse.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4096,
+        help="Sentences classified at once by the local classifier (default: 4096).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of concurrent ClickHouse clients (or local prediction threads with "
+        "--stream) (default: 1).",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f"Retries of a chunk whose client failed (default: {DEFAULT_RETRIES}).",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Predict the test file in chunks piped to the client, without intermediate files.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Sentences sent to a client at once (default: {DEFAULT_CHUNK_SIZE}).",
+    )
+    parser.add_argument(
+        "--client",
+        default=None,
+        help="ClickHouse client command for --stream (default: $CLICKHOUSE_CLIENT or the "
+        "CLICKHOUSE_CLIENT of config.sh).",
+    )
+    args = parser.parse_args()
+    if args.workers < 1 or args.chunk_size < 1 or args.retries < 0:
+        parser.error("--workers and --chunk-size must be positive and --retries non-negative")
+
+    test_file = args.test_file
+    model_names = [name for name in args.model_name.split(",") if name]
+    if not model_names:
+        parser.error("no model name given")
+    model_name = model_names[0]
+    class_id_json = args.class_id_json
+    results_file_name = args.results_file_name
+    directory = args.directory
 
     os.makedirs(directory, exist_ok=True)
 
@@ -191,33 +530,85 @@ def main():
     predictions_path = os.path.join(directory, "predictions.tsv")
     results_file = os.path.join(directory, results_file_name)
 
-    # Process test data
-    data = load_test_file(test_file)
-    write_with_sentence_id(data, with_sentence_id_path)
-    write_bulk_input(data, model_name, bulk_input_path)
-
-    # Run ClickHouse prediction
-    run_clickhouse_prediction(bulk_input_path, predictions_path)
-
-    # Load predictions
-    predictions = load_predictions(predictions_path)
-
     # Load class mapping
     with open(class_id_json, "r", encoding="utf-8") as f:
         class_mapping = json.load(f)
 
-    # Compute accuracy
-    overall_accuracy, per_class_stats, predicted_counts = compute_accuracy(
-        data, predictions, class_mapping
-    )
+    stats = RunStats("evaluate_predictions")
+    if len(model_names) > 1:
+        evaluate_models(args, model_names, class_mapping, stats)
+        return
+
+    confusion = ConfusionMatrix(class_mapping)
+    if args.stream:
+        # Predict and score chunk by chunk, without intermediate files
+        try:
+            if args.local_models:
+                predictor = LocalPredictor(args.local_models)
+            else:
+                predictor = ClickHousePredictor(load_client_command(args.client))
+            print("Running streaming prediction...")
+            with stats.stage("predict"):
+                run_streaming_evaluation(
+                    test_file,
+                    model_name,
+                    predictor,
+                    args.chunk_size,
+                    confusion,
+                    args.workers,
+                    args.retries,
+                    stats.skipped,
+                    stats.progress("Predicting", unit="sentences"),
+                )
+        except (ClickHouseClientError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        # Process test data
+        with stats.stage("prepare"):
+            write_with_sentence_id(iter_test_file(test_file), with_sentence_id_path)
+            write_bulk_input(iter_test_file(test_file), model_name, bulk_input_path)
+
+        # Run ClickHouse (or local) prediction
+        with stats.stage("predict"):
+            if args.local_models:
+                run_local_prediction(
+                    bulk_input_path, predictions_path, args.local_models, args.batch_size
+                )
+            else:
+                run_clickhouse_prediction(
+                    bulk_input_path, predictions_path, args.workers, args.chunk_size, args.retries
+                )
+
+        # Join the test data and the predictions and compute the confusion matrix
+        try:
+            with stats.stage("evaluate"):
+                evaluate_predictions(
+                    iter_test_file(test_file, stats.skipped),
+                    iter_predictions(predictions_path),
+                    confusion,
+                )
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
 
     # Write results
-    write_results(
-        results_file, overall_accuracy, per_class_stats, predicted_counts, class_mapping
-    )
+    with stats.stage("write"):
+        write_results(results_file, confusion)
+        confusion.write_tsv(os.path.join(directory, "confusion_matrix.tsv"))
 
     print("Evaluation complete.")
     print(f"Results written to {results_file}")
+    metrics = confusion.metrics()
+    stats.set(
+        sentences=metrics["total"],
+        correct=metrics["total_correct"],
+        accuracy=metrics["accuracy"],
+        missing_predictions=int(confusion.missing.sum()),
+        unknown_predictions=int(confusion.unknown.sum()),
+        extra_predictions=confusion.extra_predictions,
+    )
+    stats.write(stats_file_path(results_file))
 
 
 if __name__ == "__main__":
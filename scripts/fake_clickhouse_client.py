@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Stands in for clickhouse-client in the streaming prediction of evaluate_predictions.py, so
+the prediction runner can be tested without a ClickHouse server.
+
+Accepts the arguments the runner passes to clickhouse-client (--query, --external, --file=-,
+--name, --structure; other options such as --host are ignored), reads the external table
+from stdin and prints one "<id>\\t<predicted_class>" line per row, like the query would.
+If the external table has no model column (the multi-model query of
+util.clickhouse_client.MultiModelClickHousePredictor), the models are read from the
+naiveBayesClassifier('<model>', input) columns of the query and one predicted class per
+model is printed on every line.
+
+The classes are predicted with the local reference classifier (requires NumPy) from the
+nb_models.xml file in the NB_MODELS_XML environment variable. Without it, every sentence is
+predicted as class FAKE_CLICKHOUSE_CLASS (default: 0).
+
+To test concurrency and retries, FAKE_CLICKHOUSE_DELAY adds a server latency in seconds to
+every call, and FAKE_CLICKHOUSE_FAIL_RATE makes that fraction of the calls fail with a
+network error.
+
+Usage:
+  CLICKHOUSE_CLIENT="python3 ./scripts/fake_clickhouse_client.py" NB_MODELS_XML=nb_models.xml \\
+      python3 ./scripts/evaluate_predictions.py ... --stream
+"""
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import time
+
+from util.clickhouse_client import unescape_tsv
+
+QUERY_MODEL_PATTERN = re.compile(r"naiveBayesClassifier\('((?:[^'\\]|\\.)*)', input\)")
+
+
+def read_rows(stream):
+    rows = []
+    for line in stream:
+        sentence_id, model_name, sentence = line.rstrip("\n").split("\t", 2)
+        rows.append((sentence_id, unescape_tsv(model_name), unescape_tsv(sentence)))
+    return rows
+
+
+def read_multi_model_rows(stream, model_names):
+    """
+    Reads (sentence_id, sentence) rows and returns one (sentence_id, model_name, sentence)
+    row per sentence and model, model by model.
+    """
+    sentences = []
+    for line in stream:
+        sentence_id, sentence = line.rstrip("\n").split("\t", 1)
+        sentences.append((sentence_id, unescape_tsv(sentence)))
+    return [
+        (sentence_id, model_name, sentence)
+        for model_name in model_names
+        for sentence_id, sentence in sentences
+    ]
+
+
+def query_model_names(query):
+    """
+    Returns the model names of the naiveBayesClassifier('<model>', input) columns of query.
+    """
+    return [re.sub(r"\\(.)", r"\1", name) for name in QUERY_MODEL_PATTERN.findall(query)]
+
+
+def predict_rows(rows, models_xml):
+    """
+    Returns the predicted class of every (sentence_id, model_name, sentence) row.
+    """
+    if not models_xml:
+        return [os.environ.get("FAKE_CLICKHOUSE_CLASS", "0")] * len(rows)
+
+    from util.classifier import NaiveBayesModel
+    from util.model_meta import load_model_configs
+
+    configs = load_model_configs(models_xml)
+    by_model = {}
+    for i, (_, model_name, sentence) in enumerate(rows):
+        by_model.setdefault(model_name, []).append((i, sentence))
+    predicted = [None] * len(rows)
+    for model_name, entries in by_model.items():
+        if model_name not in configs:
+            print(
+                f"Code: 36. DB::Exception: Model '{model_name}' not found. (BAD_ARGUMENTS)",
+                file=sys.stderr,
+            )
+            sys.exit(36)
+        model = NaiveBayesModel.from_config(configs[model_name])
+        classes = model.classify([sentence for _, sentence in entries])
+        for (i, _), predicted_class in zip(entries, classes):
+            predicted[i] = str(predicted_class)
+    return predicted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake clickhouse-client for testing.")
+    parser.add_argument("--query", "-q", required=True)
+    parser.add_argument("--external", action="store_true")
+    parser.add_argument("--file")
+    parser.add_argument("--name")
+    parser.add_argument("--structure")
+    args, _ = parser.parse_known_args()
+    if not args.external or args.file != "-":
+        print("Error: expected the external table on stdin (--external --file=-).", file=sys.stderr)
+        sys.exit(1)
+
+    stdin = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    multi_model = args.structure is not None and "model" not in args.structure
+    model_names = query_model_names(args.query) if multi_model else None
+    rows = read_multi_model_rows(stdin, model_names) if multi_model else read_rows(stdin)
+    time.sleep(float(os.environ.get("FAKE_CLICKHOUSE_DELAY", 0)))
+    if random.random() < float(os.environ.get("FAKE_CLICKHOUSE_FAIL_RATE", 0)):
+        print(
+            "Code: 210. DB::NetException: Connection reset by peer. (NETWORK_ERROR)",
+            file=sys.stderr,
+        )
+        sys.exit(210)
+    predicted = predict_rows(rows, os.environ.get("NB_MODELS_XML"))
+    if multi_model:
+        # predicted holds the classes of all the sentences for one model after the other.
+        num_sentences = len(rows) // max(len(model_names), 1)
+        output = "".join(
+            f"{rows[i][0]}\t" + "\t".join(predicted[i::num_sentences]) + "\n"
+            for i in range(num_sentences)
+        )
+    else:
+        output = "".join(
+            f"{sentence_id}\t{c}\n" for (sentence_id, _, _), c in zip(rows, predicted)
+        )
+    sys.stdout.buffer.write(output.encode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
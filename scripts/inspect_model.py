@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Prints statistics of a binary model file and looks up n-gram counts without loading the
+model into Python dictionaries (requires NumPy).
+
+Usage:
+  python inspect_model.py <model.bin> [--class-mapping class_id.json] [--ngram NGRAM ...]
+
+N-grams are given as text and encoded as UTF-8; use --escapes to pass the padding bytes of
+byte models with backslash escapes (for example '\\x01\\x01T').
+"""
+
+import argparse
+import codecs
+import time
+
+from util.helpers import load_language_mapping
+from util.model_reader import ModelReader
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a binary n-gram model file.")
+    parser.add_argument("model_file", help="Binary model file.")
+    parser.add_argument(
+        "--class-mapping",
+        default=None,
+        help="JSON file mapping language codes to class IDs, used to label the classes.",
+    )
+    parser.add_argument(
+        "--ngram", action="append", default=[], help="N-gram to look up (can be repeated)."
+    )
+    parser.add_argument(
+        "--escapes", action="store_true", help="Interpret backslash escapes in --ngram values."
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    reader = ModelReader(args.model_file)
+    elapsed = time.perf_counter() - start
+
+    labels = {}
+    if args.class_mapping:
+        labels = {v: k for k, v in load_language_mapping(args.class_mapping).items()}
+
+    stats = reader.stats()
+    print(f"Model: {args.model_file} (indexed in {elapsed:.2f}s)")
+    print(f"Tuples: {stats['tuples']}")
+    print(f"Distinct n-grams: {stats['distinct_ngrams']}")
+    print("Per class:")
+    for class_id, (tuples, total) in enumerate(
+        zip(stats["tuples_per_class"], stats["total_counts_per_class"])
+    ):
+        label = labels.get(class_id, "")
+        print(f"  Class {class_id} {label}: {tuples} tuples, total count {total}")
+
+    for ngram in args.ngram:
+        key = codecs.escape_decode(ngram.encode("utf-8"))[0] if args.escapes else ngram
+        print(f"N-gram {ngram!r}: {reader.counts_per_class(key).tolist()}")
+
+
+if __name__ == "__main__":
+    main()
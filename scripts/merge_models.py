@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Merges binary models built on partitions of the training data (for example on several
+machines) into one model, summing the counts of equal (class_id, ngram) tuples.
+
+The shards are combined with a k-way merge of tuples sorted by class_id and then n-gram, so
+memory is bounded by the merge fan-in and not by the vocabulary size. Shards built with
+--sort or --max-memory are already sorted and are streamed directly; other shards are first
+sorted into runs on disk within --max-memory. The output model is sorted.
+
+The .meta.json files written next to the shards by the builders are used to check that all
+shards have the same mode, n and class mapping, and their per-class example counts are summed
+into the metadata of the merged model and the priors of --nb-models-xml.
+
+Usage:
+  python merge_models.py <output_model.bin> <shard.bin> [<shard.bin> ...]
+      [--class-mapping class_id.json] [--max-memory SIZE] [--tmp-dir DIR]
+      [--nb-models-xml FILE] [--model-name NAME]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+
+from util.counting import (
+    MERGE_BLOCK_SIZE,
+    ExternalCounts,
+    merge_runs,
+    merge_sorted_tuples,
+)
+from util.helpers import RunStats, load_language_mapping, parse_size, stats_file_path
+from util.model_io import iter_model_tuples, write_model_tuples
+from util.model_meta import (
+    load_model_meta,
+    meta_file_path,
+    model_entry,
+    write_model_meta,
+    write_nb_models_xml,
+)
+
+DEFAULT_MAX_MEMORY = "256M"
+
+
+def load_shard_metas(shard_files):
+    """
+    Returns the metadata of every shard, None for shards without a .meta.json file.
+    """
+    metas = {}
+    for shard_file in shard_files:
+        try:
+            metas[shard_file] = load_model_meta(shard_file)
+        except FileNotFoundError:
+            metas[shard_file] = None
+    return metas
+
+
+def check_shard_metas(metas, lang_mapping=None):
+    """
+    Checks that all shards with metadata have the same mode, n and class mapping (and the
+    same class mapping as lang_mapping if given).
+
+    Returns:
+      tuple: (mode, n, lang_mapping) of the shards; mode and n are None without metadata.
+
+    Raises:
+      ValueError: If two shards, or a shard and lang_mapping, disagree.
+    """
+    mode = n = None
+    reference = None
+    mapping_source = "the class mapping file"
+    for shard_file, meta in metas.items():
+        if meta is None:
+            continue
+        if mode is None:
+            mode, n = meta["mode"], meta["n"]
+            reference = shard_file
+            if lang_mapping is None:
+                lang_mapping = meta["lang_mapping"]
+                mapping_source = f"'{shard_file}'"
+        if (meta["mode"], meta["n"]) != (mode, n):
+            raise ValueError(
+                f"'{shard_file}' is a {meta['mode']} model with n={meta['n']}, but "
+                f"'{reference}' is a {mode} model with n={n}."
+            )
+        if meta["lang_mapping"] != lang_mapping:
+            raise ValueError(
+                f"'{shard_file}' was built with a different class mapping than {mapping_source}."
+            )
+    return mode, n, lang_mapping
+
+
+def scan_model_file(model_file):
+    """
+    Reads a binary model file once.
+
+    Returns:
+      tuple: (whether the tuples are sorted by class_id and then n-gram without repeated
+      keys, set of the class ids in the file).
+    """
+    is_sorted = True
+    class_ids = set()
+    previous = None
+    for class_id, ngram, _ in iter_model_tuples(model_file):
+        key = (class_id, ngram)
+        if previous is not None and key <= previous:
+            is_sorted = False
+        previous = key
+        class_ids.add(class_id)
+    return is_sorted, class_ids
+
+
+def merge_model_files(shard_files, output_file, max_memory, tmp_dir=None, class_ids=None):
+    """
+    Merges binary model files into one sorted model file.
+
+    Parameters:
+      shard_files (list): Paths to the binary model files.
+      output_file (str): Path to the merged model file.
+      max_memory (int): Memory budget in bytes for sorting unsorted shards.
+      tmp_dir (str): Directory for the sorted runs (default: system temp directory).
+      class_ids (set): If given, every class id of the shards must be in it.
+
+    Returns:
+      int: Number of tuples written.
+    """
+    run_dir = tempfile.TemporaryDirectory(prefix="ngram_merge_", dir=tmp_dir)
+    try:
+        sorted_shards = []
+        spilled_counts = ExternalCounts(run_dir, [], text=False)
+        for shard_file in shard_files:
+            is_sorted, shard_class_ids = scan_model_file(shard_file)
+            unknown = shard_class_ids - class_ids if class_ids is not None else set()
+            if unknown:
+                raise ValueError(
+                    f"'{shard_file}' has class IDs {sorted(unknown)}, which are not in the "
+                    "class mapping."
+                )
+            if is_sorted:
+                print(f"Shard '{shard_file}': sorted, merged directly.")
+                sorted_shards.append(shard_file)
+            else:
+                print(f"Shard '{shard_file}': unsorted, sorting into runs.")
+                spilled_counts.add_model_file(shard_file, max_memory)
+
+        run_files = merge_runs(
+            sorted_shards + spilled_counts.run_files, run_dir.name, keep=set(sorted_shards)
+        )
+        streams = [iter_model_tuples(f, MERGE_BLOCK_SIZE) for f in run_files]
+        return write_model_tuples(output_file, merge_sorted_tuples(streams))
+    finally:
+        run_dir.cleanup()
+
+
+def write_merged_meta(args, metas, mode, n, lang_mapping):
+    """
+    Writes the metadata file of the merged model, with the summed per-class example counts
+    of the shards, and with --nb-models-xml its nb_models.xml.
+    """
+    class_counts = collections.Counter()
+    pruned = []
+    for meta in metas.values():
+        class_counts.update(meta["class_examples"])
+        if meta["pruning"] != "no pruning":
+            pruned.append(meta["pruning"])
+    pruning = f"merged from pruned shards ({'; '.join(pruned)})" if pruned else "no pruning"
+    write_model_meta(args.output_file, mode, n, lang_mapping, class_counts, pruning)
+    if args.nb_models_xml:
+        entry = model_entry(args.output_file, mode, n, class_counts, args.model_name)
+        write_nb_models_xml(args.nb_models_xml, [entry])
+        print(f"Written nb_models.xml with the class priors to '{args.nb_models_xml}'.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merges binary models built on partitions of the training data."
+    )
+    parser.add_argument("output_file", help="Output file for the merged model.")
+    parser.add_argument("shard_files", nargs="+", help="Binary model files to merge.")
+    parser.add_argument(
+        "--class-mapping",
+        default=None,
+        help="JSON file mapping language codes to class IDs (class_id.json) that all shards "
+        "must have been built with.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=parse_size(DEFAULT_MAX_MEMORY),
+        help=f"Memory budget for sorting unsorted shards (default: {DEFAULT_MAX_MEMORY}).",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="Directory for the sorted runs (default: system temp directory).",
+    )
+    parser.add_argument(
+        "--nb-models-xml",
+        default=None,
+        help="Also write an nb_models.xml file for the merged model (needs the .meta.json "
+        "files of all shards).",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="Model name in --nb-models-xml (default: output file name without extension).",
+    )
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output_file)
+    if any(os.path.abspath(f) == output_path for f in args.shard_files):
+        parser.error("the output file must not be one of the shards")
+
+    lang_mapping = None
+    if args.class_mapping:
+        lang_mapping = load_language_mapping(args.class_mapping)
+    metas = load_shard_metas(args.shard_files)
+    try:
+        mode, n, lang_mapping = check_shard_metas(metas, lang_mapping)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    missing = [f for f, meta in metas.items() if meta is None]
+    if missing and args.nb_models_xml:
+        parser.error(f"--nb-models-xml needs the metadata file '{meta_file_path(missing[0])}'")
+
+    class_ids = set(lang_mapping.values()) if lang_mapping is not None else None
+    stats = RunStats("merge_models")
+    try:
+        with stats.stage("merge"):
+            total = merge_model_files(
+                args.shard_files, args.output_file, args.max_memory, args.tmp_dir, class_ids
+            )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(
+        f"Merge complete. Written binary model to '{args.output_file}'. Total tuples: {total}"
+    )
+
+    if missing:
+        print(
+            f"Warning: {len(missing)} shard(s) have no metadata file; "
+            "no metadata or priors are written for the merged model."
+        )
+    else:
+        with stats.stage("metadata"):
+            write_merged_meta(args, metas, mode, n, lang_mapping)
+    stats.set(
+        shards=len(args.shard_files),
+        shard_bytes=sum(os.path.getsize(f) for f in args.shard_files),
+        tuples=total,
+        model_bytes=os.path.getsize(args.output_file),
+    )
+    stats.write(stats_file_path(args.output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+"""
+Packages models for distribution to the ClickHouse servers as one compressed, content-hashed
+artifact, and verifies or unpacks such an artifact on the servers.
+
+pack reads the models listed in nb_models.xml files (or in all nb_models.xml files below a
+directory such as models/), rewrites every model canonically sorted by class_id and then
+n-gram, with the counts of repeated keys summed, and bundles the models with one generated
+nb_models.xml into a tar archive compressed with zstd (or xz where the zstandard package is
+not installed). The first member of the archive is manifest.json with the size and SHA-256
+of every file. The archive is byte-for-byte deterministic: two packagings of models with the
+same tuples give the same artifact, whatever order the builders wrote the tuples in, so the
+artifacts compress, deduplicate and rsync well. The artifact is named after the hash of its
+contents, <name>-<hash>.tar.zst, and a <artifact>.sha256 file with the hash of the artifact
+itself is written next to it.
+
+verify streams the artifact through the decompressor and checks every file against the
+manifest (and the artifact against its .sha256 file, if present). unpack does the same while
+writing every file to a temporary file in the target directory; only when all files are
+complete and verified are they renamed into place, nb_models.xml last, so the servers never
+see a partially written model.
+
+Usage:
+  python package_models.py pack <output_dir> <nb_models.xml|models_dir> [...]
+      [--name NAME] [--install-dir DIR] [--compression {zstd,xz}] [--level N]
+      [--max-memory SIZE] [--tmp-dir DIR]
+  python package_models.py verify <artifact>
+  python package_models.py unpack <artifact> [<target_dir>]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import lzma
+import os
+import sys
+import tarfile
+import tempfile
+
+from merge_models import DEFAULT_MAX_MEMORY, merge_model_files
+from util.helpers import RunStats, parse_size
+from util.model_meta import DEFAULT_MODEL_DIR, load_model_configs, write_nb_models_xml
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_FILE = "manifest.json"
+NB_MODELS_XML = "nb_models.xml"
+MANIFEST_FORMAT = 1
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+EXTENSIONS = {"zstd": ".tar.zst", "xz": ".tar.xz"}
+DEFAULT_LEVELS = {"zstd": 19, "xz": 6}
+COPY_BLOCK_SIZE = 1 << 20
+# Mode of the artifacts and of the installed files, which the server must be able to read.
+FILE_MODE = 0o644
+# Errors of a truncated or corrupt archive.
+CORRUPT_ERRORS = (tarfile.TarError, lzma.LZMAError, EOFError, KeyError, TypeError)
+if zstandard is not None:
+    CORRUPT_ERRORS += (zstandard.ZstdError,)
+
+
+def file_sha256(path):
+    """
+    Returns the hex SHA-256 of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_model_xmls(paths):
+    """
+    Returns the nb_models.xml files given directly or found below the given directories,
+    in sorted order within every directory.
+    """
+    xml_files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            xml_files.append(path)
+            continue
+        found = []
+        for root, _, files in os.walk(path):
+            if NB_MODELS_XML in files:
+                found.append(os.path.join(root, NB_MODELS_XML))
+        xml_files.extend(sorted(found))
+    return xml_files
+
+
+def collect_models(xml_files):
+    """
+    Reads the model entries of nb_models.xml files.
+
+    Returns:
+      list: The model configs (see util.model_meta.load_model_configs), sorted by name.
+
+    Raises:
+      ValueError: If two entries have the same name or model file name, or a model file
+        does not exist.
+    """
+    models = {}
+    files = {}
+    for xml_file in xml_files:
+        for name, config in load_model_configs(xml_file).items():
+            basename = os.path.basename(config["path"])
+            if name in models:
+                raise ValueError(f"Model '{name}' is configured more than once.")
+            if basename in files or basename in (MANIFEST_FILE, NB_MODELS_XML):
+                raise ValueError(
+                    f"Model file name '{basename}' of model '{name}' is used more than once."
+                )
+            if not os.path.isfile(config["path"]):
+                raise ValueError(
+                    f"Model file '{config['path']}' of model '{name}' in '{xml_file}' not found."
+                )
+            models[name] = config
+            files[basename] = name
+    return [models[name] for name in sorted(models)]
+
+
+def _tar_info(name, size):
+    # Fixed metadata, so the archive only depends on the names and contents of its files.
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 0
+    info.mode = FILE_MODE
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def _open_compressor(f, compression, level):
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=level, write_checksum=True).stream_writer(f)
+    return lzma.LZMAFile(f, "w", format=lzma.FORMAT_XZ, preset=level)
+
+
+def pack_models(
+    xml_files,
+    output_dir,
+    name="nb_models",
+    install_dir=DEFAULT_MODEL_DIR,
+    compression="zstd",
+    level=None,
+    max_memory=parse_size(DEFAULT_MAX_MEMORY),
+    tmp_dir=None,
+    stats=None,
+):
+    """
+    Packages the models of nb_models.xml files into a content-hashed artifact in output_dir.
+
+    Parameters:
+      xml_files (list): nb_models.xml files listing the models.
+      output_dir (str): Directory the artifact is written to.
+      name (str): Name prefix of the artifact.
+      install_dir (str): Directory the models are installed to, used for the model paths
+        of the generated nb_models.xml.
+      compression (str): zstd or xz.
+      level (int): Compression level (default: 19 for zstd, 6 for xz).
+      max_memory (int): Memory budget in bytes for sorting unsorted models.
+      tmp_dir (str): Directory for the canonical model files and sorted runs.
+      stats (RunStats): Optional stats that get the stage times.
+
+    Returns:
+      tuple: (path of the artifact, manifest dict).
+    """
+    stats = stats or RunStats("package_models")
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    models = collect_models(xml_files)
+    if not models:
+        raise ValueError("No models to package.")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="package_", dir=tmp_dir) as staging:
+        entries = []
+        manifest_models = []
+        with stats.stage("sort"):
+            for config in models:
+                basename = os.path.basename(config["path"])
+                print(f"Model '{config['name']}': {config['path']}")
+                tuples = merge_model_files(
+                    [config["path"]], os.path.join(staging, basename), max_memory, tmp_dir
+                )
+                entries.append({**config, "path": f"{install_dir}/{basename}"})
+                manifest_models.append(
+                    {
+                        "name": config["name"],
+                        "mode": config["mode"],
+                        "n": config["n"],
+                        "file": basename,
+                        "tuples": tuples,
+                    }
+                )
+        write_nb_models_xml(os.path.join(staging, NB_MODELS_XML), entries)
+
+        with stats.stage("hash"):
+            # Models in name order, then the configuration that refers to them.
+            names = [model["file"] for model in manifest_models] + [NB_MODELS_XML]
+            files = [
+                {
+                    "name": file_name,
+                    "size": os.path.getsize(os.path.join(staging, file_name)),
+                    "sha256": file_sha256(os.path.join(staging, file_name)),
+                }
+                for file_name in names
+            ]
+        content = json.dumps(files, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        content_hash = hashlib.sha256(content).hexdigest()
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "content_hash": content_hash,
+            "install_dir": install_dir,
+            "models": manifest_models,
+            "files": files,
+        }
+        manifest_data = (json.dumps(manifest, indent=2, sort_keys=True) + "\n").encode("utf-8")
+
+        artifact = os.path.join(output_dir, f"{name}-{content_hash[:16]}{EXTENSIONS[compression]}")
+        fd, partial = tempfile.mkstemp(prefix=".package_", dir=output_dir)
+        try:
+            with stats.stage("compress"):
+                with os.fdopen(fd, "wb") as f, _open_compressor(f, compression, level) as out:
+                    with tarfile.open(fileobj=out, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                        info = _tar_info(MANIFEST_FILE, len(manifest_data))
+                        tar.addfile(info, io.BytesIO(manifest_data))
+                        for entry in files:
+                            with open(os.path.join(staging, entry["name"]), "rb") as model:
+                                tar.addfile(_tar_info(entry["name"], entry["size"]), model)
+            os.chmod(partial, FILE_MODE)
+            os.replace(partial, artifact)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    with open(artifact + ".sha256", "w", encoding="utf-8") as f:
+        f.write(f"{file_sha256(artifact)}  {os.path.basename(artifact)}\n")
+    return artifact, manifest
+
+
+class _HashingReader:
+    """
+    Reads a binary file and computes the SHA-256 of the bytes read.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def _open_decompressor(raw):
+    magic = raw.peek(len(XZ_MAGIC))[: len(XZ_MAGIC)]
+    reader = _HashingReader(raw)
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("The artifact is zstd compressed; install the zstandard package.")
+        return reader, zstandard.ZstdDecompressor().stream_reader(reader)
+    if magic.startswith(XZ_MAGIC):
+        return reader, lzma.LZMAFile(reader)
+    raise ValueError("The artifact is neither zstd nor xz compressed.")
+
+
+def _copy_member(f, out):
+    """
+    Copies a file of the archive to out (if not None), returning its size and SHA-256.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+        digest.update(block)
+        size += len(block)
+        if out is not None:
+            out.write(block)
+    return size, digest.hexdigest()
+
+
+def _manifest_files(manifest):
+    """
+    Returns the file entries of a manifest by name, checking that every name is a plain file
+    name that occurs once, so no file can be extracted outside the target directory.
+    """
+    files = {}
+    for entry in manifest["files"]:
+        name = entry["name"]
+        if (
+            not isinstance(name, str)
+            or os.path.basename(name) != name
+            or name in ("", ".", "..", MANIFEST_FILE)
+        ):
+            raise ValueError(f"Invalid file name {name!r} in the manifest.")
+        if name in files:
+            raise ValueError(f"File '{name}' is listed more than once in the manifest.")
+        files[name] = entry
+    return files
+
+
+def _read_members(artifact, target_dir, partial_files):
+    manifest = None
+    files = {}
+    with open(artifact, "rb") as raw:
+        reader, stream = _open_decompressor(raw)
+        with stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    raise ValueError(f"Unexpected entry '{member.name}' in the artifact.")
+                f = tar.extractfile(member)
+                if manifest is None:
+                    if member.name != MANIFEST_FILE:
+                        raise ValueError(f"The artifact does not start with {MANIFEST_FILE}.")
+                    manifest = json.loads(f.read().decode("utf-8"))
+                    if manifest.get("format") != MANIFEST_FORMAT:
+                        raise ValueError(f"Unsupported manifest format {manifest.get('format')}.")
+                    files = _manifest_files(manifest)
+                    continue
+                entry = files.get(member.name)
+                if entry is None or member.name in partial_files:
+                    raise ValueError(f"Unexpected file '{member.name}' in the artifact.")
+                if target_dir is None:
+                    partial_files[member.name] = None
+                    size, sha256 = _copy_member(f, None)
+                else:
+                    fd, partial_files[member.name] = tempfile.mkstemp(
+                        prefix=f".{member.name}.", dir=target_dir
+                    )
+                    os.fchmod(fd, FILE_MODE)
+                    with os.fdopen(fd, "wb") as out:
+                        size, sha256 = _copy_member(f, out)
+                if size != entry["size"] or sha256 != entry["sha256"]:
+                    raise ValueError(f"File '{member.name}' does not match the manifest.")
+                print(f"  {member.name}: {size} bytes, OK")
+        # Read to the end, so the hash covers the whole artifact.
+        for _ in iter(lambda: reader.read(COPY_BLOCK_SIZE), b""):
+            pass
+    if manifest is None:
+        raise ValueError("The artifact is empty.")
+    missing = [name for name in files if name not in partial_files]
+    if missing:
+        raise ValueError(f"Files missing from the artifact: {', '.join(missing)}.")
+    content = json.dumps(manifest["files"], sort_keys=True, separators=(",", ":"))
+    if hashlib.sha256(content.encode("utf-8")).hexdigest() != manifest["content_hash"]:
+        raise ValueError("The content hash does not match the manifest.")
+    checksum_file = artifact + ".sha256"
+    if os.path.exists(checksum_file):
+        with open(checksum_file, "r", encoding="utf-8") as f:
+            expected = f.read().split()[0]
+        if reader.digest.hexdigest() != expected:
+            raise ValueError(f"The artifact does not match '{checksum_file}'.")
+    else:
+        print(f"Note: no '{checksum_file}'; only the contents were verified.")
+    return manifest
+
+
+def read_manifest(artifact):
+    """
+    Returns the manifest of an artifact, decompressing only its first member.
+    """
+    try:
+        with open(artifact, "rb") as raw:
+            _, stream = _open_decompressor(raw)
+            with stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+                member = tar.next()
+                if member is None or member.name != MANIFEST_FILE:
+                    raise ValueError(f"The artifact does not start with {MANIFEST_FILE}.")
+                return json.loads(tar.extractfile(member).read().decode("utf-8"))
+    except CORRUPT_ERRORS as e:
+        raise ValueError(f"Corrupt artifact: {e}")
+
+
+def read_artifact(artifact, target_dir=None):
+    """
+    Streams an artifact through the decompressor and checks every file against its manifest.
+    With target_dir, every file is written to a temporary file in target_dir while it is
+    read; the temporary files are only renamed to their names (nb_models.xml last) once
+    all files are verified.
+
+    Returns:
+      dict: The manifest.
+
+    Raises:
+      ValueError: If the artifact is corrupt or does not match its manifest or .sha256 file.
+    """
+    partial_files = {}
+    try:
+        try:
+            manifest = _read_members(artifact, target_dir, partial_files)
+        except CORRUPT_ERRORS as e:
+            raise ValueError(f"Corrupt artifact: {e}")
+    except BaseException:
+        if target_dir is not None:
+            for partial in partial_files.values():
+                os.remove(partial)
+        raise
+    if target_dir is not None:
+        # The configuration is last, so it never refers to a model that is not in place.
+        for entry in manifest["files"]:
+            os.replace(partial_files[entry["name"]], os.path.join(target_dir, entry["name"]))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Packages models into a compressed, content-hashed artifact, and verifies "
+        "or unpacks it."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack = commands.add_parser("pack", help="Package models into an artifact.")
+    pack.add_argument("output_dir", help="Directory the artifact is written to.")
+    pack.add_argument(
+        "inputs",
+        nargs="+",
+        help="nb_models.xml files, or directories searched for nb_models.xml files.",
+    )
+    pack.add_argument(
+        "--name", default="nb_models", help="Name prefix of the artifact (default: nb_models)."
+    )
+    pack.add_argument(
+        "--install-dir",
+        default=DEFAULT_MODEL_DIR,
+        help=f"Directory the models are installed to on the servers, used for the model paths "
+        f"of the packaged nb_models.xml (default: {DEFAULT_MODEL_DIR}).",
+    )
+    pack.add_argument(
+        "--compression",
+        choices=["zstd", "xz"],
+        default="zstd" if zstandard is not None else "xz",
+        help="Compression of the artifact (default: zstd, or xz if the zstandard package is "
+        "not installed).",
+    )
+    pack.add_argument(
+        "--level",
+        type=int,
+        default=None,
+        help="Compression level (default: 19 for zstd, 6 for xz).",
+    )
+    pack.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=parse_size(DEFAULT_MAX_MEMORY),
+        help=f"Memory budget for sorting unsorted models (default: {DEFAULT_MAX_MEMORY}).",
+    )
+    pack.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="Directory for the sorted model files (default: system temp directory).",
+    )
+
+    verify = commands.add_parser("verify", help="Check an artifact against its manifest.")
+    verify.add_argument("artifact", help="Artifact written by pack.")
+
+    unpack = commands.add_parser("unpack", help="Verify an artifact and install its files.")
+    unpack.add_argument("artifact", help="Artifact written by pack.")
+    unpack.add_argument(
+        "target_dir",
+        nargs="?",
+        default=None,
+        help="Directory the files are installed to (default: the install directory of the "
+        "artifact).",
+    )
+    args = parser.parse_args()
+
+    stats = RunStats(f"package_models {args.command}")
+    try:
+        if args.command == "pack":
+            if args.compression == "zstd" and zstandard is None:
+                parser.error("--compression zstd requires the zstandard package")
+            artifact, manifest = pack_models(
+                find_model_xmls(args.inputs),
+                args.output_dir,
+                args.name,
+                args.install_dir,
+                args.compression,
+                args.level,
+                args.max_memory,
+                args.tmp_dir,
+                stats,
+            )
+            size = sum(entry["size"] for entry in manifest["files"])
+            compressed = os.path.getsize(artifact)
+            print(
+                f"Packaged {len(manifest['models'])} models ({size / 1e6:.2f} MB) into "
+                f"'{artifact}' ({compressed / 1e6:.2f} MB, {compressed / max(size, 1):.1%})."
+            )
+        elif args.command == "verify":
+            with stats.stage("verify"):
+                manifest = read_artifact(args.artifact)
+            print(f"Artifact '{args.artifact}' is valid ({len(manifest['files'])} files).")
+        else:
+            target_dir = args.target_dir
+            if target_dir is None:
+                with stats.stage("verify"):
+                    target_dir = read_manifest(args.artifact)["install_dir"]
+            os.makedirs(target_dir, exist_ok=True)
+            with stats.stage("unpack"):
+                manifest = read_artifact(args.artifact, target_dir)
+            print(f"Installed {len(manifest['files'])} files to '{target_dir}'.")
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    stats.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Predicts the class of every sentence of a bulk input file with ClickHouse, using a pool of
+concurrent clickhouse-client processes.
+
+The input file has the columns sentence_id, model_name, sentence (bulk_input.tsv of
+evaluate_predictions.py). It is split into chunks that are sent to --workers clients at once
+as external tables (see util/clickhouse_client.py), so no table is created on the server and
+any number of predictions can run at the same time. Failed chunks are retried, and the
+predictions are written in input order with the columns sentence_id, input, predicted_class,
+like predict.sh did. The stats of the run are written next to the prediction file
+(<predictions>.stats.json).
+
+Usage:
+  python predict.py <input_file> <prediction_file> [--workers N] [--chunk-size N]
+      [--retries N] [--client CMD]
+"""
+
+import argparse
+import itertools
+import os
+import sys
+
+from util.clickhouse_client import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_RETRIES,
+    ClickHouseClientError,
+    ClickHousePredictor,
+    load_client_command,
+    predict_chunks,
+)
+from util.helpers import RunStats, stats_file_path
+
+
+def iter_input_chunks(input_file, chunk_size):
+    """
+    Reads the bulk input file in chunks of (sentence_id, model_name, sentence) rows.
+
+    Yields:
+      tuple: (rows, rows) pairs for predict_chunks.
+    """
+    with open(input_file, "r", encoding="utf-8") as fin:
+        rows = (line.rstrip("\n").split("\t", 2) for line in fin)
+        while True:
+            chunk = [
+                (int(sentence_id), model_name, sentence)
+                for sentence_id, model_name, sentence in itertools.islice(rows, chunk_size)
+            ]
+            if not chunk:
+                return
+            yield chunk, chunk
+
+
+def predict_file(
+    input_file,
+    prediction_file,
+    predictor,
+    workers=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    retries=DEFAULT_RETRIES,
+    progress=None,
+):
+    """
+    Predicts every row of input_file and writes the predictions to prediction_file,
+    advancing progress (a util.helpers.Progress) after every chunk if given. Rows the client
+    returned no prediction for are left out of prediction_file, so evaluate_predictions.py
+    counts them as missing.
+
+    Returns:
+      int: Number of sentences predicted.
+    """
+    num_sentences = 0
+    with open(prediction_file, "w", encoding="utf-8", newline="\n") as fout:
+        chunks = iter_input_chunks(input_file, chunk_size)
+        for rows, predictions in predict_chunks(predictor, chunks, workers, retries):
+            for sentence_id, _, sentence in rows:
+                if sentence_id in predictions:
+                    fout.write(f"{sentence_id}\t{sentence}\t{predictions[sentence_id]}\n")
+            num_sentences += len(rows)
+            if progress is not None:
+                progress.update(num_sentences)
+    return num_sentences
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Predicts a bulk input file with concurrent ClickHouse clients."
+    )
+    parser.add_argument(
+        "input_file", help="TSV file with the columns sentence_id, model_name, sentence."
+    )
+    parser.add_argument("prediction_file", help="Output TSV file with the predictions.")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of concurrent clients (default: 1)."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Sentences sent to a client at once (default: {DEFAULT_CHUNK_SIZE}).",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f"Retries of a failed chunk (default: {DEFAULT_RETRIES}).",
+    )
+    parser.add_argument(
+        "--client",
+        default=None,
+        help="ClickHouse client command (default: $CLICKHOUSE_CLIENT or the CLICKHOUSE_CLIENT "
+        "of config.sh).",
+    )
+    args = parser.parse_args()
+    if args.workers < 1 or args.chunk_size < 1 or args.retries < 0:
+        parser.error("--workers and --chunk-size must be positive and --retries non-negative")
+
+    stats = RunStats("predict")
+    try:
+        predictor = ClickHousePredictor(load_client_command(args.client))
+        print(f"Using ClickHouse client: {' '.join(predictor.client_command)}")
+        with stats.stage("predict"):
+            total = predict_file(
+                args.input_file,
+                args.prediction_file,
+                predictor,
+                args.workers,
+                args.chunk_size,
+                args.retries,
+                stats.progress("Predicting", unit="sentences"),
+            )
+    except ClickHouseClientError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(
+        f"Predicted {total} sentences with {args.workers} client(s) in "
+        f"{stats.stages['predict']:.1f}s."
+    )
+    stats.set(
+        sentences=total,
+        workers=args.workers,
+        input_bytes=os.path.getsize(args.input_file),
+    )
+    stats.write(stats_file_path(args.prediction_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Language detection over HTTP, outside ClickHouse (requires NumPy).
+
+Loads the models of an nb_models.xml file (their .bin files, mode, n, alpha and priors, see
+util/model_meta.py) with the local reference classifier at startup and serves them with an
+asyncio HTTP/1.1 server from the standard library:
+
+  POST /classify  {"text": "...", "model": "lang_byte_3"}  ->  {"model": ..., "class": 4}
+                  {"texts": ["...", ...]}  ->  {"model": ..., "predictions": [{"class": 4}, ...]}
+                  "model" defaults to the first loaded model. With --class-mapping, every
+                  prediction also has the "language" code of its class.
+  GET  /stats     Request count, throughput, p50/p99/max latency, batching and cache counters.
+  GET  /health    {"status": "ok", "models": [...]}
+
+Concurrent texts of a model are micro-batched: a batch waits at most --batch-window
+milliseconds for other requests and is classified by one vectorized classify call of at most
+--max-batch-size texts, in a worker thread so the event loop keeps accepting requests (see
+util/serving.py). The classes of the --cache-size most recently used (model, text) pairs are
+kept in an LRU cache, keyed by a digest of the pair rather than the text itself, and returned
+without classification.
+
+Usage:
+  python serve_models.py <nb_models.xml> [--model NAME ...] [--host HOST] [--port PORT]
+      [--class-mapping lang_mapping.json] [--max-batch-size N] [--batch-window MS]
+      [--cache-size N] [--latency-window N] [--max-body-bytes N]
+"""
+
+import argparse
+import asyncio
+import http
+import json
+import sys
+import time
+
+from util.classifier import NaiveBayesModel
+from util.model_meta import load_model_configs
+from util.serving import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_LATENCY_WINDOW,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_MAX_DELAY,
+    LatencyStats,
+    LRUCache,
+    MicroBatcher,
+    cache_key,
+)
+
+DEFAULT_MAX_BODY_BYTES = 1 << 20
+
+
+class HTTPError(Exception):
+    """
+    Raised to answer a request with an error status and message.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+async def read_line(reader):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # The line is longer than the limit of the stream reader.
+        raise HTTPError(431, "The request line or a header is too long.")
+
+
+async def read_request(reader, max_body_bytes):
+    """
+    Reads one HTTP request from reader.
+
+    Returns:
+      tuple: (method, path, body, keep_alive), or None if the connection was closed before
+      a request.
+
+    Raises:
+      HTTPError: If the request is malformed or its body is larger than max_body_bytes.
+    """
+    line = await read_line(reader)
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line.")
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length.")
+    if length > max_body_bytes:
+        raise HTTPError(413, f"The request body exceeds {max_body_bytes} bytes.")
+    body = await reader.readexactly(length) if length > 0 else b""
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        keep_alive = connection != "close"
+    else:
+        keep_alive = connection == "keep-alive"
+    return method, target.split("?", 1)[0], body, keep_alive
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = [
+        f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+        "Content-Type: application/json; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+
+
+class ClassificationService:
+    """
+    Classifies texts with loaded models through micro-batchers and an LRU cache, and keeps
+    the request statistics.
+
+    Parameters:
+      models (dict): Mapping of model name to NaiveBayesModel; the first is the default.
+      class_names (dict): Mapping of class ID to language code for the responses, or None.
+    """
+
+    def __init__(
+        self,
+        models,
+        class_names=None,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_delay=DEFAULT_MAX_DELAY,
+        cache_size=DEFAULT_CACHE_SIZE,
+        latency_window=DEFAULT_LATENCY_WINDOW,
+        max_body_bytes=DEFAULT_MAX_BODY_BYTES,
+    ):
+        self.models = models
+        self.default_model = next(iter(models))
+        self.class_names = class_names
+        self.batchers = {
+            name: MicroBatcher(model.classify, max_batch_size, max_delay)
+            for name, model in models.items()
+        }
+        self.cache = LRUCache(cache_size)
+        self.latency = LatencyStats(latency_window)
+        self.max_body_bytes = max_body_bytes
+        self.texts = 0
+
+    def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    async def stop(self):
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def classify_text(self, model_name, text):
+        key = cache_key(model_name, text)
+        predicted_class = self.cache.get(key)
+        if predicted_class is None:
+            predicted_class = await self.batchers[model_name].submit(text)
+            self.cache.put(key, predicted_class)
+        return predicted_class
+
+    def prediction(self, predicted_class):
+        result = {"class": predicted_class}
+        if self.class_names is not None:
+            result["language"] = self.class_names.get(predicted_class)
+        return result
+
+    async def classify(self, body):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise HTTPError(400, "The request body is not valid JSON.")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "The request body must be a JSON object.")
+        model_name = request.get("model", self.default_model)
+        if model_name not in self.batchers:
+            raise HTTPError(404, f"Model '{model_name}' is not loaded.")
+        single = "text" in request
+        texts = [request["text"]] if single else request.get("texts")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise HTTPError(400, 'Expected a "text" string or a "texts" list of strings.')
+        # Lone surrogates are valid JSON escapes, but the models cannot encode them.
+        for text in texts:
+            try:
+                text.encode("utf-8")
+            except UnicodeEncodeError:
+                raise HTTPError(400, "The texts must not contain lone surrogates.")
+
+        classes = await asyncio.gather(*(self.classify_text(model_name, text) for text in texts))
+        self.texts += len(texts)
+        if single:
+            return {"model": model_name, **self.prediction(classes[0])}
+        return {"model": model_name, "predictions": [self.prediction(c) for c in classes]}
+
+    def stats(self):
+        return {
+            **self.latency.as_dict(),
+            "texts": self.texts,
+            "cache": self.cache.as_dict(),
+            "models": {
+                name: {"mode": model.mode, "n": model.n, **self.batchers[name].as_dict()}
+                for name, model in self.models.items()
+            },
+        }
+
+    async def dispatch(self, method, path, body):
+        if path == "/classify":
+            if method != "POST":
+                raise HTTPError(405, "Use POST for /classify.")
+            return await self.classify(body)
+        if path in ("/stats", "/health"):
+            if method != "GET":
+                raise HTTPError(405, f"Use GET for {path}.")
+            if path == "/stats":
+                return self.stats()
+            return {"status": "ok", "models": list(self.models)}
+        raise HTTPError(404, f"Unknown path '{path}'.")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body_bytes)
+                except HTTPError as e:
+                    write_response(writer, e.status, {"error": e.message}, False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+                start = time.perf_counter()
+                try:
+                    status, payload = 200, await self.dispatch(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": e.message}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                if path == "/classify":
+                    self.latency.add(time.perf_counter() - start, error=status != 200)
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def load_models(models_xml, model_names=None):
+    """
+    Loads the models named in model_names (default: all) from an nb_models.xml file.
+
+    Returns:
+      dict: Mapping of model name to NaiveBayesModel, in the order of model_names or of the
+      XML file.
+
+    Raises:
+      ValueError: If a model is not in the XML file.
+    """
+    configs = load_model_configs(models_xml)
+    for model_name in model_names or []:
+        if model_name not in configs:
+            raise ValueError(f"Model '{model_name}' not found in '{models_xml}'.")
+    models = {}
+    for model_name in model_names or list(configs):
+        start = time.perf_counter()
+        models[model_name] = NaiveBayesModel.from_config(configs[model_name])
+        print(
+            f"Loaded model '{model_name}' ({configs[model_name]['mode']}, n="
+            f"{configs[model_name]['n']}) in {time.perf_counter() - start:.2f}s."
+        )
+    return models
+
+
+async def serve(service, host, port):
+    service.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    addresses = ", ".join(f"{s.getsockname()[0]}:{s.getsockname()[1]}" for s in server.sockets)
+    print(f"Serving {', '.join(service.models)} on http://{addresses}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves language detection models over HTTP.")
+    parser.add_argument("models_xml", help="nb_models.xml file with the models to serve.")
+    parser.add_argument(
+        "--model",
+        action="append",
+        dest="model_names",
+        metavar="NAME",
+        help="Model of the XML file to serve; repeat for several (default: all). The first "
+        "one is the default model of the requests.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument(
+        "--class-mapping",
+        default=None,
+        help="JSON file mapping language codes to class IDs (lang_mapping.json of "
+        "split_dataset.py), to add the language code to the predictions.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help=f"Texts classified at once (default: {DEFAULT_MAX_BATCH_SIZE}).",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=DEFAULT_MAX_DELAY * 1000,
+        help="Milliseconds a batch waits for concurrent requests; 0 classifies what is "
+        f"queued at once (default: {DEFAULT_MAX_DELAY * 1000:g}).",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help=f"Recent (model, text) pairs kept in the LRU cache; 0 disables it "
+        f"(default: {DEFAULT_CACHE_SIZE}).",
+    )
+    parser.add_argument(
+        "--latency-window",
+        type=int,
+        default=DEFAULT_LATENCY_WINDOW,
+        help="Most recent requests covered by the latency percentiles and the recent "
+        f"throughput (default: {DEFAULT_LATENCY_WINDOW}).",
+    )
+    parser.add_argument(
+        "--max-body-bytes",
+        type=int,
+        default=DEFAULT_MAX_BODY_BYTES,
+        help=f"Largest accepted request body (default: {DEFAULT_MAX_BODY_BYTES}).",
+    )
+    args = parser.parse_args()
+    if args.max_batch_size < 1 or args.batch_window < 0 or args.cache_size < 0:
+        parser.error(
+            "--max-batch-size must be positive, --batch-window and --cache-size non-negative"
+        )
+    if args.latency_window < 1 or args.max_body_bytes < 1:
+        parser.error("--latency-window and --max-body-bytes must be positive")
+
+    class_names = None
+    if args.class_mapping:
+        with open(args.class_mapping, "r", encoding="utf-8") as f:
+            class_names = {class_id: lang for lang, class_id in json.load(f).items()}
+    try:
+        models = load_models(args.models_xml, args.model_names)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not models:
+        print(f"Error: no models in '{args.models_xml}'.", file=sys.stderr)
+        sys.exit(1)
+
+    service = ClassificationService(
+        models,
+        class_names,
+        args.max_batch_size,
+        args.batch_window / 1000,
+        args.cache_size,
+        args.latency_window,
+        args.max_body_bytes,
+    )
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        print("Stopped.")
+
+
+if __name__ == "__main__":
+    main()
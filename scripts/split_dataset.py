@@ -2,15 +2,120 @@
 """
 Combines multiple TSV files from an input directory and splits them into training and testing datasets.
 Then creates class mapping and prior probability files based on the training data.
+
+The input files are streamed line by line (in parallel with --workers) and every line is
+assigned to the training or testing data by a seeded hash of its content, so the split is
+reproducible, needs no shuffle in memory, and identical lines always end up on the same side.
+The class frequencies of the training data are collected during the same pass. The stage
+times and line counts of the run are written next to the training file (<train>.stats.json).
+
+With --max-per-class, the training data is reduced to a stratified sample of at most N lines
+of every class (see util.sampling): the split pass also fills a bottom-k reservoir of seeded
+hash priorities per class, and the training lines are filtered by the resulting thresholds
+while the parts are combined, so the sample does not depend on the order of the files or on
+the workers. The test data is not sampled, and the class mapping and priors are computed from
+the full training data.
 """
 
-import sys
-import os
-import random
+import argparse
+import collections
+import hashlib
 import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+from util.helpers import RunStats, stats_file_path
+from util.sampling import StratifiedReservoir
+
+HASH_SCALE = float(1 << 64)
+
+
+def is_training_line(line, split_ratio, seed):
+    """
+    Decides with a seeded hash of the line content (without its line ending) whether a line
+    belongs to the training data, which happens with probability split_ratio.
+    """
+    key = str(seed).encode("utf-8")
+    digest = hashlib.blake2b(line.rstrip("\n").encode("utf-8"), digest_size=8, key=key).digest()
+    return int.from_bytes(digest, "big") / HASH_SCALE < split_ratio
+
+
+def class_label(line):
+    """
+    Returns the class value (first column) of a line, or None for an empty line.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    return line.split("\t")[0]
+
+
+def split_file(task):
+    """
+    Splits one TSV file into a training and a testing part file.
+
+    Returns:
+      tuple: (number of lines, number of training lines, Counter of training class values,
+      StratifiedReservoir of the training lines or None without max_per_class).
+    """
+    filepath, train_part, test_part, split_ratio, seed, max_per_class, sample_seed = task
+    freq = collections.Counter()
+    reservoir = None
+    if max_per_class is not None:
+        reservoir = StratifiedReservoir(max_per_class, sample_seed)
+    num_lines = num_train = 0
+    with open(filepath, "r", encoding="utf-8") as f, open(
+        train_part, "w", encoding="utf-8"
+    ) as train_out, open(test_part, "w", encoding="utf-8") as test_out:
+        for line in f:
+            if not line.endswith("\n"):
+                line += "\n"
+            num_lines += 1
+            if is_training_line(line, split_ratio, seed):
+                num_train += 1
+                train_out.write(line)
+                label = class_label(line)
+                if label is not None:
+                    freq[label] += 1
+                    if reservoir is not None:
+                        reservoir.add(label, line.rstrip("\n"))
+            else:
+                test_out.write(line)
+    return num_lines, num_train, freq, reservoir
+
 
+def copy_sampled_lines(part, out, sample):
+    """
+    Appends the lines of a training part file that are in sample (lines without a class
+    value are kept) to out.
 
-def combine_and_split_files(input_dir, train_file, test_file, split_ratio=0.8):
+    Returns:
+      int: Number of lines written.
+    """
+    written = 0
+    with open(part, "r", encoding="utf-8") as f:
+        for line in f:
+            label = class_label(line)
+            if label is None or sample.keeps(label, line.rstrip("\n")):
+                out.write(line)
+                written += 1
+    return written
+
+
+def combine_and_split_files(
+    input_dir,
+    train_file,
+    test_file,
+    split_ratio=0.8,
+    seed=0,
+    workers=1,
+    stats=None,
+    max_per_class=None,
+    sample_seed=0,
+):
     """
     Combines all TSV files in the input directory and splits them into train and test files.
 
@@ -19,46 +124,111 @@ def combine_and_split_files(input_dir, train_file, test_file, split_ratio=0.8):
       train_file (str): Output file for training data.
       test_file (str): Output file for testing data.
       split_ratio (float): Fraction of lines to use for training.
+      seed (int): Seed of the hash that assigns the lines.
+      workers (int): Number of files split in parallel.
+      stats (RunStats): Optional stats of the run that get the line counts; progress lines
+        are printed if given.
+      max_per_class (int): Optional number of training lines kept per class value, chosen
+        by a stratified sample.
+      sample_seed (int): Seed of the hash that samples the training lines.
+
+    Returns:
+      Counter: Frequency of each class value (first column) in the training data, before
+      the sample.
     """
-    with open(train_file, "w", encoding="utf-8") as train_out, open(
-        test_file, "w", encoding="utf-8"
-    ) as test_out:
-        for filename in sorted(os.listdir(input_dir)):
-            if not filename.endswith(".tsv"):
-                continue
-            filepath = os.path.join(input_dir, filename)
-            print(f"Processing file: {filepath}")
-            with open(filepath, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                if not lines:
-                    continue
-                random.shuffle(lines)
-                train_cutoff = int(len(lines) * split_ratio)
-                train_out.writelines(lines[:train_cutoff])
-                test_out.writelines(lines[train_cutoff:])
+    filenames = [name for name in sorted(os.listdir(input_dir)) if name.endswith(".tsv")]
+    part_dir = tempfile.mkdtemp(prefix="split_", dir=os.path.dirname(os.path.abspath(train_file)))
+    pool = None
+    try:
+        tasks = [
+            (
+                os.path.join(input_dir, name),
+                os.path.join(part_dir, f"{i}.train"),
+                os.path.join(part_dir, f"{i}.test"),
+                split_ratio,
+                seed,
+                max_per_class,
+                sample_seed,
+            )
+            for i, name in enumerate(filenames)
+        ]
+        results = map(split_file, tasks)
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            # imap returns the files in order, so the output does not depend on the workers.
+            results = pool.imap(split_file, tasks)
+        freq = collections.Counter()
+        reservoir = None
+        if max_per_class is not None:
+            reservoir = StratifiedReservoir(max_per_class, sample_seed)
+        input_bytes = [os.path.getsize(task[0]) for task in tasks]
+        progress = None
+        if stats is not None:
+            progress = stats.progress("Splitting", total=sum(input_bytes), unit="files")
+        total_lines = total_train = 0
+        with open(train_file, "w", encoding="utf-8") as train_out, open(
+            test_file, "w", encoding="utf-8"
+        ) as test_out:
+            for i, (task, result) in enumerate(zip(tasks, results)):
+                num_lines, num_train, file_freq, file_reservoir = result
+                filepath, train_part, test_part = task[:3]
+                print(f"Processing file: {filepath}")
+                # With a sample, the training parts are combined once all files are split.
+                parts = [(test_part, test_out)]
+                if reservoir is None:
+                    parts.insert(0, (train_part, train_out))
+                else:
+                    reservoir.merge(file_reservoir)
+                for part, out in parts:
+                    with open(part, "r", encoding="utf-8") as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(part)
+                freq.update(file_freq)
                 print(
-                    f"  {len(lines)} lines: {train_cutoff} training, {len(lines) - train_cutoff} testing"
+                    f"  {num_lines} lines: {num_train} training, {num_lines - num_train} testing"
                 )
+                total_lines += num_lines
+                total_train += num_train
+                if progress is not None:
+                    progress.update(i + 1, position=sum(input_bytes[: i + 1]))
+            if reservoir is not None:
+                sample = reservoir.sample()
+                sampled_train = sum(
+                    copy_sampled_lines(task[1], train_out, sample) for task in tasks
+                )
+                print(
+                    f"Sampled {sampled_train} of {total_train} training lines (at most "
+                    f"{max_per_class} of every class, seed {sample_seed})."
+                )
+        if stats is not None:
+            stats.set(
+                files=len(tasks),
+                input_bytes=sum(input_bytes),
+                lines=total_lines,
+                train_lines=total_train,
+                test_lines=total_lines - total_train,
+            )
+            if reservoir is not None:
+                stats.set(
+                    max_per_class=max_per_class,
+                    sample_seed=sample_seed,
+                    sampled_train_lines=sampled_train,
+                    sampled_class_lines=dict(sorted(reservoir.counts().items())),
+                )
+        return freq
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(part_dir, ignore_errors=True)
 
 
-def create_class_mapping_and_prior(train_file, class_id_json, prior_file):
+def write_class_mapping_and_prior(freq, class_id_json, prior_file):
     """
-    Reads the training file to compute the frequency of each unique value in the first column.
-    Generates a mapping (0 to n-1) and writes two files:
+    Writes the class mapping and prior files for the given class frequencies:
       - class_id.json: JSON file mapping each class (first column value) to an id.
       - prior.txt: Each line contains the class name, its numeric id, and the ratio it appears in the file.
     """
-    freq = {}
-    total = 0
-    with open(train_file, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            columns = line.split("\t")
-            class_val = columns[0]
-            freq[class_val] = freq.get(class_val, 0) + 1
-            total += 1
+    total = sum(freq.values())
 
     # Create a mapping from class value to an ID, sorting to ensure consistency
     labels = sorted(freq.keys())
@@ -75,30 +245,76 @@ def create_class_mapping_and_prior(train_file, class_id_json, prior_file):
             f.write(f"{label}\t{mapping[label]}\t{ratio}\n")
 
 
-def main():
-    if len(sys.argv) != 5:
-        print(
-            "Usage: python ./scripts/split_dataset.py <input_dir> <train_file> <test_file> <split_ratio>"
-        )
-        sys.exit(1)
-    input_dir = sys.argv[1]
-    train_file = sys.argv[2]
-    test_file = sys.argv[3]
-    split_ratio_str = sys.argv[4]
+def parse_split_ratio(value):
     try:
-        split_ratio = float(split_ratio_str)
+        split_ratio = float(value)
         if not (0 < split_ratio < 1):
             raise ValueError
     except ValueError:
         print("Error: split_ratio must be a float between 0 and 1.")
         sys.exit(1)
+    return split_ratio
+
 
-    combine_and_split_files(input_dir, train_file, test_file, split_ratio)
-    print("Shuffled and combined train and test TSV files created.")
+def main():
+    parser = argparse.ArgumentParser(
+        description="Combines TSV files and splits them into training and testing datasets.",
+        usage="python ./scripts/split_dataset.py <input_dir> <train_file> <test_file> <split_ratio> "
+        "[--seed SEED] [--workers N] [--max-per-class N] [--sample-seed SEED]",
+    )
+    parser.add_argument("input_dir", help="Directory containing TSV files.")
+    parser.add_argument("train_file", help="Output file for training data.")
+    parser.add_argument("test_file", help="Output file for testing data.")
+    parser.add_argument("split_ratio", help="Fraction of lines to use for training.")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the hash that splits the lines (default: 0)."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of input files split in parallel (default: 1).",
+    )
+    parser.add_argument(
+        "--max-per-class",
+        type=int,
+        default=None,
+        help="Keep a seeded stratified sample of at most N training lines of every class; the "
+        "priors are still computed from all training lines.",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed of the hash that samples the training lines (default: 0).",
+    )
+    args = parser.parse_args()
+    split_ratio = parse_split_ratio(args.split_ratio)
+    if args.max_per_class is not None and args.max_per_class < 1:
+        parser.error("--max-per-class must be at least 1")
+
+    stats = RunStats("split_dataset")
+    with stats.stage("split"):
+        freq = combine_and_split_files(
+            args.input_dir,
+            args.train_file,
+            args.test_file,
+            split_ratio,
+            args.seed,
+            args.workers,
+            stats,
+            args.max_per_class,
+            args.sample_seed,
+        )
+    print("Combined and split train and test TSV files created.")
 
-    # Create class mapping and prior files based on the training file
-    create_class_mapping_and_prior(train_file, "class_id.json", "prior.txt")
+    # Create class mapping and prior files from the class frequencies of the split (before
+    # any sample, so the priors keep the skew of the full data)
+    with stats.stage("mapping"):
+        write_class_mapping_and_prior(freq, "class_id.json", "prior.txt")
     print("Class mapping and prior probability files created: class_id.json, prior.txt")
+    stats.set(classes=len(freq))
+    stats.write(stats_file_path(args.train_file))
 
 
 if __name__ == "__main__":
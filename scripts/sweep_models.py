@@ -0,0 +1,606 @@
+#!/usr/bin/env python3
+"""
+Builds and scores a grid of model configurations and prints their size, accuracy and build
+time with the Pareto-optimal configurations marked (requires NumPy).
+
+The grid is the product of the models (mode and n), the pruning settings (--min-counts,
+--top-ks, --feature-selections), the per-class caps of the training examples
+(--max-per-class, a seeded stratified sample as in the builders, with the priors of the full
+training data) and the Laplace smoothing parameters (--alphas). The sweep
+runs the whole pipeline:
+  1. Splits the TSV files of the input directory into training and test data like
+     split_dataset.py, with the class mapping and priors.
+  2. Compiles the training data into a corpus cache (see compile_corpus.py).
+  3. Builds the .bin model of every (mode, n, pruning, cap) configuration from the corpus cache,
+     sorted, like the create_ngram_model_<mode>.py builders.
+  4. Scores the test data with every model and alpha with the local reference classifier.
+Steps 3 and 4 run in a pool of --workers processes, and every model is scored as soon as
+it is built.
+
+Every artifact is cached in --cache-dir under a key that hashes the contents of the input
+files and every setting the artifact depends on (the split, the corpus cache, the models and
+the predictions with their metrics), so a rerun only does the work of the configurations
+it has not seen: adding one grid point builds one model, and adding an alpha only scores.
+An artifact is written to a temporary directory that is renamed into place when it is
+complete, so an interrupted sweep leaves no partial artifacts. Build times are those of the
+run that built the model. The output of every build is written to log.txt in its model
+directory.
+
+Usage:
+  python sweep_models.py <input_dir> <cache_dir> [--split-ratio R] [--seed S]
+      [--models byte:1-3,codepoint:1-2] [--min-counts 1,2] [--top-ks 0,5000]
+      [--feature-selections none,chi2:20000] [--max-per-class 0,1000] [--sample-seed S]
+      [--alphas 1,0.5] [--workers N] [--json FILE]
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import shutil
+import time
+
+from create_ngram_models import parse_model_list
+from evaluate_predictions import iter_test_file
+from split_dataset import combine_and_split_files, write_class_mapping_and_prior
+from util.classifier import MODE_BUILDERS, NaiveBayesModel, classify_stream
+from util.corpus_cache import CorpusCache, open_corpus_cache
+from util.evaluation import ConfusionMatrix
+from util.helpers import RunStats, load_language_mapping
+from util.model_io import write_model_counts
+from util.model_meta import compute_priors, write_model_meta
+from util.pruning import FEATURE_SELECTION_METHODS, PrunedCounts
+
+# Part of every cache key; bump it when the builders or the scoring change their output.
+SWEEP_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+DEFAULT_MODELS = "byte:1-3,codepoint:1-2"
+TRAIN_FILE = "train.tsv"
+TEST_FILE = "test.tsv"
+MAPPING_FILE = "class_id.json"
+PRIOR_FILE = "prior.txt"
+MODEL_FILE = "model.bin"
+BUILD_FILE = "build.json"
+PREDICTIONS_FILE = "predictions.txt"
+RESULT_FILE = "result.json"
+LOG_FILE = "log.txt"
+
+
+def cache_key(*parts):
+    """
+    Returns a hex digest of JSON-serializable parts.
+    """
+    data = json.dumps([SWEEP_VERSION, *parts], sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def input_hash(input_dir):
+    """
+    Returns a hex digest of the names and contents of the TSV files of input_dir.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(input_dir)):
+        if not name.endswith(".tsv"):
+            continue
+        path = os.path.join(input_dir, name)
+        digest.update(f"{name}\0{os.path.getsize(path)}\0".encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def new_artifact(path):
+    """
+    Context manager yielding a temporary directory that is renamed to path when its block
+    completes, and removed if it fails.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another sweep completed the same artifact first.
+            if not os.path.isdir(path):
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def parse_int_list(value):
+    try:
+        return [int(item) for item in value.split(",") if item]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list of integers: '{value}'")
+
+
+def parse_float_list(value):
+    try:
+        return [float(item) for item in value.split(",") if item]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list of numbers: '{value}'")
+
+
+def parse_feature_selections(value):
+    """
+    Parses a comma-separated list of none and <method>:<number of features> items.
+
+    Returns:
+      list: (method, num_features) pairs, (None, None) for none.
+    """
+    selections = []
+    for item in value.split(","):
+        if item == "none":
+            selections.append((None, None))
+            continue
+        method, _, num_features = item.partition(":")
+        if method not in FEATURE_SELECTION_METHODS or not num_features.isdigit():
+            raise argparse.ArgumentTypeError(
+                f"invalid feature selection '{item}', expected none or <method>:<N> with a "
+                f"method of {', '.join(FEATURE_SELECTION_METHODS)}"
+            )
+        selections.append((method, int(num_features)))
+    return selections
+
+
+def split_data(cache_dir, input_dir, split_ratio, seed):
+    """
+    Returns the split artifact of the input files (training and test data, class mapping and
+    priors), splitting them first if it is not cached.
+
+    Returns:
+      tuple: (key, directory, whether it was cached).
+    """
+    key = cache_key("split", input_hash(input_dir), split_ratio, seed)
+    path = os.path.join(cache_dir, "split", key)
+    if os.path.isdir(path):
+        return key, path, True
+    with new_artifact(path) as tmp_path:
+        freq = combine_and_split_files(
+            input_dir,
+            os.path.join(tmp_path, TRAIN_FILE),
+            os.path.join(tmp_path, TEST_FILE),
+            split_ratio,
+            seed,
+        )
+        write_class_mapping_and_prior(
+            freq, os.path.join(tmp_path, MAPPING_FILE), os.path.join(tmp_path, PRIOR_FILE)
+        )
+    return key, path, False
+
+
+def build_model(task):
+    """
+    Builds the model of a configuration from the corpus cache into its artifact directory.
+    Runs in a worker process.
+
+    Returns:
+      dict: The build info written to build.json.
+    """
+    path, split_dir, corpus_dir, config = task
+    mapping_file = os.path.join(split_dir, MAPPING_FILE)
+    builder = importlib.import_module(MODE_BUILDERS[config["mode"]])
+    with new_artifact(path) as tmp_path:
+        with open(os.path.join(tmp_path, LOG_FILE), "w", encoding="utf-8") as log:
+            with contextlib.redirect_stdout(log):
+                start = time.perf_counter()
+                class_counts = collections.Counter()
+                sampled_counts = collections.Counter()
+                counts = builder.encode_ngram_model(
+                    os.path.join(split_dir, TRAIN_FILE),
+                    config["n"],
+                    mapping_file,
+                    class_counts=class_counts,
+                    corpus_cache=CorpusCache(corpus_dir),
+                    max_per_class=config["max_per_class"],
+                    sample_seed=config["sample_seed"],
+                    sampled_counts=sampled_counts,
+                )
+                pruned_counts = PrunedCounts(
+                    counts,
+                    min_count=config["min_count"],
+                    top_k=config["top_k"],
+                    feature_selection=config["feature_selection"],
+                    num_features=config["num_features"],
+                )
+                model_file = os.path.join(tmp_path, MODEL_FILE)
+                tuples = write_model_counts(pruned_counts, model_file, sort=True)
+                write_model_meta(
+                    model_file,
+                    config["mode"],
+                    config["n"],
+                    load_language_mapping(mapping_file),
+                    class_counts,
+                    pruned_counts.describe(),
+                )
+                build_seconds = time.perf_counter() - start
+        examples = sampled_counts if config["max_per_class"] else class_counts
+        info = {
+            "config": config,
+            "pruning": pruned_counts.describe(),
+            "tuples": tuples,
+            "model_bytes": os.path.getsize(model_file),
+            "build_seconds": round(build_seconds, 3),
+            "examples": sum(examples.values()),
+            "class_counts": {str(c): class_counts[c] for c in sorted(class_counts)},
+        }
+        with open(os.path.join(tmp_path, BUILD_FILE), "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=2)
+            f.write("\n")
+    return info
+
+
+def score_model(task):
+    """
+    Predicts the test data with a built model and a smoothing parameter and writes the
+    predictions and metrics into the artifact directory. Runs in a worker process.
+
+    Returns:
+      dict: The metrics written to result.json.
+    """
+    path, split_dir, model_dir, alpha, batch_size, _ = task
+    with open(os.path.join(model_dir, BUILD_FILE), "r", encoding="utf-8") as f:
+        info = json.load(f)
+    config = info["config"]
+    class_counts = {int(c): count for c, count in info["class_counts"].items()}
+    with new_artifact(path) as tmp_path:
+        start = time.perf_counter()
+        model = NaiveBayesModel.load(
+            os.path.join(model_dir, MODEL_FILE),
+            config["mode"],
+            config["n"],
+            compute_priors(class_counts),
+            alpha,
+        )
+        confusion = ConfusionMatrix(load_language_mapping(os.path.join(split_dir, MAPPING_FILE)))
+        # The test file is read once; tee only buffers the batch being classified.
+        records, sentences = itertools.tee(iter_test_file(os.path.join(split_dir, TEST_FILE)))
+        predicted = classify_stream(model, (sentence for _, _, sentence in sentences), batch_size)
+        with open(os.path.join(tmp_path, PREDICTIONS_FILE), "w", encoding="utf-8") as f:
+            for (_, true_lang, _), predicted_class in zip(records, predicted):
+                f.write(f"{predicted_class}\n")
+                confusion.add(true_lang, str(predicted_class))
+        metrics = confusion.metrics()
+        classes = metrics["support"] > 0
+        result = {
+            "alpha": alpha,
+            "sentences": metrics["total"],
+            "correct": metrics["total_correct"],
+            "accuracy": metrics["accuracy"],
+            "macro_f1": float(metrics["f1"][classes].mean()) if classes.any() else 0.0,
+            "score_seconds": round(time.perf_counter() - start, 3),
+        }
+        with open(os.path.join(tmp_path, RESULT_FILE), "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    return result
+
+
+def grid_configs(models, min_counts, top_ks, feature_selections, max_per_class, sample_seed):
+    """
+    Returns the build configuration of every point of the grid, without smoothing.
+    """
+    return [
+        {
+            "mode": mode,
+            "n": n,
+            "min_count": min_count,
+            "top_k": top_k or None,
+            "feature_selection": method,
+            "num_features": num_features,
+            "max_per_class": cap or None,
+            "sample_seed": sample_seed if cap else None,
+        }
+        for (mode, n), min_count, top_k, (method, num_features), cap in itertools.product(
+            models, min_counts, top_ks, feature_selections, max_per_class
+        )
+    ]
+
+
+def describe_config(config):
+    """
+    Returns a label of a build configuration such as byte:3 (min count 2).
+    """
+    pruning = []
+    if config["min_count"] > 1:
+        pruning.append(f"min count {config['min_count']}")
+    if config["top_k"]:
+        pruning.append(f"top {config['top_k']}")
+    if config["feature_selection"]:
+        pruning.append(f"{config['feature_selection']} {config['num_features']}")
+    if config["max_per_class"]:
+        pruning.append(f"at most {config['max_per_class']} per class")
+    label = f"{config['mode']}:{config['n']}"
+    return f"{label} ({', '.join(pruning)})" if pruning else label
+
+
+def run_sweep(split_key, split_dir, corpus_dir, cache_dir, configs, alphas, workers, batch_size):
+    """
+    Builds and scores every configuration with every alpha that is not cached yet, in a pool
+    of workers processes; a model is scored as soon as it is built.
+
+    Returns:
+      list: One row per (configuration, alpha) with the build info, the metrics and whether
+      the model and the scores were cached.
+    """
+    rows = []
+    to_build = {}
+    to_score = collections.defaultdict(list)
+    for config in configs:
+        model_key = cache_key("model", split_key, config)
+        model_dir = os.path.join(cache_dir, "models", model_key)
+        model_cached = os.path.isdir(model_dir)
+        if not model_cached:
+            to_build[model_key] = (model_dir, split_dir, corpus_dir, config)
+        for alpha in alphas:
+            score_dir = os.path.join(cache_dir, "predictions", cache_key("score", model_key, alpha))
+            row = {
+                "model_dir": model_dir,
+                "score_dir": score_dir,
+                "model_cached": model_cached,
+                "score_cached": os.path.isdir(score_dir),
+            }
+            rows.append(row)
+            if not row["score_cached"]:
+                to_score[model_key].append(
+                    (score_dir, split_dir, model_dir, alpha, batch_size, describe_config(config))
+                )
+
+    print(
+        f"{len(rows)} configurations: building {len(to_build)} models and scoring "
+        f"{sum(len(tasks) for tasks in to_score.values())} configurations; the rest is cached."
+    )
+    with concurrent.futures.ProcessPoolExecutor(max(workers, 1)) as pool:
+        pending = {}
+        for model_key, tasks in to_score.items():
+            if model_key not in to_build:
+                for task in tasks:
+                    pending[pool.submit(score_model, task)] = ("score", task)
+        for model_key, task in to_build.items():
+            pending[pool.submit(build_model, task)] = ("build", model_key)
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                kind, name = pending.pop(future)
+                future.result()
+                if kind == "build":
+                    print(f"Built {describe_config(to_build[name][3])} in '{to_build[name][0]}'.")
+                    for task in to_score[name]:
+                        pending[pool.submit(score_model, task)] = ("score", task)
+                else:
+                    print(f"Scored {name[5]} with alpha {name[3]:g}.")
+
+    for row in rows:
+        with open(os.path.join(row["model_dir"], BUILD_FILE), "r", encoding="utf-8") as f:
+            row.update(json.load(f))
+        with open(os.path.join(row["score_dir"], RESULT_FILE), "r", encoding="utf-8") as f:
+            row.update(json.load(f))
+        del row["class_counts"]
+    return rows
+
+
+def mark_pareto(rows):
+    """
+    Sets "pareto" on every row: True if no other row is at least as small, as fast to build
+    and as accurate, and better in one of them.
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other["model_bytes"] <= row["model_bytes"]
+            and other["build_seconds"] <= row["build_seconds"]
+            and other["accuracy"] >= row["accuracy"]
+            and (
+                other["model_bytes"] < row["model_bytes"]
+                or other["build_seconds"] < row["build_seconds"]
+                or other["accuracy"] > row["accuracy"]
+            )
+            for other in rows
+        )
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def print_table(rows):
+    """
+    Prints the rows sorted by size and then accuracy, with the Pareto-optimal rows marked.
+    """
+    header = [
+        "",
+        "model",
+        "pruning",
+        "cap",
+        "alpha",
+        "examples",
+        "size",
+        "tuples",
+        "build",
+        "accuracy",
+        "macro F1",
+    ]
+    table = [header]
+    for row in sorted(rows, key=lambda row: (row["model_bytes"], -row["accuracy"])):
+        table.append(
+            [
+                "*" if row["pareto"] else "",
+                f"{row['config']['mode']}:{row['config']['n']}",
+                row["pruning"],
+                str(row["config"]["max_per_class"] or "-"),
+                f"{row['alpha']:g}",
+                str(row["examples"]),
+                _format_size(row["model_bytes"]),
+                str(row["tuples"]),
+                f"{row['build_seconds']:.1f}s" + ("" if row["model_cached"] else " (new)"),
+                f"{row['accuracy'] * 100:.2f}%",
+                f"{row['macro_f1'] * 100:.2f}%",
+            ]
+        )
+    widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+    for line in table:
+        print(
+            "  ".join(
+                cell.ljust(width) if i < 4 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(line, widths))
+            )
+        )
+    print(
+        "* Pareto-optimal, not dominated: no other configuration is at least as small, fast and "
+        "accurate and strictly better in one."
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds and scores a grid of model configurations with cached artifacts."
+    )
+    parser.add_argument("input_dir", help="Directory containing the TSV files to split.")
+    parser.add_argument("cache_dir", help="Directory of the cached artifacts.")
+    parser.add_argument(
+        "--split-ratio",
+        type=float,
+        default=0.8,
+        help="Fraction of lines used for training (default: 0.8).",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the hash that splits the lines (default: 0)."
+    )
+    parser.add_argument(
+        "--models",
+        type=parse_model_list,
+        default=parse_model_list(DEFAULT_MODELS),
+        help=f"Comma-separated models as <mode>:<n> or <mode>:<first n>-<last n> "
+        f"(default: {DEFAULT_MODELS}).",
+    )
+    parser.add_argument(
+        "--min-counts",
+        type=parse_int_list,
+        default=[1],
+        help="Comma-separated --min-count values of the builders (default: 1).",
+    )
+    parser.add_argument(
+        "--top-ks",
+        type=parse_int_list,
+        default=[0],
+        help="Comma-separated --top-k values of the builders, 0 for no limit (default: 0).",
+    )
+    parser.add_argument(
+        "--feature-selections",
+        type=parse_feature_selections,
+        default=[(None, None)],
+        help="Comma-separated feature selections as none or <method>:<number of features>, "
+        f"with a method of {', '.join(FEATURE_SELECTION_METHODS)} (default: none).",
+    )
+    parser.add_argument(
+        "--max-per-class",
+        type=parse_int_list,
+        default=[0],
+        help="Comma-separated --max-per-class values of the builders, the number of training "
+        "examples sampled per class, 0 for all (default: 0).",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed of the hash that samples the examples of --max-per-class (default: 0).",
+    )
+    parser.add_argument(
+        "--alphas",
+        type=parse_float_list,
+        default=[1.0],
+        help="Comma-separated Laplace smoothing parameters (default: 1).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes that build and score (default: the number of CPUs).",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4096,
+        help="Sentences classified at once when scoring (default: 4096).",
+    )
+    parser.add_argument("--json", metavar="FILE", default=None, help="Write the table as JSON.")
+    args = parser.parse_args()
+    if not 0 < args.split_ratio < 1:
+        parser.error("--split-ratio must be between 0 and 1")
+    if any(value < 1 for value in args.min_counts) or any(value < 0 for value in args.top_ks):
+        parser.error("--min-counts must be positive and --top-ks non-negative")
+    if any(value < 0 for value in args.max_per_class):
+        parser.error("--max-per-class must be non-negative")
+    if any(alpha <= 0 for alpha in args.alphas):
+        parser.error("--alphas must be positive")
+    if args.workers < 1 or args.batch_size < 1:
+        parser.error("--workers and --batch-size must be positive")
+
+    stats = RunStats("sweep_models")
+    os.makedirs(args.cache_dir, exist_ok=True)
+    for kind in ("split", "corpus", "models", "predictions"):
+        os.makedirs(os.path.join(args.cache_dir, kind), exist_ok=True)
+    with stats.stage("split"):
+        split_key, split_dir, cached = split_data(
+            args.cache_dir, args.input_dir, args.split_ratio, args.seed
+        )
+    print(f"{'Using cached' if cached else 'Created'} split '{split_dir}'.")
+    with stats.stage("corpus"):
+        corpus_dir = os.path.join(args.cache_dir, "corpus", split_key)
+        open_corpus_cache(
+            corpus_dir,
+            os.path.join(split_dir, TRAIN_FILE),
+            os.path.join(split_dir, MAPPING_FILE),
+            stats.skipped,
+        )
+
+    configs = grid_configs(
+        args.models,
+        args.min_counts,
+        args.top_ks,
+        args.feature_selections,
+        args.max_per_class,
+        args.sample_seed,
+    )
+    with stats.stage("sweep"):
+        rows = run_sweep(
+            split_key,
+            split_dir,
+            corpus_dir,
+            args.cache_dir,
+            configs,
+            args.alphas,
+            args.workers,
+            args.batch_size,
+        )
+    mark_pareto(rows)
+    print_table(rows)
+    stats.set(
+        configurations=len(rows),
+        models_built=len({row["model_dir"] for row in rows if not row["model_cached"]}),
+        configurations_scored=sum(1 for row in rows if not row["score_cached"]),
+    )
+    stats.print_summary()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"configurations": rows, "run": stats.as_dict()}, f, indent=2)
+            f.write("\n")
+        print(f"Written the table to '{args.json}'.")
+
+
+if __name__ == "__main__":
+    main()
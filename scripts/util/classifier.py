@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Local reference implementation of ClickHouse's naiveBayesClassifier (requires NumPy).
+
+Loads a binary model file together with the mode, n, alpha and priors of its entry in an
+nb_models.xml file, tokenizes and pads input text exactly like the create_ngram_model_*
+scripts and classifies batches of sentences with multinomial Naive Bayes and Laplace
+smoothing:
+
+  score(c) = log(prior(c)) + sum over n-grams g of log((count(c, g) + alpha) / (total(c) + alpha * V))
+
+where total(c) is the number of n-grams of class c and V is the number of distinct n-grams.
+The class with the highest score is predicted; ties go to the lowest class id.
+
+classify_early_exit scores only a prefix of every sentence: the n-grams are added to the
+per-class scores in blocks, and a sentence stops once the margin of its leading class over
+the runner-up exceeds the most the remaining n-grams could change it (the remaining count
+times the largest per-n-gram difference between two classes, which never changes the
+prediction), or a configurable bound below that, or after a maximum number of n-grams.
+"""
+
+import importlib
+import math
+
+import numpy as np
+
+from util.model_io import iter_model_tuples
+from util.model_meta import DEFAULT_ALPHA
+
+# Builder script that defines sentence_ngrams(sentence, n) for each mode.
+MODE_BUILDERS = {
+    "byte": "create_ngram_model_byte",
+    "codepoint": "create_ngram_model_codepoint",
+    "token": "create_ngram_model_token",
+}
+DEFAULT_BATCH_SIZE = 4096
+# N-grams added to the scores of every sentence between two early exit checks.
+DEFAULT_EXIT_STEP = 8
+# N-grams of a byte or code point sentence tokenized before the first check; the prefix is
+# tokenized again, twice as long, whenever a sentence needs more.
+EXIT_FIRST_WINDOW = 32
+
+
+def get_sentence_ngrams(mode):
+    """
+    Returns the sentence_ngrams(sentence, n) function of the builder for the given mode.
+    """
+    if mode not in MODE_BUILDERS:
+        raise ValueError(f"Unknown model mode '{mode}'.")
+    return importlib.import_module(MODE_BUILDERS[mode]).sentence_ngrams
+
+
+class NaiveBayesModel:
+    """
+    A loaded model: an n-gram vocabulary and a dense [vocabulary + 1, classes] float32
+    matrix of log-probabilities, whose last row is used for unseen n-grams.
+    """
+
+    def __init__(self, mode, n, vocabulary, log_probs, log_priors):
+        self.mode = mode
+        self.n = n
+        self.vocabulary = vocabulary
+        self.log_probs = log_probs
+        self.log_priors = log_priors
+        self.unseen = len(vocabulary)
+        self.sentence_ngrams = get_sentence_ngrams(mode)
+        self._max_swing = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls.load(
+            config["path"], config["mode"], config["n"], config["priors"], config["alpha"]
+        )
+
+    @classmethod
+    def load(cls, model_file, mode, n, priors=None, alpha=DEFAULT_ALPHA):
+        """
+        Loads a binary model file.
+
+        Parameters:
+          model_file (str): Path to the binary model file.
+          mode (str): byte, codepoint or token.
+          n (int): N-gram size the model was built with.
+          priors (dict): Mapping of class id to prior probability; uniform if empty.
+          alpha (float): Laplace smoothing parameter.
+        """
+        text = mode != "byte"
+        vocabulary = {}
+        rows = []
+        class_ids = []
+        counts = []
+        for class_id, ngram, count in iter_model_tuples(model_file):
+            if text:
+                ngram = ngram.decode("utf-8")
+            row = vocabulary.setdefault(ngram, len(vocabulary))
+            rows.append(row)
+            class_ids.append(class_id)
+            counts.append(count)
+
+        num_classes = max(class_ids + list(priors or {}), default=-1) + 1
+        vocabulary_size = len(vocabulary)
+        class_ids = np.array(class_ids, dtype=np.int64)
+        counts = np.array(counts, dtype=np.float64)
+        matrix = np.zeros((vocabulary_size + 1, num_classes), dtype=np.float32)
+        matrix[np.array(rows, dtype=np.int64), class_ids] = counts
+
+        totals = np.bincount(class_ids, weights=counts, minlength=num_classes)
+        denominators = (totals + alpha * vocabulary_size).astype(np.float32)
+        matrix += np.float32(alpha)
+        matrix /= denominators
+        np.log(matrix, out=matrix)
+
+        if priors:
+            log_priors = np.array(
+                [
+                    math.log(priors[c]) if priors.get(c, 0) > 0 else -np.inf
+                    for c in range(num_classes)
+                ]
+            )
+        else:
+            log_priors = np.full(num_classes, -math.log(max(num_classes, 1)))
+        return cls(mode, n, vocabulary, matrix, log_priors)
+
+    def scores(self, sentences):
+        """
+        Returns the [len(sentences), classes] matrix of log scores.
+        """
+        vocabulary_get = self.vocabulary.get
+        unseen = self.unseen
+        ids = []
+        lengths = []
+        for sentence in sentences:
+            ngrams = self.sentence_ngrams(sentence, self.n)
+            ids.extend([vocabulary_get(ngram, unseen) for ngram in ngrams])
+            lengths.append(len(ngrams))
+        lengths = np.array(lengths, dtype=np.int64)
+
+        scores = np.tile(self.log_priors, (len(sentences), 1))
+        nonempty = lengths > 0
+        if ids:
+            offsets = (np.cumsum(lengths) - lengths)[nonempty]
+            rows = self.log_probs[np.array(ids, dtype=np.int64)]
+            scores[nonempty] += np.add.reduceat(rows, offsets, axis=0, dtype=np.float64)
+        return scores
+
+    def classify(self, sentences):
+        """
+        Returns the predicted class id of every sentence.
+        """
+        if not sentences:
+            return []
+        return np.argmax(self.scores(sentences), axis=1).tolist()
+
+    @property
+    def max_swing(self):
+        """
+        Largest difference between the log-probabilities of two classes for one n-gram
+        (including unseen n-grams): no n-gram changes the score margin of two classes by more.
+        """
+        if self._max_swing is None:
+            swings = self.log_probs.max(axis=1) - self.log_probs.min(axis=1)
+            self._max_swing = float(swings.max()) if len(swings) else 0.0
+        return self._max_swing
+
+    def ngram_count(self, sentence):
+        """
+        Returns len(self.sentence_ngrams(sentence, self.n)), without tokenizing byte and code
+        point sentences.
+        """
+        if self.mode == "byte":
+            length = len(sentence.encode("utf-8"))
+        elif self.mode == "codepoint":
+            length = len(sentence)
+        else:
+            return len(self.sentence_ngrams(sentence, self.n))
+        # The builders pad both ends with n - 1 boundary tokens.
+        padded = length + 2 * (self.n - 1)
+        return padded - self.n + 1 if padded >= self.n else 0
+
+    def prefix_ngrams(self, sentence, max_prefix=None):
+        """
+        Returns the first max_prefix n-grams of a sentence (all of them if None).
+        """
+        if max_prefix is None:
+            return self.sentence_ngrams(sentence, self.n)
+        if self.mode != "token":
+            # After the n - 1 start paddings, n-gram i ends with code point (or byte) i, and
+            # every code point is at least one byte, so the rest of the sentence is not needed.
+            sentence = sentence[:max_prefix]
+        return self.sentence_ngrams(sentence, self.n)[:max_prefix]
+
+    def classify_early_exit(
+        self, sentences, bound=math.inf, max_prefix=None, step=DEFAULT_EXIT_STEP
+    ):
+        """
+        Classifies sentences from a prefix of their n-grams.
+
+        The sentences are scored in lockstep, step n-grams at a time. A sentence stops when
+        all its n-grams (at most max_prefix) are scored, or when the margin of its leading
+        class over the runner-up exceeds min(bound, remaining n-grams * max_swing). With the
+        default bound, the predictions are those of classify; a finite bound stops earlier at
+        the risk of changing some.
+
+        Parameters:
+          sentences (list): Sentences to classify.
+          bound (float): Margin in nats (natural log units) that ends the scoring of a sentence.
+          max_prefix (int): Maximum number of n-grams scored per sentence, or None.
+          step (int): N-grams added between two checks of the margin.
+
+        Returns:
+          tuple: (classes, scored), the predicted class id and the number of scored n-grams
+          of every sentence.
+        """
+        if not sentences:
+            return [], []
+        if self.mode == "token":
+            ngram_lists = [self.prefix_ngrams(sentence, max_prefix) for sentence in sentences]
+            lengths = [len(ngrams) for ngrams in ngram_lists]
+        else:
+            # Only a first window is tokenized; it is extended when a sentence needs more.
+            window = min(EXIT_FIRST_WINDOW, max_prefix or EXIT_FIRST_WINDOW)
+            ngram_lists = [self.prefix_ngrams(sentence, window) for sentence in sentences]
+            lengths = [self.ngram_count(sentence) for sentence in sentences]
+            if max_prefix is not None:
+                lengths = [min(length, max_prefix) for length in lengths]
+        scores = np.tile(self.log_priors, (len(sentences), 1))
+        scored = np.zeros(len(sentences), dtype=np.int64)
+        if scores.shape[1] < 2:
+            return np.argmax(scores, axis=1).tolist(), scored.tolist()
+
+        vocabulary_get = self.vocabulary.get
+        unseen = self.unseen
+        active = np.flatnonzero(np.array(lengths, dtype=np.int64) > 0)
+        lengths = np.array(lengths, dtype=np.int64)
+        start = 0
+        while len(active):
+            end = start + step
+            ids = []
+            counts = []
+            for i in active.tolist():
+                ngrams = ngram_lists[i]
+                if len(ngrams) < end and len(ngrams) < lengths[i]:
+                    window = max(2 * len(ngrams), end)
+                    if max_prefix is not None:
+                        window = min(window, max_prefix)
+                    ngrams = ngram_lists[i] = self.prefix_ngrams(sentences[i], window)
+                block = [vocabulary_get(ngram, unseen) for ngram in ngrams[start:end]]
+                ids.extend(block)
+                counts.append(len(block))
+            counts = np.array(counts, dtype=np.int64)
+            offsets = np.cumsum(counts) - counts
+            rows = self.log_probs[np.array(ids, dtype=np.int64)]
+            scores[active] += np.add.reduceat(rows, offsets, axis=0, dtype=np.float64)
+            scored[active] += counts
+
+            remaining = lengths[active] - scored[active]
+            top = np.partition(scores[active], -2, axis=1)
+            with np.errstate(invalid="ignore"):
+                margin = top[:, -1] - top[:, -2]
+                limit = np.minimum(remaining * self.max_swing, bound)
+                done = (remaining == 0) | (margin > limit)
+            active = active[~done]
+            start = end
+        return np.argmax(scores, axis=1).tolist(), scored.tolist()
+
+
+def classify_stream(model, sentences, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Classifies an iterable of sentences in batches, yielding one class id per sentence.
+    """
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence)
+        if len(batch) >= batch_size:
+            yield from model.classify(batch)
+            batch = []
+    if batch:
+        yield from model.classify(batch)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Chunked prediction through clickhouse-client without intermediate files.
+
+Every chunk of (sentence_id, model_name, sentence) rows is written as TabSeparated data to
+the stdin of one clickhouse-client process, which sends it to the server as an external
+table (--external --file=-) and runs the naiveBayesClassifier query over it. The client
+prints one (sentence_id, predicted_class) row per sentence. Only one chunk is held by the
+server and by this process at a time, and no table is created on the server.
+
+predict_chunks runs the chunks on a pool of concurrent client processes (each with its own
+connection and its own external table, so evaluations never share server state), retries
+failed chunks and returns the predictions in the order of the chunks.
+
+MultiModelClickHousePredictor evaluates several models in one query: the external table
+holds only (sentence_id, sentence) rows, and the query has one naiveBayesClassifier column
+per model, so every sentence is sent and read by the server once for all the models.
+
+The client command is read like predict.sh does it: from the CLICKHOUSE_CLIENT environment
+variable, or else from the CLICKHOUSE_CLIENT= line of config.sh. Any executable that accepts
+the same arguments can stand in for clickhouse-client, see fake_clickhouse_client.py.
+"""
+
+import collections
+import os
+import re
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CONFIG_FILE = "config.sh"
+EXTERNAL_TABLE = "nb_input"
+EXTERNAL_STRUCTURE = "id Int32, model String, input String"
+PREDICT_QUERY = (
+    f"SELECT id, naiveBayesClassifier(model, input) AS predicted_class FROM {EXTERNAL_TABLE} "
+    "FORMAT TSV"
+)
+MULTI_MODEL_STRUCTURE = "id Int32, input String"
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_RETRIES = 2
+# Delay before the first retry of a chunk, doubled for every further retry.
+RETRY_DELAY = 0.5
+TSV_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n"}
+
+
+class ClickHouseClientError(RuntimeError):
+    """
+    Raised when the client exits with an error or returns an unexpected result. retryable
+    is True for failures that another attempt may not repeat: a non-zero exit or a timeout.
+    """
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def load_client_command(client=None, config_file=CONFIG_FILE):
+    """
+    Returns the client command as an argument list.
+
+    Parameters:
+      client (str): Client command line; if None, the CLICKHOUSE_CLIENT environment variable
+        or the CLICKHOUSE_CLIENT= assignment in config_file is used.
+      config_file (str): Shell configuration file read by predict.sh.
+    """
+    if client is None:
+        client = os.environ.get("CLICKHOUSE_CLIENT")
+    if client is None and os.path.isfile(config_file):
+        with open(config_file, "r", encoding="utf-8") as f:
+            for line in f:
+                match = re.match(r"\s*(?:export\s+)?CLICKHOUSE_CLIENT=(.*)", line)
+                if match:
+                    client = " ".join(shlex.split(match.group(1), comments=True))
+    if not client:
+        raise ClickHouseClientError(
+            f"No ClickHouse client configured; set CLICKHOUSE_CLIENT or edit '{config_file}'."
+        )
+    return shlex.split(client)
+
+
+def escape_tsv(value):
+    """
+    Escapes a value for the TabSeparated format.
+    """
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def unescape_tsv(value):
+    """
+    Reverses escape_tsv.
+    """
+    return re.sub(r"\\[\\tn]", lambda m: TSV_ESCAPES[m.group(0)], value)
+
+
+def quote_string(value):
+    """
+    Returns value as a ClickHouse string literal.
+    """
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def multi_model_query(model_names):
+    """
+    Returns the query predicting every sentence of the external table with every model, with
+    one predicted class column per model in the order of model_names.
+    """
+    columns = ", ".join(
+        f"naiveBayesClassifier({quote_string(model_name)}, input) AS predicted_class_{i}"
+        for i, model_name in enumerate(model_names)
+    )
+    return f"SELECT id, {columns} FROM {EXTERNAL_TABLE} FORMAT TSV"
+
+
+class ClickHousePredictor:
+    """
+    Predicts chunks of sentences with one clickhouse-client process per chunk.
+    """
+
+    query = PREDICT_QUERY
+    structure = EXTERNAL_STRUCTURE
+
+    def __init__(self, command, timeout=None):
+        self.client_command = list(command)
+        self.command = self.client_command + [
+            "--query",
+            self.query,
+            "--external",
+            "--file=-",
+            f"--name={EXTERNAL_TABLE}",
+            f"--structure={self.structure}",
+        ]
+        self.timeout = timeout
+
+    def run(self, data):
+        """
+        Runs the client with data (TabSeparated rows of the external table) on its stdin.
+
+        Returns:
+          list: The lines printed by the client.
+
+        Raises:
+          ClickHouseClientError: If the client cannot be run (for example a missing or not
+            executable binary, which is not retryable), times out or fails.
+        """
+        try:
+            result = subprocess.run(
+                self.command,
+                input=data.encode("utf-8"),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired as e:
+            raise ClickHouseClientError(
+                f"'{self.command[0]}' timed out after {self.timeout}s.", retryable=True
+            ) from e
+        except OSError as e:
+            raise ClickHouseClientError(f"Could not run '{self.command[0]}': {e}") from e
+        if result.returncode != 0:
+            message = result.stderr.decode("utf-8", "replace").strip()
+            raise ClickHouseClientError(
+                f"'{self.command[0]}' exited with code {result.returncode}: {message}",
+                retryable=True,
+            )
+        return result.stdout.decode("utf-8").splitlines()
+
+    def predict(self, rows):
+        """
+        Predicts the class of every row.
+
+        Parameters:
+          rows (list): (sentence_id, model_name, sentence) tuples.
+
+        Returns:
+          dict: Mapping of sentence_id to the predicted class (as returned by the server).
+          Rows the client returned no prediction for are missing from it; the callers count
+          them as missing predictions.
+
+        Raises:
+          ClickHouseClientError: If the client fails or prints a line that cannot be parsed.
+        """
+        data = "".join(
+            f"{sentence_id}\t{escape_tsv(model_name)}\t{escape_tsv(sentence)}\n"
+            for sentence_id, model_name, sentence in rows
+        )
+        predictions = {}
+        for line in self.run(data):
+            sentence_id, _, predicted_class = line.partition("\t")
+            try:
+                predictions[int(sentence_id)] = predicted_class.strip()
+            except ValueError:
+                raise ClickHouseClientError(f"Unexpected line in the client output: {line!r}")
+        return predictions
+
+
+class MultiModelClickHousePredictor(ClickHousePredictor):
+    """
+    Predicts chunks of sentences with several models at once, in one query per chunk.
+    """
+
+    structure = MULTI_MODEL_STRUCTURE
+
+    def __init__(self, command, model_names, timeout=None):
+        self.model_names = list(model_names)
+        self.query = multi_model_query(self.model_names)
+        super().__init__(command, timeout)
+
+    def predict(self, rows):
+        """
+        Predicts the class of every row with every model.
+
+        Parameters:
+          rows (list): (sentence_id, sentence) tuples.
+
+        Returns:
+          dict: Mapping of sentence_id to a tuple of predicted classes, one per model. Rows
+          the client returned no prediction for are missing from it.
+
+        Raises:
+          ClickHouseClientError: If the client fails or prints a line that cannot be parsed.
+        """
+        data = "".join(f"{sentence_id}\t{escape_tsv(sentence)}\n" for sentence_id, sentence in rows)
+        predictions = {}
+        for line in self.run(data):
+            parts = line.split("\t")
+            try:
+                if len(parts) != len(self.model_names) + 1:
+                    raise ValueError
+                predictions[int(parts[0])] = tuple(part.strip() for part in parts[1:])
+            except ValueError:
+                raise ClickHouseClientError(f"Unexpected line in the client output: {line!r}")
+        return predictions
+
+
+def predict_with_retries(predictor, rows, retries=DEFAULT_RETRIES, retry_delay=RETRY_DELAY):
+    """
+    Calls predictor.predict(rows), retrying up to retries times on a retryable
+    ClickHouseClientError (a non-zero exit or a timeout of the client).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return predictor.predict(rows)
+        except ClickHouseClientError as e:
+            if attempt == retries or not e.retryable:
+                raise
+            delay = retry_delay * 2**attempt
+            print(f"Warning: {e} Retrying in {delay:.1f}s ({attempt + 1}/{retries}).")
+            time.sleep(delay)
+
+
+def predict_chunks(predictor, chunks, workers=1, retries=DEFAULT_RETRIES):
+    """
+    Predicts chunks on up to workers concurrent clients.
+
+    Parameters:
+      predictor: Object with a predict(rows) method returning a dict of sentence_id to
+        predicted class, such as ClickHousePredictor or MultiModelClickHousePredictor.
+      chunks (iterable): (context, rows) pairs; rows are passed to predictor.predict and
+        context is passed through unchanged.
+      workers (int): Number of chunks predicted at once.
+      retries (int): Number of retries of a failed chunk.
+
+    Yields:
+      tuple: (context, predictions) for every chunk, in the order of chunks. At most
+      2 * workers chunks are in flight or waiting to be yielded.
+
+    Raises:
+      ClickHouseClientError: If a chunk still fails after its retries.
+    """
+    if workers <= 1:
+        for context, rows in chunks:
+            yield context, predict_with_retries(predictor, rows, retries)
+        return
+
+    pool = ThreadPoolExecutor(workers)
+    pending = collections.deque()
+    try:
+        for context, rows in chunks:
+            pending.append((context, pool.submit(predict_with_retries, predictor, rows, retries)))
+            if len(pending) >= 2 * workers:
+                context, future = pending.popleft()
+                yield context, future.result()
+        while pending:
+            context, future = pending.popleft()
+            yield context, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
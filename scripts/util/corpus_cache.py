@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Persistent binary cache of a parsed and validated training corpus.
+
+Compiling a training TSV file with a language mapping writes the valid examples to a cache
+directory as three flat files that are memory-mapped when the cache is read:
+  classes.bin   class ID of every example (uint8, uint16 or uint32, native byte order)
+  offsets.bin   uint64 start offset of every example in payload.bin, plus the end offset
+  payload.bin   the cleaned sentences, UTF-8 encoded, each followed by a newline
+and header.json with the element type, the number of examples per class, the number of
+skipped lines (also by reason) and a content hash of the TSV and mapping files the cache was
+compiled from.
+
+Reading the cache skips the TSV splitting, the language lookup and the encoding of the
+builders: the sentences are decoded directly from slices of the mapped payload, a block of
+sentences at a time (sentences never contain a newline, so a decoded block is split on
+newlines). A cache is recompiled by open_corpus_cache when the content hash of its sources
+changes.
+"""
+
+import array
+import collections
+import hashlib
+import json
+import mmap
+import os
+
+from util.counting import iter_lines, iter_training_examples
+from util.helpers import SkippedLines, load_language_mapping
+
+CACHE_VERSION = 2
+# Number of sentences decoded at once.
+DECODE_BLOCK_SIZE = 4096
+HEADER_FILE = "header.json"
+CLASSES_FILE = "classes.bin"
+OFFSETS_FILE = "offsets.bin"
+PAYLOAD_FILE = "payload.bin"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def source_hash(train_file, lang_mapping_file):
+    """
+    Returns a hex digest of the contents of the training and language mapping files.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in (train_file, lang_mapping_file):
+        digest.update(str(os.path.getsize(path)).encode("ascii") + b"\0")
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _class_typecode(lang_mapping):
+    max_class_id = max(lang_mapping.values(), default=0)
+    if max_class_id < 1 << 8:
+        return "B"
+    if max_class_id < 1 << 16:
+        return "H"
+    return "I"
+
+
+def compile_corpus(train_file, lang_mapping_file, cache_dir, skipped=None, progress=None):
+    """
+    Parses a training TSV file once and writes its valid examples to cache_dir. The invalid
+    lines are counted in skipped (a SkippedLines) if given, and by reason in the header;
+    progress (a Progress) is advanced for every line if given.
+
+    Returns:
+      CorpusCache: The compiled cache.
+    """
+    lang_mapping = load_language_mapping(lang_mapping_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    header_path = os.path.join(cache_dir, HEADER_FILE)
+    # Remove the header first, so an interrupted compilation leaves no valid cache behind.
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    typecode = _class_typecode(lang_mapping)
+    classes = array.array(typecode)
+    offsets = array.array("Q", [0])
+    class_counts = collections.Counter()
+    if skipped is None:
+        skipped = SkippedLines()
+    initial_skipped = collections.Counter(skipped.counts)
+    num_lines = 0
+
+    def counted_lines():
+        nonlocal num_lines
+        for line in iter_lines(train_file):
+            num_lines += 1
+            yield line
+
+    lines = counted_lines()
+    if progress is not None:
+        lines = progress.wrap(lines)
+    position = 0
+    with open(os.path.join(cache_dir, PAYLOAD_FILE), "wb") as payload:
+        examples = iter_training_examples(lines, lang_mapping, class_counts, skipped)
+        for class_id, sentence in examples:
+            data = sentence.encode("utf-8") + b"\n"
+            payload.write(data)
+            position += len(data)
+            classes.append(class_id)
+            offsets.append(position)
+    with open(os.path.join(cache_dir, CLASSES_FILE), "wb") as f:
+        classes.tofile(f)
+    with open(os.path.join(cache_dir, OFFSETS_FILE), "wb") as f:
+        offsets.tofile(f)
+
+    header = {
+        "version": CACHE_VERSION,
+        "source_hash": source_hash(train_file, lang_mapping_file),
+        "train_file": os.path.abspath(train_file),
+        "lang_mapping_file": os.path.abspath(lang_mapping_file),
+        "class_typecode": typecode,
+        "num_examples": len(classes),
+        "skipped_lines": num_lines - len(classes),
+        "skipped_reasons": dict((skipped.counts - initial_skipped).most_common()),
+        "class_examples": {str(c): class_counts[c] for c in sorted(class_counts)},
+    }
+    with open(header_path, "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=2)
+        f.write("\n")
+    return CorpusCache(cache_dir)
+
+
+def _map_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CorpusCache:
+    """
+    Read-only view of a compiled corpus. Provides the example source interface of
+    util.counting.TrainingFile (chunks and iter_examples), so it can be passed to
+    count_training_file as corpus_cache, also to worker processes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, HEADER_FILE), "r", encoding="utf-8") as f:
+            self.header = json.load(f)
+        self.classes = memoryview(_map_file(os.path.join(cache_dir, CLASSES_FILE))).cast(
+            self.header["class_typecode"]
+        )
+        self.offsets = memoryview(_map_file(os.path.join(cache_dir, OFFSETS_FILE))).cast("Q")
+        self.payload = memoryview(_map_file(os.path.join(cache_dir, PAYLOAD_FILE)))
+        num_examples = self.header["num_examples"]
+        if len(self.classes) != num_examples or len(self.offsets) != num_examples + 1:
+            raise ValueError(f"Corpus cache '{cache_dir}' is corrupt.")
+
+    def __getstate__(self):
+        # Worker processes map the files again instead of receiving their contents.
+        return {"cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"])
+
+    def __len__(self):
+        return len(self.classes)
+
+    def chunks(self, num_chunks):
+        """
+        Splits the examples into at most num_chunks (start, end) index ranges.
+        """
+        size = len(self)
+        boundaries = sorted({size * i // num_chunks for i in range(num_chunks)} | {size})
+        return list(zip(boundaries[:-1], boundaries[1:])) or [(0, 0)]
+
+    def iter_examples(self, start=0, end=None, class_counts=None, skipped=None, progress=None):
+        """
+        Yields the (class_id, sentence) examples with index in [start, end). The examples
+        were validated when the cache was compiled, so skipped is not used; progress (a
+        Progress) is advanced for every example if given.
+        """
+        if end is None:
+            end = len(self)
+        if progress is not None:
+            progress.total = end - start
+            progress.unit = "examples"
+            yield from progress.wrap(self._iter_examples(start, end, class_counts))
+        else:
+            yield from self._iter_examples(start, end, class_counts)
+
+    def _iter_examples(self, start, end, class_counts):
+        classes = self.classes[start:end]
+        if class_counts is not None:
+            class_counts.update(classes)
+        payload = self.payload
+        offsets = self.offsets
+        for block_start in range(start, end, DECODE_BLOCK_SIZE):
+            block_end = min(block_start + DECODE_BLOCK_SIZE, end)
+            # Drop the newline after the last sentence before splitting.
+            text = str(payload[offsets[block_start] : offsets[block_end] - 1], "utf-8")
+            yield from zip(classes[block_start - start : block_end - start], text.split("\n"))
+
+
+def open_corpus_cache(cache_dir, train_file, lang_mapping_file, skipped=None):
+    """
+    Opens the corpus cache in cache_dir, compiling it first if it does not exist or was
+    compiled from different contents of train_file or lang_mapping_file. The lines skipped
+    when the cache was compiled are added to skipped (a SkippedLines) if given.
+
+    Returns:
+      CorpusCache: The up-to-date cache.
+    """
+    header_path = os.path.join(cache_dir, HEADER_FILE)
+    if os.path.exists(header_path):
+        with open(header_path, "r", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("version") == CACHE_VERSION and header.get("source_hash") == source_hash(
+            train_file, lang_mapping_file
+        ):
+            cache = CorpusCache(cache_dir)
+            print(f"Using corpus cache '{cache_dir}' ({len(cache)} examples).")
+            if header["skipped_lines"]:
+                print(
+                    f"Note: {header['skipped_lines']} invalid lines were skipped when the cache "
+                    "was compiled."
+                )
+                if skipped is not None:
+                    skipped.counts.update(header.get("skipped_reasons", {}))
+            return cache
+        print(f"Corpus cache '{cache_dir}' is out of date; recompiling.")
+    else:
+        print(f"Compiling corpus cache '{cache_dir}'.")
+    return compile_corpus(train_file, lang_mapping_file, cache_dir, skipped)
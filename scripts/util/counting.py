@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+Shared n-gram counting routines used by the create_ngram_model_* scripts.
+
+Each builder supplies a counting backend, usually a SentenceCounter wrapping its
+`sentence_ngrams(sentence, n)` function that pads a sentence and returns its n-grams; the
+routines here take care of reading and validating the training data, running the backend
+in parallel or within a memory budget and merging the counts keyed by (class_id, ngram).
+
+A counting backend provides:
+  new_counts()                        -> empty counts with items() and len()
+  count(examples, n, counts)          counts an iterable of (class_id, sentence)
+  merge(counts, other_counts)         -> counts with other_counts added, keeping the
+                                         order of first occurrence
+  entry_bytes(counts)                 -> approximate memory used per distinct key
+  batch_size                          sentences counted between memory checks
+and optionally:
+  distinct_keys(counts)               -> number of distinct keys shown in progress lines
+                                         (default: len(counts))
+"""
+
+import collections
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from util.helpers import SkippedLines
+from util.model_io import iter_model_tuples, write_model_counts, write_model_tuples
+from util.sampling import sample_source
+
+# Approximate memory used by one (class_id, ngram) -> count entry of the count table,
+# excluding the ngram object itself.
+ENTRY_OVERHEAD_BYTES = 128
+# Number of sentences counted between two memory checks of the default backend.
+SPILL_CHECK_SENTENCES = 256
+# Maximum number of runs merged at once.
+MAX_MERGE_FAN_IN = 64
+# Read buffer size per run while merging.
+MERGE_BLOCK_SIZE = 64 << 10
+
+
+def iter_training_examples(lines, lang_mapping, class_counts=None, skipped=None):
+    """
+    Parses training lines of the form <language_code> \\t <text ...>.
+
+    Parameters:
+      lines (iterable of str): Lines of the training TSV file.
+      lang_mapping (dict): Mapping of language codes to class IDs.
+      class_counts (collections.Counter): Optional counter of valid examples per class ID,
+        updated in place.
+      skipped (SkippedLines): Optional counter of the invalid lines by reason, updated in
+        place; only the first invalid lines of every reason are printed.
+
+    Yields:
+      tuple: (class_id, sentence) for every valid line.
+    """
+    if skipped is None:
+        skipped = SkippedLines()
+    for line in lines:
+        line = line.rstrip("\n")
+        parts = line.split("\t")
+        if len(parts) < 2:
+            skipped.add("too few columns", f"line '{line}' does not have enough parts")
+            continue
+
+        lang_code = parts[0].strip()
+        sentence = " ".join(parts[1:]).strip()
+        if not sentence:
+            skipped.add("empty sentence", f"empty sentence in line '{line}'")
+            continue
+        if lang_code not in lang_mapping:
+            skipped.add("unknown language", f"language code '{lang_code}' not in mapping")
+            continue
+
+        class_id = lang_mapping[lang_code]
+        if class_counts is not None:
+            class_counts[class_id] += 1
+        yield class_id, sentence
+
+
+class SentenceCounter:
+    """
+    Default counting backend: counts the n-grams returned by a builder's
+    sentence_ngrams(sentence, n) function in a dictionary keyed by (class_id, ngram).
+    """
+
+    batch_size = SPILL_CHECK_SENTENCES
+
+    def __init__(self, sentence_ngrams):
+        self.sentence_ngrams = sentence_ngrams
+
+    def new_counts(self):
+        return collections.defaultdict(int)
+
+    def count(self, examples, n, model_counts):
+        sentence_ngrams = self.sentence_ngrams
+        for class_id, sentence in examples:
+            for ngram in sentence_ngrams(sentence, n):
+                model_counts[(class_id, ngram)] += 1
+
+    def merge(self, model_counts, partial_counts):
+        for key, count in partial_counts.items():
+            model_counts[key] += count
+        return model_counts
+
+    def entry_bytes(self, model_counts):
+        _, ngram = next(iter(model_counts))
+        return ENTRY_OVERHEAD_BYTES + sys.getsizeof(ngram)
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Yields lists of up to batch_size consecutive items of iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def count_ngrams(lines, n, lang_mapping, counter, model_counts=None, class_counts=None):
+    """
+    Counts the n-grams of every valid training line.
+
+    Parameters:
+      lines (iterable of str): Lines of the training TSV file.
+      n (int): N-gram size.
+      lang_mapping (dict): Mapping of language codes to class IDs.
+      counter: Counting backend, e.g. SentenceCounter(sentence_ngrams).
+      model_counts: Optional counts of the backend to accumulate into.
+      class_counts (collections.Counter): Optional counter of examples per class ID.
+
+    Returns:
+      dict: Dictionary with keys (class_id, ngram) and values as counts (or the counts
+      object of the backend).
+    """
+    if model_counts is None:
+        model_counts = counter.new_counts()
+    counter.count(iter_training_examples(lines, lang_mapping, class_counts), n, model_counts)
+    return model_counts
+
+
+def _spill_run(model_counts, run_dir):
+    """
+    Writes the counts sorted by (class_id, ngram) to a new run file in run_dir.
+    """
+    fd, run_file = tempfile.mkstemp(suffix=".run", dir=run_dir)
+    os.close(fd)
+    write_model_counts(model_counts, run_file, sort=True)
+    return run_file
+
+
+def count_ngrams_external(
+    lines, n, lang_mapping, counter, max_memory, run_dir, class_counts=None
+):
+    """
+    Counts n-grams like count_ngrams, but keeps the counts below max_memory bytes by
+    spilling them to sorted run files in run_dir whenever they grow past the budget.
+
+    Returns:
+      tuple: (list of run files, whether the n-grams are text).
+    """
+    examples = iter_training_examples(lines, lang_mapping, class_counts)
+    return count_examples_external(examples, n, counter, max_memory, run_dir)
+
+
+def count_examples_external(examples, n, counter, max_memory, run_dir):
+    """
+    Counts the n-grams of (class_id, sentence) examples within max_memory bytes, see
+    count_ngrams_external.
+    """
+    model_counts = counter.new_counts()
+    run_files = []
+    max_entries = None
+    text = False
+    for batch in iter_batches(examples, counter.batch_size):
+        counter.count(batch, n, model_counts)
+        if max_entries is None and len(model_counts):
+            (_, ngram), _ = next(iter(model_counts.items()))
+            text = isinstance(ngram, str)
+            max_entries = max(1, max_memory // counter.entry_bytes(model_counts))
+        if max_entries is not None and len(model_counts) >= max_entries:
+            run_files.append(_spill_run(model_counts, run_dir))
+            model_counts = counter.new_counts()
+    if len(model_counts):
+        run_files.append(_spill_run(model_counts, run_dir))
+    return run_files, text
+
+
+def merge_sorted_tuples(streams):
+    """
+    Merges streams of (class_id, ngram, count) tuples sorted by (class_id, ngram),
+    summing the counts of equal keys.
+    """
+    current_key = None
+    current_count = 0
+    for class_id, ngram, count in heapq.merge(*streams):
+        key = (class_id, ngram)
+        if key == current_key:
+            current_count += count
+            continue
+        if current_key is not None:
+            yield current_key[0], current_key[1], current_count
+        current_key = key
+        current_count = count
+    if current_key is not None:
+        yield current_key[0], current_key[1], current_count
+
+
+def merge_runs(run_files, run_dir, keep=()):
+    """
+    Reduces a list of sorted run files to at most MAX_MERGE_FAN_IN runs by merging them
+    in groups into new runs in run_dir. Merged runs are removed unless they are in keep.
+    """
+    while len(run_files) > MAX_MERGE_FAN_IN:
+        merged_runs = []
+        for i in range(0, len(run_files), MAX_MERGE_FAN_IN):
+            group = run_files[i : i + MAX_MERGE_FAN_IN]
+            fd, run_file = tempfile.mkstemp(suffix=".run", dir=run_dir)
+            os.close(fd)
+            streams = [iter_model_tuples(f, MERGE_BLOCK_SIZE) for f in group]
+            write_model_tuples(run_file, merge_sorted_tuples(streams))
+            for f in group:
+                if f not in keep:
+                    os.remove(f)
+            merged_runs.append(run_file)
+        run_files = merged_runs
+    return run_files
+
+
+class ExternalCounts:
+    """
+    Model counts stored as sorted run files on disk.
+
+    items() merges the runs on the fly and yields ((class_id, ngram), count) sorted by
+    class_id and then ngram, so it can be passed to serialize_model like a dictionary.
+    The run files are removed when the object is closed or garbage collected.
+    """
+
+    is_sorted = True
+
+    def __init__(self, run_dir, run_files, text):
+        self.run_dir = run_dir
+        self.run_files = merge_runs(run_files, run_dir.name)
+        self.text = text
+
+    def items(self):
+        streams = [iter_model_tuples(f, MERGE_BLOCK_SIZE) for f in self.run_files]
+        for class_id, ngram, count in merge_sorted_tuples(streams):
+            if self.text:
+                ngram = ngram.decode("utf-8")
+            yield (class_id, ngram), count
+
+    def add_model_file(self, model_file, max_memory):
+        """
+        Adds the counts of a binary model file, spilled to sorted runs within max_memory bytes.
+        """
+        run_files = list(self.run_files)
+        model_counts = collections.defaultdict(int)
+        max_entries = None
+        for class_id, ngram, count in iter_model_tuples(model_file):
+            model_counts[(class_id, ngram)] += count
+            if max_entries is None:
+                max_entries = max(1, max_memory // (ENTRY_OVERHEAD_BYTES + sys.getsizeof(ngram)))
+            if len(model_counts) >= max_entries:
+                run_files.append(_spill_run(model_counts, self.run_dir.name))
+                model_counts = collections.defaultdict(int)
+        if model_counts:
+            run_files.append(_spill_run(model_counts, self.run_dir.name))
+        self.run_files = merge_runs(run_files, self.run_dir.name)
+
+    def close(self):
+        self.run_dir.cleanup()
+
+
+def add_model_file_counts(model_counts, model_file, text, max_memory=None):
+    """
+    Adds the counts of an existing binary model file to model counts.
+
+    Dictionary-like counts are combined into a new dictionary that starts with the tuples of
+    the model file in file order, followed by the new keys in their order, like a build over
+    the old training data followed by the new one. ExternalCounts spill the model file into
+    additional sorted runs within max_memory bytes instead.
+
+    Parameters:
+      model_counts: Counts returned by count_training_file.
+      model_file (str): Path to the existing binary model file.
+      text (bool): Whether the n-grams are str (decoded from UTF-8) rather than bytes.
+      max_memory (int): Memory budget in bytes for ExternalCounts.
+
+    Returns:
+      The combined counts.
+    """
+    if isinstance(model_counts, ExternalCounts):
+        model_counts.text = text
+        model_counts.add_model_file(model_file, max_memory)
+        return model_counts
+
+    combined_counts = collections.defaultdict(int)
+    for class_id, ngram, count in iter_model_tuples(model_file):
+        if text:
+            ngram = ngram.decode("utf-8")
+        combined_counts[(class_id, ngram)] += count
+    for key, count in model_counts.items():
+        combined_counts[key] += count
+    return combined_counts
+
+
+def find_chunk_boundaries(path, num_chunks):
+    """
+    Splits a file into at most num_chunks byte ranges that start at line boundaries.
+
+    Returns:
+      list: List of (start, end) byte offsets covering the whole file.
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_chunks):
+            pos = size * i // num_chunks
+            if pos <= boundaries[-1]:
+                continue
+            # Move to the first line starting at or after pos.
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if boundaries[-1] < pos < size:
+                boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_lines(path, start=0, end=None):
+    """
+    Yields the text lines starting inside the byte range [start, end) of a UTF-8 file.
+    Line endings are translated the same way as a file opened in text mode.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for raw in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(raw)
+            line = raw.decode("utf-8")
+            if "\r" in line:
+                yield from io.StringIO(line, newline=None)
+            else:
+                yield line
+
+
+class TrainingFile:
+    """
+    Source of the training examples of a TSV file, split into chunks at line boundaries.
+    A CorpusCache (util.corpus_cache) provides the same interface for a compiled corpus.
+    """
+
+    def __init__(self, path, lang_mapping):
+        self.path = path
+        self.lang_mapping = lang_mapping
+
+    def chunks(self, num_chunks):
+        return find_chunk_boundaries(self.path, num_chunks)
+
+    def iter_examples(self, start=0, end=None, class_counts=None, skipped=None, progress=None):
+        """
+        Yields the (class_id, sentence) examples of the lines starting in [start, end).
+        Invalid lines are counted in skipped (a SkippedLines) if given; progress (a Progress
+        with the file size as total) is advanced for every line of a full read.
+        """
+        if start == 0 and end is None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f
+                if progress is not None:
+                    progress.total = os.path.getsize(self.path)
+                    lines = progress.wrap(f, position=f.buffer.tell)
+                yield from iter_training_examples(lines, self.lang_mapping, class_counts, skipped)
+        else:
+            lines = iter_lines(self.path, start, end)
+            if progress is not None:
+                lines = progress.wrap(lines)
+            yield from iter_training_examples(lines, self.lang_mapping, class_counts, skipped)
+
+
+def _count_chunk(task):
+    source, start, end, n, counter = task
+    class_counts = collections.Counter()
+    skipped = SkippedLines()
+    model_counts = counter.new_counts()
+    counter.count(source.iter_examples(start, end, class_counts, skipped), n, model_counts)
+    return model_counts, class_counts, skipped
+
+
+def _count_chunk_external(task):
+    source, start, end, n, counter, max_memory, run_dir = task
+    class_counts = collections.Counter()
+    skipped = SkippedLines()
+    examples = source.iter_examples(start, end, class_counts, skipped)
+    run_files, text = count_examples_external(examples, n, counter, max_memory, run_dir)
+    return run_files, text, class_counts, skipped
+
+
+def _count_progress(stats, counter=None, counts=None):
+    """
+    Returns the Progress of a serial count for RunStats stats (None without stats), showing
+    the number of distinct keys of counts if given.
+    """
+    if stats is None:
+        return None
+    progress = stats.progress("Counting")
+    if counts is not None:
+        distinct_keys = getattr(counter, "distinct_keys", len)
+        progress.status = lambda: f"{distinct_keys(counts)} distinct keys"
+    return progress
+
+
+def _chunk_progress(stats, num_chunks):
+    return stats.progress("Counting", total=num_chunks, unit="chunks") if stats else None
+
+
+def count_training_file_external(
+    train_file,
+    n,
+    lang_mapping,
+    counter,
+    max_memory,
+    workers=1,
+    tmp_dir=None,
+    class_counts=None,
+    corpus_cache=None,
+    stats=None,
+    source=None,
+):
+    """
+    Counts the n-grams of a training TSV file within a memory budget of max_memory bytes
+    (shared between the workers), spilling sorted runs to a temporary directory.
+
+    Returns:
+      ExternalCounts: Counts that are merged from the runs when iterated.
+    """
+    if source is None:
+        source = corpus_cache or TrainingFile(train_file, lang_mapping)
+    skipped = stats.skipped if stats is not None else None
+    run_dir = tempfile.TemporaryDirectory(prefix="ngram_runs_", dir=tmp_dir)
+    if workers <= 1:
+        progress = _count_progress(stats)
+        examples = source.iter_examples(
+            class_counts=class_counts, skipped=skipped, progress=progress
+        )
+        run_files, text = count_examples_external(
+            examples, n, counter, max_memory, run_dir.name
+        )
+        return ExternalCounts(run_dir, run_files, text)
+
+    worker_memory = max(1, max_memory // workers)
+    tasks = [
+        (source, start, end, n, counter, worker_memory, run_dir.name)
+        for start, end in source.chunks(workers)
+    ]
+    run_files = []
+    text = False
+    progress = _chunk_progress(stats, len(tasks))
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        results = pool.imap(_count_chunk_external, tasks)
+        for i, (chunk_runs, chunk_text, chunk_class_counts, chunk_skipped) in enumerate(results):
+            run_files.extend(chunk_runs)
+            text = text or chunk_text
+            if class_counts is not None:
+                class_counts.update(chunk_class_counts)
+            if skipped is not None:
+                skipped.update(chunk_skipped)
+            if progress is not None:
+                progress.update(i + 1)
+    return ExternalCounts(run_dir, run_files, text)
+
+
+def count_training_file(
+    train_file,
+    n,
+    lang_mapping,
+    counter,
+    workers=1,
+    max_memory=None,
+    tmp_dir=None,
+    class_counts=None,
+    corpus_cache=None,
+    stats=None,
+    max_per_class=None,
+    sample_seed=0,
+    sampled_counts=None,
+):
+    """
+    Counts the n-grams of a training TSV file, optionally in several processes.
+
+    With workers > 1 the file is split into byte-range chunks at line boundaries, each chunk
+    is counted in a separate process and the partial counts are merged in file order, so the
+    result (including the order of first occurrence) is the same as a serial pass.
+
+    With max_memory set, the counts are spilled to sorted runs on disk (in tmp_dir) and an
+    ExternalCounts object is returned instead of a dictionary.
+
+    If class_counts (a collections.Counter) is given, the number of valid training examples
+    of every class ID is added to it.
+
+    If corpus_cache (a CorpusCache compiled from the same file and mapping) is given, the
+    examples are read from the cache instead of parsing the TSV file.
+
+    If stats (a util.helpers.RunStats) is given, the skipped lines are counted in
+    stats.skipped (also those of the worker processes) and progress lines are printed.
+
+    With max_per_class set, only a stratified sample of at most max_per_class examples of
+    every class (seeded by sample_seed, see util.sampling) is counted, which takes an extra
+    pass over the data to find the sample. class_counts still gets the examples of the full
+    data, so the priors do not change; sampled_counts (a collections.Counter) gets the number
+    of counted examples of every class ID if given.
+
+    Returns:
+      dict: Dictionary with keys (class_id, ngram) and values as counts (or the counts
+      object of the backend).
+    """
+    source = corpus_cache or TrainingFile(train_file, lang_mapping)
+    if max_per_class is not None:
+        source, kept_counts = sample_source(source, max_per_class, sample_seed, workers, stats)
+        print(
+            f"Sampled {sum(kept_counts.values())} training examples (at most {max_per_class} "
+            f"of every class, seed {sample_seed})."
+        )
+        if sampled_counts is not None:
+            sampled_counts.update(kept_counts)
+    if max_memory is not None:
+        return count_training_file_external(
+            train_file,
+            n,
+            lang_mapping,
+            counter,
+            max_memory,
+            workers,
+            tmp_dir,
+            class_counts,
+            corpus_cache,
+            stats,
+            source,
+        )
+
+    skipped = stats.skipped if stats is not None else None
+    if workers <= 1:
+        model_counts = counter.new_counts()
+        progress = _count_progress(stats, counter, model_counts)
+        examples = source.iter_examples(
+            class_counts=class_counts, skipped=skipped, progress=progress
+        )
+        counter.count(examples, n, model_counts)
+        return model_counts
+
+    tasks = [(source, start, end, n, counter) for start, end in source.chunks(workers)]
+    model_counts = counter.new_counts()
+    progress = _chunk_progress(stats, len(tasks))
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        results = pool.imap(_count_chunk, tasks)
+        for i, (partial_counts, partial_class_counts, partial_skipped) in enumerate(results):
+            model_counts = counter.merge(model_counts, partial_counts)
+            if class_counts is not None:
+                class_counts.update(partial_class_counts)
+            if skipped is not None:
+                skipped.update(partial_skipped)
+            if progress is not None:
+                progress.update(i + 1)
+    return model_counts
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Confusion matrix of language predictions, and the evaluation report (requires NumPy).
+
+The evaluation keeps only a dense classes x classes confusion matrix and a few per-class
+counters, so memory does not depend on the number of test sentences. Sentences without a
+prediction, with a predicted class that is not in the class mapping, or with a true
+language that is not in the class mapping are counted instead of aborting the evaluation.
+The first two count as errors of their true class; the last are excluded from all metrics.
+"""
+
+import collections
+
+import numpy as np
+
+# Number of (true, predicted) pairs collected before they are added to the matrix.
+ADD_BATCH_SIZE = 65536
+TOP_CONFUSIONS = 10
+
+
+def safe_ratio(numerator, denominator):
+    """
+    Element-wise numerator / denominator, 0 where the denominator is 0.
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+class ConfusionMatrix:
+    """
+    Confusion matrix indexed by the classes of a class mapping in class ID order; rows are
+    the true classes and columns the predicted classes.
+    """
+
+    def __init__(self, class_mapping):
+        self.class_mapping = class_mapping
+        self.labels = sorted(class_mapping, key=lambda lang: class_mapping[lang])
+        self.label_index = {lang: i for i, lang in enumerate(self.labels)}
+        # Predictions are class IDs as strings, as returned by ClickHouse.
+        self.class_index = {str(class_mapping[lang]): i for i, lang in enumerate(self.labels)}
+        size = len(self.labels)
+        self._matrix = np.zeros((size, size), dtype=np.int64)
+        self.missing = np.zeros(size, dtype=np.int64)
+        self.unknown = np.zeros(size, dtype=np.int64)
+        self.unknown_predictions = collections.Counter()
+        self.unknown_labels = collections.Counter()
+        self.extra_predictions = 0
+        self._pending = []
+
+    def add(self, true_lang, predicted_class):
+        """
+        Counts one test sentence; predicted_class is None if it has no prediction.
+        """
+        true_index = self.label_index.get(true_lang)
+        if true_index is None:
+            self.unknown_labels[true_lang] += 1
+        elif predicted_class is None:
+            self.missing[true_index] += 1
+        else:
+            predicted_index = self.class_index.get(predicted_class)
+            if predicted_index is None:
+                self.unknown[true_index] += 1
+                self.unknown_predictions[predicted_class] += 1
+            else:
+                self._pending.append(true_index * len(self.labels) + predicted_index)
+                if len(self._pending) >= ADD_BATCH_SIZE:
+                    self._flush()
+
+    def _flush(self):
+        if self._pending:
+            size = len(self.labels)
+            counts = np.bincount(np.array(self._pending, dtype=np.int64), minlength=size * size)
+            self._matrix += counts.reshape(size, size)
+            self._pending = []
+
+    @property
+    def matrix(self):
+        self._flush()
+        return self._matrix
+
+    def metrics(self):
+        """
+        Returns:
+          dict: Per-class arrays correct, support (true sentences, including missing and
+          unknown predictions), predicted, precision, recall and f1; scalars total, correct
+          and accuracy over all sentences with a known true language.
+        """
+        matrix = self.matrix
+        correct = np.diag(matrix)
+        support = matrix.sum(axis=1) + self.missing + self.unknown
+        predicted = matrix.sum(axis=0)
+        precision = safe_ratio(correct, predicted)
+        recall = safe_ratio(correct, support)
+        f1 = safe_ratio(2 * precision * recall, precision + recall)
+        total = int(support.sum())
+        return {
+            "correct": correct,
+            "support": support,
+            "predicted": predicted,
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "total": total,
+            "total_correct": int(correct.sum()),
+            "accuracy": int(correct.sum()) / total if total > 0 else 0.0,
+        }
+
+    def top_confusions(self, limit=TOP_CONFUSIONS):
+        """
+        Returns the most frequent (true_lang, predicted_lang, count) errors.
+        """
+        errors = self.matrix.copy()
+        np.fill_diagonal(errors, 0)
+        order = np.argsort(errors, axis=None, kind="stable")[::-1][:limit]
+        size = len(self.labels)
+        return [
+            (self.labels[i // size], self.labels[i % size], int(errors.flat[i]))
+            for i in order
+            if errors.flat[i] > 0
+        ]
+
+    def report_lines(self):
+        """
+        Returns the lines of the evaluation report. The accuracy lines come first, in the
+        format of the earlier reports.
+        """
+        m = self.metrics()
+        # Classes with test sentences, by language code.
+        classes = sorted(range(len(self.labels)), key=self.labels.__getitem__)
+        classes = [i for i in classes if m["support"][i] > 0]
+        lines = [f"Overall Accuracy: {m['accuracy'] * 100:.2f}%", "Per-class accuracy:"]
+        for i in classes:
+            lang = self.labels[i]
+            lines.append(
+                f"Language: {lang} (ID: {self.class_mapping[lang]}) - Accuracy: "
+                f"{m['recall'][i] * 100:.2f}% ({m['correct'][i]}/{m['support'][i]}) - "
+                f"Predictions: {m['predicted'][i]}"
+            )
+
+        lines.append("Per-class precision, recall and F1:")
+        for i in classes:
+            lang = self.labels[i]
+            lines.append(
+                f"Language: {lang} (ID: {self.class_mapping[lang]}) - Precision: "
+                f"{m['precision'][i] * 100:.2f}% - Recall: {m['recall'][i] * 100:.2f}% - "
+                f"F1: {m['f1'][i] * 100:.2f}% - Support: {m['support'][i]}"
+            )
+        if classes:
+            lines.append(
+                f"Macro average - Precision: {m['precision'][classes].mean() * 100:.2f}% - "
+                f"Recall: {m['recall'][classes].mean() * 100:.2f}% - "
+                f"F1: {m['f1'][classes].mean() * 100:.2f}%"
+            )
+
+        lines.append("Top confusions (true -> predicted):")
+        confusions = self.top_confusions()
+        for true_lang, predicted_lang, count in confusions:
+            lines.append(f"  {true_lang} -> {predicted_lang}: {count}")
+        if not confusions:
+            lines.append("  none")
+
+        lines.append(f"Missing predictions: {int(self.missing.sum())}")
+        lines.append(
+            f"Predictions of classes not in the mapping: {int(self.unknown.sum())}"
+            + self._format_counter(self.unknown_predictions)
+        )
+        lines.append(
+            f"Test sentences with a language not in the mapping (not scored): "
+            f"{sum(self.unknown_labels.values())}" + self._format_counter(self.unknown_labels)
+        )
+        lines.append(f"Predictions of unknown sentence IDs: {self.extra_predictions}")
+        return lines
+
+    @staticmethod
+    def _format_counter(counter, limit=TOP_CONFUSIONS):
+        if not counter:
+            return ""
+        return " (" + ", ".join(f"{key}: {count}" for key, count in counter.most_common(limit)) + ")"
+
+    def write_tsv(self, path):
+        """
+        Writes the confusion matrix as TSV with the true languages as rows and the predicted
+        languages as columns.
+        """
+        matrix = self.matrix
+        with open(path, "w", encoding="utf-8", newline="\n") as f:
+            f.write("true\\predicted\t" + "\t".join(self.labels) + "\n")
+            for lang, row in zip(self.labels, matrix):
+                f.write(lang + "\t" + "\t".join(str(count) for count in row) + "\n")
+
+
+def _percent(value):
+    return f"{value * 100:.2f}%"
+
+
+def comparison_report_lines(confusions):
+    """
+    Returns the lines of a Markdown report comparing the evaluations of several models on the
+    same test set: a summary table with one row per model, the per-language accuracy of every
+    model side by side, and one accuracy table per model in the format of the tables in
+    models/*/README.md.
+
+    Parameters:
+      confusions (dict): Mapping of model name to its ConfusionMatrix, in report order.
+    """
+    metrics = {name: confusion.metrics() for name, confusion in confusions.items()}
+    lines = [
+        "## Summary",
+        "| Model | Accuracy | Correct Predictions | Total Sentences | Macro F1 | Missing |",
+        "|-------|--------:|--------------------:|----------------:|--------:|--------:|",
+    ]
+    for name, confusion in confusions.items():
+        m = metrics[name]
+        classes = m["support"] > 0
+        macro_f1 = m["f1"][classes].mean() if classes.any() else 0.0
+        lines.append(
+            f"| {name} | {_percent(m['accuracy'])} | {m['total_correct']:,} | {m['total']:,} | "
+            f"{_percent(macro_f1)} | {int(confusion.missing.sum()):,} |"
+        )
+
+    if not confusions:
+        return lines
+    # All the models are evaluated on the same test set with the same class mapping.
+    first_name = next(iter(confusions))
+    labels = confusions[first_name].labels
+    support = metrics[first_name]["support"]
+    classes = sorted(range(len(labels)), key=labels.__getitem__)
+    classes = [i for i in classes if support[i] > 0]
+    lines += [
+        "",
+        "## Per-language accuracy",
+        "| Language | " + " | ".join(confusions) + " |",
+        "|----------|" + "".join("--------:|" for _ in confusions),
+    ]
+    for i in classes:
+        cells = " | ".join(_percent(metrics[name]["recall"][i]) for name in confusions)
+        lines.append(f"| {labels[i]} | {cells} |")
+    cells = " | ".join(f"**{_percent(metrics[name]['accuracy'])}**" for name in confusions)
+    lines.append(f"| **Overall** | {cells} |")
+
+    for name in confusions:
+        m = metrics[name]
+        lines += [
+            "",
+            f"## {name}",
+            "| Language | Accuracy | Correct Predictions | Total Sentences |",
+            "|----------|--------:|--------------------:|----------------:|",
+        ]
+        for i in classes:
+            lines.append(
+                f"| {labels[i]} | {_percent(m['recall'][i])} | {m['correct'][i]:,} | "
+                f"{m['support'][i]:,} |"
+            )
+        lines.append(
+            f"| **Overall** | **{_percent(m['accuracy'])}** | **{m['total_correct']:,}** | "
+            f"**{m['total']:,}** |"
+        )
+    return lines
@@ -1,5 +1,34 @@
 #!/usr/bin/env python3
+import argparse
+import collections
+import contextlib
+import itertools
 import json
+import os
+import sys
+import time
+
+from util.model_meta import (
+    check_compatible_meta,
+    load_model_meta,
+    meta_file_path,
+    model_entry,
+    write_model_meta,
+    write_nb_models_xml,
+)
+from util.pruning import FEATURE_SELECTION_METHODS
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+# Seconds between two progress lines.
+PROGRESS_INTERVAL = 10.0
+# Number of items processed between two checks of the progress clock.
+PROGRESS_CHECK_ITEMS = 1024
+# Number of skipped lines of every reason that are printed; the rest are only counted.
+MAX_SKIP_WARNINGS = 5
 
 
 def load_language_mapping(mapping_file):
@@ -14,3 +43,472 @@ def load_language_mapping(mapping_file):
     """
     with open(mapping_file, "r", encoding="utf-8") as f:
         return json.load(f)
+
+
+def create_builder_argument_parser(description):
+    """
+    Creates the command line parser shared by the create_ngram_model_* scripts.
+
+    Parameters:
+      description (str): Description shown in the usage message.
+
+    Returns:
+      argparse.ArgumentParser: Parser for the builder arguments.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("train_file", help="TSV file with training data.")
+    parser.add_argument("output_file", help="Output file for the serialized model.")
+    parser.add_argument("n", type=int, help="N-gram size.")
+    parser.add_argument("lang_mapping_file", help="JSON file mapping language codes to class IDs.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to count n-grams (default: 1).",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=None,
+        help="Memory budget for the n-gram count table, e.g. 512M or 2G. When the table grows "
+        "past the budget it is spilled to sorted runs on disk that are merged into the output.",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="Directory for the spilled runs of --max-memory (default: system temp directory).",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="Write the tuples sorted by class ID and then n-gram, so the output is deterministic.",
+    )
+    parser.add_argument(
+        "--min-count",
+        type=int,
+        default=1,
+        help="Drop (class, n-gram) tuples seen fewer than this many times (default: 1).",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=None,
+        help="Keep only the K most frequent n-grams of every class.",
+    )
+    parser.add_argument(
+        "--feature-selection",
+        choices=FEATURE_SELECTION_METHODS,
+        default=None,
+        help="Keep only the --num-features most discriminative n-grams, scored by chi-square or "
+        "information gain (requires NumPy; not available with --max-memory).",
+    )
+    parser.add_argument(
+        "--num-features",
+        type=int,
+        default=None,
+        help="Number of n-grams kept by --feature-selection.",
+    )
+    parser.add_argument(
+        "--max-per-class",
+        type=int,
+        default=None,
+        help="Count only a seeded stratified sample of at most N training examples of every "
+        "class; the priors are still computed from all examples.",
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Seed of the hash that samples the examples of --max-per-class (default: 0).",
+    )
+    parser.add_argument(
+        "--corpus-cache",
+        metavar="DIR",
+        default=None,
+        help="Read the training data from a compiled corpus cache in DIR (see compile_corpus.py), "
+        "compiling it first if it is missing or out of date.",
+    )
+    parser.add_argument(
+        "--update",
+        metavar="EXISTING_MODEL",
+        default=None,
+        help="Add the counts of the training file to an existing model (built with its "
+        ".meta.json file) instead of building from scratch. May be the same as output_file.",
+    )
+    parser.add_argument(
+        "--nb-models-xml",
+        default=None,
+        help="Also write an nb_models.xml file for the model with the priors of its training data.",
+    )
+    parser.add_argument(
+        "--model-name",
+        default=None,
+        help="Model name in --nb-models-xml (default: output file name without extension).",
+    )
+    return parser
+
+
+def validate_builder_arguments(parser, args):
+    """
+    Checks the combinations of builder arguments that argparse cannot, exiting with a usage
+    error if they are invalid.
+
+    Parameters:
+      parser (argparse.ArgumentParser): Parser created by create_builder_argument_parser, or
+        the parser of create_ngram_models.py (which has no --max-memory).
+      args (argparse.Namespace): Parsed arguments.
+    """
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.min_count < 1:
+        parser.error("--min-count must be at least 1")
+    if args.top_k is not None and args.top_k < 1:
+        parser.error("--top-k must be at least 1")
+    if args.max_per_class is not None and args.max_per_class < 1:
+        parser.error("--max-per-class must be at least 1")
+    if args.feature_selection:
+        if args.num_features is None or args.num_features < 1:
+            parser.error("--feature-selection requires a positive --num-features")
+        if getattr(args, "max_memory", None) is not None:
+            parser.error(
+                "--feature-selection needs the n-gram vocabulary in memory and cannot be "
+                "combined with --max-memory"
+            )
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            parser.error("--feature-selection requires NumPy")
+    elif args.num_features is not None:
+        parser.error("--num-features requires --feature-selection")
+
+
+def parse_size(size):
+    """
+    Parses a memory size such as "512M" or "2G" (binary units) into bytes.
+
+    Parameters:
+      size (str): Size with an optional K, M or G suffix.
+
+    Returns:
+      int: Size in bytes.
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    number = size.strip().upper().rstrip("B")
+    multiplier = 1
+    if number and number[-1] in units:
+        multiplier = units[number[-1]]
+        number = number[:-1]
+    try:
+        value = int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory size: '{size}'")
+    if value <= 0:
+        raise argparse.ArgumentTypeError("memory size must be positive")
+    return value
+
+
+def load_update_meta(parser, args, mode, lang_mapping):
+    """
+    Loads and checks the metadata of the model given with --update, exiting with a usage
+    error if it is missing or incompatible with the build.
+
+    Parameters:
+      parser (argparse.ArgumentParser): Parser created by create_builder_argument_parser.
+      args (argparse.Namespace): Parsed arguments.
+      mode (str): Mode of the builder.
+      lang_mapping (dict): Mapping of language codes to class IDs.
+
+    Returns:
+      dict: Metadata of the existing model, or None without --update.
+    """
+    if not args.update:
+        return None
+    try:
+        meta = load_model_meta(args.update)
+        check_compatible_meta(meta, mode, args.n, lang_mapping, args.update)
+    except FileNotFoundError:
+        parser.error(
+            f"--update needs the metadata file '{meta_file_path(args.update)}' written by the "
+            "build of the existing model"
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    if meta["pruning"] != "no pruning":
+        print(
+            f"Warning: '{args.update}' was pruned ({meta['pruning']}); "
+            "the counts of the pruned n-grams are lost."
+        )
+    return meta
+
+
+def write_build_metadata(args, mode, lang_mapping, class_counts, pruned_counts, update_meta=None):
+    """
+    Writes the metadata file of a built model and, with --nb-models-xml, its nb_models.xml.
+
+    Parameters:
+      args (argparse.Namespace): Parsed builder arguments.
+      mode (str): Mode of the builder.
+      lang_mapping (dict): Mapping of language codes to class IDs.
+      class_counts (dict): Number of training examples per class ID.
+      pruned_counts (PrunedCounts): Counts that were written.
+      update_meta (dict): Metadata of the model given with --update.
+    """
+    pruning = pruned_counts.describe()
+    if update_meta is not None:
+        lang_mapping = {**update_meta["lang_mapping"], **lang_mapping}
+        if update_meta["pruning"] != "no pruning":
+            pruning = f"{update_meta['pruning']} before update, then {pruning}"
+    write_model_meta(args.output_file, mode, args.n, lang_mapping, class_counts, pruning)
+    if args.nb_models_xml:
+        entry = model_entry(args.output_file, mode, args.n, class_counts, args.model_name)
+        write_nb_models_xml(args.nb_models_xml, [entry])
+        print(f"Written nb_models.xml with the class priors to '{args.nb_models_xml}'.")
+
+
+def stats_file_path(output_file):
+    """
+    Returns the path of the stats file written next to an output file: the output file name
+    with its extension replaced by .stats.json.
+    """
+    return os.path.splitext(output_file)[0] + ".stats.json"
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident set size of this process or of its largest finished child
+    process in bytes, or None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _format_bytes(size):
+    return "n/a" if size is None else f"{size / (1 << 20):.1f} MB"
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class SkippedLines:
+    """
+    Counts of skipped input lines by reason. The first max_warnings lines of every reason are
+    printed as warnings, the others are only counted and summarized by report(), so a file
+    with many bad lines does not flood the output.
+    """
+
+    def __init__(self, max_warnings=MAX_SKIP_WARNINGS):
+        self.max_warnings = max_warnings
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, reason, message):
+        """
+        Counts a skipped line; message describes the line in the printed warning.
+        """
+        self.counts[reason] += 1
+        count = self.counts[reason]
+        if count <= self.max_warnings:
+            print(f"Warning: {message}; skipping.")
+            if count == self.max_warnings:
+                print(f"Note: further lines skipped because of '{reason}' are only counted.")
+
+    def update(self, other):
+        """
+        Adds the counts of another SkippedLines, e.g. of a worker process.
+        """
+        self.counts.update(other.counts)
+
+    def report(self):
+        """
+        Prints the number of skipped lines by reason, if any were skipped.
+        """
+        if self.counts:
+            reasons = ", ".join(f"{count} {reason}" for reason, count in self.counts.most_common())
+            print(f"Skipped {len(self)} lines ({reasons}).")
+
+    def as_dict(self):
+        return dict(self.counts.most_common())
+
+
+class Progress:
+    """
+    Prints a progress line at most every interval seconds while a long loop runs: the number
+    of items done, their rate, the percentage done and the ETA if the total is known, the
+    peak RSS and an optional status, such as the number of distinct keys counted so far.
+
+    Parameters:
+      label (str): Name of the work shown at the start of the line.
+      total (int): Total amount of work, in items or in the units of the position passed
+        to wrap() or update(); None if unknown.
+      unit (str): Name of the items.
+      interval (float): Minimum number of seconds between two progress lines.
+    """
+
+    def __init__(self, label, total=None, unit="lines", interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.status = None
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def wrap(self, iterable, position=None):
+        """
+        Yields the items of iterable, counting them and printing progress lines.
+
+        Parameters:
+          iterable: Items to pass through.
+          position (callable): Optional function that returns the current position in the
+            units of total (e.g. the byte offset in the input file), for inputs where the
+            total number of items is not known in advance.
+        """
+        iterator = iter(iterable)
+        while True:
+            # Passing the items on in batches keeps the overhead per item low.
+            batch = list(itertools.islice(iterator, PROGRESS_CHECK_ITEMS))
+            if not batch:
+                return
+            yield from batch
+            self.done += len(batch)
+            self.update(position=position() if position is not None else None)
+
+    def update(self, done=None, position=None):
+        """
+        Sets the number of items done and prints a progress line if the interval has passed.
+        """
+        if done is not None:
+            self.done = done
+        now = time.perf_counter()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        parts = [f"{self.done} {self.unit}", f"{self.done / elapsed:.0f} {self.unit}/s"]
+        if self.total:
+            current = self.done if position is None else position
+            fraction = min(1.0, current / self.total)
+            parts.insert(0, f"{fraction * 100:.1f}%")
+            if fraction > 0:
+                parts.append(f"ETA {_format_duration(elapsed * (1 - fraction) / fraction)}")
+        if self.status is not None:
+            parts.append(self.status())
+        parts.append(f"peak RSS {_format_bytes(peak_rss_bytes())}")
+        print(f"{self.label}: " + ", ".join(parts), flush=True)
+
+
+class RunStats:
+    """
+    Instrumentation of a script run: the wall time of its stages, counters such as the
+    number of examples and distinct keys, skipped lines by reason and the peak RSS. The stats
+    are printed as a summary and written as a machine-readable JSON file.
+
+    Parameters:
+      script (str): Name of the script, stored in the stats file.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.stages = {}
+        self.counters = {}
+        self.skipped = SkippedLines()
+        self.started = time.time()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the wall time of its block to the stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def progress(self, label, total=None, unit="lines"):
+        """
+        Returns a Progress for a loop of the run.
+        """
+        return Progress(label, total, unit)
+
+    def set(self, **counters):
+        """
+        Sets counters of the run; values must be JSON serializable.
+        """
+        self.counters.update(counters)
+
+    def as_dict(self):
+        return {
+            "script": self.script,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            "total_seconds": round(time.perf_counter() - self.start, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "peak_rss_bytes": peak_rss_bytes(),
+            "counters": self.counters,
+            "skipped_lines": self.skipped.as_dict(),
+        }
+
+    def print_summary(self):
+        """
+        Prints the skipped lines, the stage times and the peak RSS.
+        """
+        self.skipped.report()
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        print(
+            f"Time: {time.perf_counter() - self.start:.2f}s ({stages or 'no stages'}), "
+            f"peak RSS: {_format_bytes(peak_rss_bytes())}."
+        )
+
+    def write(self, stats_file):
+        """
+        Prints the summary and writes the stats as JSON to stats_file.
+        """
+        self.print_summary()
+        with open(stats_file, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=2)
+            f.write("\n")
+        print(f"Written run stats to '{stats_file}'.")
+
+
+def write_build_stats(args, stats, class_counts, pruned_counts, sampled_counts=None):
+    """
+    Writes the stats of a builder run next to the built model.
+
+    Parameters:
+      args (argparse.Namespace): Parsed builder arguments.
+      stats (RunStats): Stats of the run.
+      class_counts (dict): Number of training examples per class ID.
+      pruned_counts (PrunedCounts): Counts that were written.
+      sampled_counts (dict): Number of counted examples per class ID with --max-per-class.
+    """
+    if args.max_per_class is not None and sampled_counts is not None:
+        stats.set(
+            max_per_class=args.max_per_class,
+            sample_seed=args.sample_seed,
+            sampled_examples=sum(sampled_counts.values()),
+        )
+    stats.set(
+        n=args.n,
+        workers=args.workers,
+        examples=sum(class_counts.values()),
+        distinct_keys=pruned_counts.input_tuples,
+        tuples=pruned_counts.output_tuples,
+        model_bytes=os.path.getsize(args.output_file),
+    )
+    stats.write(stats_file_path(args.output_file))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Reading and writing of the binary model format used by ClickHouse's naiveBayesClassifier.
+
+Format for each tuple:
+  <unsigned int: class_id>
+  <unsigned int: length of ngram in bytes>
+  <ngram in utf-8 bytes>
+  <unsigned int: count>
+"""
+
+import struct
+
+HEADER = struct.Struct("II")
+COUNT = struct.Struct("I")
+READ_BLOCK_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def iter_model_tuples(model_file, block_size=READ_BLOCK_SIZE):
+    """
+    Streams the tuples of a binary model file.
+
+    Parameters:
+      model_file (str): Path to the binary model file.
+      block_size (int): Number of bytes read from the file at a time.
+
+    Yields:
+      tuple: (class_id, ngram_bytes, count) in file order.
+    """
+    with open(model_file, "rb") as f:
+        buffer = b""
+        pos = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            buffer = buffer[pos:] + block
+            pos = 0
+            end = len(buffer)
+            while pos + HEADER.size <= end:
+                class_id, length = HEADER.unpack_from(buffer, pos)
+                count_pos = pos + HEADER.size + length
+                if count_pos + COUNT.size > end:
+                    break
+                ngram = buffer[pos + HEADER.size : count_pos]
+                (count,) = COUNT.unpack_from(buffer, count_pos)
+                pos = count_pos + COUNT.size
+                yield class_id, ngram, count
+        if pos != len(buffer):
+            raise ValueError(f"Truncated tuple at the end of model file '{model_file}'.")
+
+
+def write_model_counts(model_counts, model_file, sort=False, buffer_size=WRITE_BUFFER_SIZE):
+    """
+    Serializes model counts to a binary model file without building the whole output in memory.
+
+    Each tuple is packed with one precompiled struct (cached per n-gram length) into a reused
+    buffer of buffer_size bytes, which is flushed to the file whenever it is full.
+
+    Parameters:
+      model_counts: Dictionary (or object with items()) with keys (class_id, ngram) and
+        counts as values. N-grams may be bytes or str (written as UTF-8).
+      model_file (str): Path to the output binary model file.
+      sort (bool): Write the tuples sorted by class_id and then n-gram, making the output
+        independent of the counting order. Count objects with a true is_sorted attribute
+        are already in this order.
+      buffer_size (int): Size of the write buffer in bytes.
+
+    Returns:
+      int: Number of tuples written.
+    """
+    items = model_counts.items()
+    if sort and not getattr(model_counts, "is_sorted", False):
+        # Code point order of str n-grams is the same as the byte order of their UTF-8 encoding.
+        items = sorted(items)
+
+    # "=" packs the native byte order of the "I" fields without alignment padding.
+    tuple_structs = {}
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    pos = 0
+    total = 0
+    with open(model_file, "wb") as f_out:
+        for (class_id, ngram), count in items:
+            if type(ngram) is str:
+                ngram = ngram.encode("utf-8")
+            length = len(ngram)
+            tuple_struct = tuple_structs.get(length)
+            if tuple_struct is None:
+                tuple_struct = tuple_structs[length] = struct.Struct(f"=II{length}sI")
+            tuple_size = tuple_struct.size
+            if pos + tuple_size > buffer_size:
+                f_out.write(view[:pos])
+                pos = 0
+                if tuple_size > buffer_size:
+                    f_out.write(tuple_struct.pack(class_id, length, ngram, count))
+                    total += 1
+                    continue
+            tuple_struct.pack_into(buffer, pos, class_id, length, ngram, count)
+            pos += tuple_size
+            total += 1
+        f_out.write(view[:pos])
+    return total
+
+
+def write_model_tuples(model_file, tuples, buffer_size=WRITE_BUFFER_SIZE):
+    """
+    Writes (class_id, ngram_bytes, count) tuples to a binary model file, see write_model_counts.
+
+    Returns:
+      int: Number of tuples written.
+    """
+
+    class TupleItems:
+        def items(self):
+            for class_id, ngram, count in tuples:
+                yield (class_id, ngram), count
+
+    return write_model_counts(TupleItems(), model_file, buffer_size=buffer_size)
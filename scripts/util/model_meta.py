@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Metadata files written next to binary models, and nb_models.xml reading and generation.
+
+Every build writes <model>.meta.json next to <model>.bin with the mode, n, the language
+mapping, the number of training examples of every class and the pruning applied. The
+example counts are what the class priors of nb_models.xml are computed from, and they are
+what allows a model to be updated with new training data (or merged with other shards)
+without reading the training data it was built from again.
+"""
+
+import json
+import os
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+META_SUFFIX = ".meta.json"
+# Directory the models are installed to on the ClickHouse servers.
+DEFAULT_MODEL_DIR = "/etc/clickhouse-server/config.d"
+# Laplace smoothing parameter of a model without <alpha>.
+DEFAULT_ALPHA = 1.0
+
+
+def meta_file_path(model_file):
+    """
+    Returns the path of the metadata file of a model, e.g. lang_byte_3.meta.json for
+    lang_byte_3.bin.
+    """
+    return os.path.splitext(model_file)[0] + META_SUFFIX
+
+
+def write_model_meta(model_file, mode, n, lang_mapping, class_counts, pruning="no pruning"):
+    """
+    Writes the metadata file of a model.
+
+    Parameters:
+      model_file (str): Path to the binary model file.
+      mode (str): byte, codepoint or token.
+      n (int): N-gram size.
+      lang_mapping (dict): Mapping of language codes to class IDs.
+      class_counts (dict): Number of training examples per class ID.
+      pruning (str): Description of the pruning applied to the model.
+    """
+    meta = {
+        "mode": mode,
+        "n": n,
+        "lang_mapping": lang_mapping,
+        "class_examples": {str(c): class_counts[c] for c in sorted(class_counts)},
+        "pruning": pruning,
+    }
+    with open(meta_file_path(model_file), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def load_model_meta(model_file):
+    """
+    Loads the metadata file of a model.
+
+    Returns:
+      dict: The metadata, with class_examples keyed by int class ID.
+
+    Raises:
+      FileNotFoundError: If the model has no metadata file.
+    """
+    with open(meta_file_path(model_file), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["class_examples"] = {int(c): count for c, count in meta["class_examples"].items()}
+    return meta
+
+
+def check_compatible_meta(meta, mode, n, lang_mapping, model_file):
+    """
+    Checks that a model described by meta can be combined with a model of the given mode,
+    n and language mapping.
+
+    Raises:
+      ValueError: If the mode, n or the class ID of a shared language code differ.
+    """
+    if meta["mode"] != mode or meta["n"] != n:
+        raise ValueError(
+            f"'{model_file}' is a {meta['mode']} model with n={meta['n']}, "
+            f"expected a {mode} model with n={n}."
+        )
+    for lang_code, class_id in meta["lang_mapping"].items():
+        if lang_mapping.get(lang_code, class_id) != class_id:
+            raise ValueError(
+                f"Language code '{lang_code}' has class ID {class_id} in '{model_file}' "
+                f"but {lang_mapping[lang_code]} in the language mapping."
+            )
+    used = {class_id: lang_code for lang_code, class_id in lang_mapping.items()}
+    for lang_code, class_id in meta["lang_mapping"].items():
+        if used.get(class_id, lang_code) != lang_code:
+            raise ValueError(
+                f"Class ID {class_id} is '{lang_code}' in '{model_file}' "
+                f"but '{used[class_id]}' in the language mapping."
+            )
+
+
+def compute_priors(class_counts):
+    """
+    Returns the prior probability of every class ID with at least one training example.
+    """
+    total = sum(class_counts.values())
+    return {c: class_counts[c] / total for c in sorted(class_counts) if class_counts[c] > 0}
+
+
+def model_entry(model_file, mode, n, class_counts, name=None, model_dir=DEFAULT_MODEL_DIR):
+    """
+    Returns the nb_models.xml entry of a model, installed as model_dir/<basename>.
+    """
+    basename = os.path.basename(model_file)
+    return {
+        "name": name or os.path.splitext(basename)[0],
+        "mode": mode,
+        "path": f"{model_dir}/{basename}",
+        "n": n,
+        "priors": compute_priors(class_counts),
+    }
+
+
+def load_model_configs(xml_file):
+    """
+    Reads the <model> entries of an nb_models.xml file.
+
+    The model path is resolved relative to the XML file when the configured path (usually
+    under /etc/clickhouse-server/config.d/) does not exist locally.
+
+    Returns:
+      dict: Mapping of model name to a dict with keys name, mode, path, n, alpha and priors
+      (mapping class id to prior probability, empty if not configured).
+    """
+    configs = {}
+    root = ET.parse(xml_file).getroot()
+    for model in root.iter("model"):
+        path = model.findtext("path").strip()
+        if not os.path.exists(path):
+            path = os.path.join(os.path.dirname(xml_file), os.path.basename(path))
+        priors = {
+            int(prior.findtext("class")): float(prior.findtext("value"))
+            for prior in model.iter("prior")
+        }
+        alpha = model.findtext("alpha")
+        name = model.findtext("name").strip()
+        configs[name] = {
+            "name": name,
+            "mode": model.findtext("mode").strip(),
+            "path": path,
+            "n": int(model.findtext("n")),
+            "alpha": float(alpha) if alpha is not None else DEFAULT_ALPHA,
+            "priors": priors,
+        }
+    return configs
+
+
+def write_nb_models_xml(xml_file, models):
+    """
+    Writes an nb_models.xml configuration file in the format of the shipped models.
+
+    Parameters:
+      xml_file (str): Output path.
+      models (list): Entries with keys name, mode, path, n and priors (mapping class ID
+        to probability), see model_entry(), and optionally alpha.
+    """
+    lines = ["<clickhouse>", "    <nb_models>"]
+    for model in models:
+        lines += [
+            "        <model>",
+            f"            <mode>{escape(model['mode'])}</mode>",
+            f"            <name>{escape(model['name'])}</name>",
+            f"            <path>{escape(model['path'])}</path>",
+            f"            <n>{model['n']}</n>",
+        ]
+        if model.get("alpha", DEFAULT_ALPHA) != DEFAULT_ALPHA:
+            lines.append(f"            <alpha>{model['alpha']}</alpha>")
+        lines.append("            <priors>")
+        for class_id, prior in sorted(model["priors"].items()):
+            lines += [
+                "                <prior>",
+                f"                    <class>{class_id}</class>",
+                f"                    <value>{prior:.6f}</value>",
+                "                </prior>",
+            ]
+        lines += ["            </priors>", "        </model>"]
+    lines += ["    </nb_models>", "</clickhouse>"]
+    with open(xml_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
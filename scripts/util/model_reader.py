@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped reader for binary model files with a hash index (requires NumPy).
+
+The file is mapped read-only and indexed once: the offset, class id, n-gram length, count and
+a 64-bit FNV-1a hash of the n-gram of every tuple are collected into NumPy arrays, and the
+tuples are sorted by hash. Lookups binary-search the hash and compare the candidate n-grams
+against the mapped file, so the payload is never copied into Python objects.
+
+Models with a fixed n-gram length (all byte models) are indexed without a Python loop through
+strided views of the mapping. Other models (most code point and token models) walk the length
+headers once in a Python loop, one length read per tuple, and gather the rest vectorized: the
+offset of a tuple depends on the lengths of all tuples before it, so the walk cannot be
+vectorized without treating every byte of the file as a possible tuple header.
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV_PRIME = np.uint64(0x100000001B3)
+HEADER_SIZE = 8
+COUNT_SIZE = 4
+LENGTH = struct.Struct("I")
+
+
+def fnv1a(ngram):
+    """
+    Returns the 64-bit FNV-1a hash of a bytes object (same values as the vectorized version).
+    """
+    h = 0xCBF29CE484222325
+    for byte in ngram:
+        h = ((h ^ byte) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+def _fnv1a_rows(rows):
+    """
+    Hashes every row of a [k, length] uint8 matrix.
+    """
+    hashes = np.full(rows.shape[0], FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in rows.T:
+            hashes ^= column
+            hashes *= FNV_PRIME
+    return hashes
+
+
+class ModelReader:
+    """
+    Read-only view of a binary model file.
+
+    Attributes (NumPy arrays in file order):
+      offsets: Byte offset of every tuple.
+      lengths: N-gram length in bytes of every tuple.
+      class_ids: Class id of every tuple.
+      counts: Count of every tuple.
+      hashes: FNV-1a hash of the n-gram of every tuple.
+    """
+
+    def __init__(self, model_file):
+        self.model_file = model_file
+        with open(model_file, "rb") as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file.
+                self.mm = b""
+        self.data = np.frombuffer(self.mm, dtype=np.uint8)
+        if not self._index_fixed_width():
+            self._index_variable_width()
+        self.order = np.argsort(self.hashes, kind="stable")
+        self.sorted_hashes = self.hashes[self.order]
+        self.num_classes = int(self.class_ids.max()) + 1 if len(self.class_ids) else 0
+
+    def _index_fixed_width(self):
+        size = len(self.data)
+        if size < HEADER_SIZE:
+            return False
+        (length,) = LENGTH.unpack_from(self.mm, 4)
+        record_size = HEADER_SIZE + length + COUNT_SIZE
+        if size % record_size != 0:
+            return False
+        num_tuples = size // record_size
+
+        def column(offset):
+            return np.ndarray(
+                (num_tuples,), dtype=np.uint32, buffer=self.mm, offset=offset, strides=(record_size,)
+            )
+
+        # If the length at every multiple of record_size is the same, every tuple starts there.
+        if not np.all(column(4) == length):
+            return False
+        self.offsets = np.arange(num_tuples, dtype=np.int64) * record_size
+        self.lengths = np.full(num_tuples, length, dtype=np.int64)
+        self.class_ids = column(0).astype(np.int64)
+        self.counts = column(HEADER_SIZE + length).astype(np.int64)
+        rows = np.ndarray(
+            (num_tuples, length),
+            dtype=np.uint8,
+            buffer=self.mm,
+            offset=HEADER_SIZE,
+            strides=(record_size, 1),
+        )
+        self.hashes = _fnv1a_rows(rows)
+        return True
+
+    def _index_variable_width(self):
+        # The tuple offsets are found sequentially (see the module docstring); the class ids,
+        # lengths, counts and hashes are then gathered per n-gram length with NumPy.
+        mm = self.mm
+        size = len(mm)
+        unpack_length = LENGTH.unpack_from
+        offsets = []
+        pos = 0
+        while pos < size:
+            offsets.append(pos)
+            pos += HEADER_SIZE + unpack_length(mm, pos + 4)[0] + COUNT_SIZE
+        if pos != size:
+            raise ValueError(f"Truncated tuple at the end of model file '{self.model_file}'.")
+
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.class_ids = self._gather_uint32(self.offsets)
+        self.lengths = self._gather_uint32(self.offsets + 4)
+        self.counts = self._gather_uint32(self.offsets + HEADER_SIZE + self.lengths)
+        self.hashes = np.empty(len(offsets), dtype=np.uint64)
+        for length in np.unique(self.lengths).tolist():
+            selected = np.flatnonzero(self.lengths == length)
+            starts = self.offsets[selected] + HEADER_SIZE
+            rows = self.data[starts[:, None] + np.arange(length, dtype=np.int64)]
+            self.hashes[selected] = _fnv1a_rows(rows)
+
+    def _gather_uint32(self, positions):
+        raw = self.data[positions[:, None] + np.arange(4, dtype=np.int64)]
+        return np.ascontiguousarray(raw).view(np.uint32).ravel().astype(np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _matches(self, ngram):
+        """
+        Yields the indices (in file order) of the tuples whose n-gram equals ngram.
+        """
+        if isinstance(ngram, str):
+            ngram = ngram.encode("utf-8")
+        h = np.uint64(fnv1a(ngram))
+        lo = np.searchsorted(self.sorted_hashes, h, side="left")
+        hi = np.searchsorted(self.sorted_hashes, h, side="right")
+        for i in self.order[lo:hi].tolist():
+            start = int(self.offsets[i]) + HEADER_SIZE
+            if self.lengths[i] == len(ngram) and self.mm[start : start + len(ngram)] == ngram:
+                yield i
+
+    def count(self, class_id, ngram):
+        """
+        Returns the count of ngram (bytes or str) for class_id, 0 if it is not in the model.
+        """
+        for i in self._matches(ngram):
+            if self.class_ids[i] == class_id:
+                return int(self.counts[i])
+        return 0
+
+    def counts_per_class(self, ngram):
+        """
+        Returns a vector with the count of ngram (bytes or str) for every class.
+        """
+        vector = np.zeros(self.num_classes, dtype=np.int64)
+        for i in self._matches(ngram):
+            vector[self.class_ids[i]] += self.counts[i]
+        return vector
+
+    def ngram(self, i):
+        """
+        Returns the n-gram bytes of the i-th tuple.
+        """
+        start = int(self.offsets[i]) + HEADER_SIZE
+        return bytes(self.mm[start : start + int(self.lengths[i])])
+
+    def stats(self):
+        """
+        Returns whole-file statistics: number of tuples, distinct n-grams (by 64-bit hash),
+        and the number of tuples and total count per class.
+        """
+        return {
+            "tuples": len(self),
+            "distinct_ngrams": int(np.count_nonzero(np.diff(self.sorted_hashes)) + 1)
+            if len(self)
+            else 0,
+            "tuples_per_class": np.bincount(self.class_ids, minlength=self.num_classes).tolist(),
+            "total_counts_per_class": np.bincount(
+                self.class_ids, weights=self.counts, minlength=self.num_classes
+            )
+            .astype(np.int64)
+            .tolist(),
+        }
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+NumPy counting backends for n-gram models (requires NumPy).
+
+Instead of slicing every padded sentence into bytes or str objects, a batch of padded
+sentences is concatenated into one array of units and every n-gram window that lies inside
+a sentence is packed big-endian into a key of one or more uint64 words (a row of a 2-D
+array). The keys are counted per class with a sort and run-length counting, and the
+per-batch results are kept as NumPy arrays (columns of class ids, keys, counts and first
+occurrences) that are compacted the same way as they accumulate.
+
+For byte models the units are the bytes themselves, packed with 8 bits each into one word
+(n <= 8). For code point and token models every distinct code point or token is interned to
+an integer id, and the ids are packed with min(32, 64 // n) bits each, so that the key of
+an n-gram fits one word. When the vocabulary outgrows these bits (e.g. more than 2^21
+distinct tokens for trigrams), the keys counted so far are re-packed with 32 bits per id,
+two ids per word. The n-gram strings are only built from the ids when the counts are
+serialized.
+
+Every distinct (class_id, key) remembers the position of its first occurrence in the
+training data, so items() yields the tuples in the same order, with the same counts, as
+the dictionary built by the default backend.
+
+The batches are sized for speed, not for a memory budget: a byte batch of BATCH_SENTENCES
+sentences allocates temporary arrays of a few hundred bytes per n-gram that the spill check
+of --max-memory does not see, and the interned backends also keep their whole vocabulary in
+memory, so the builders reject these engines with --max-memory.
+"""
+
+import itertools
+
+import numpy as np
+
+from util.counting import iter_batches
+
+MAX_N = 8
+# Bits of an interned unit id in the keys of unigrams, and of every n-gram once the
+# vocabulary outgrows the bits that fit an n-gram into one word.
+MAX_UNIT_BITS = 32
+# Number of sentences vectorized at once.
+BATCH_SENTENCES = 16384
+# Number of sentences counted at once by the interned backends, which keep more temporary
+# arrays per unit than the byte backend.
+INTERNED_BATCH_SENTENCES = 2048
+# Approximate memory per distinct key of one word: four arrays plus the temporaries of a
+# compaction.
+ENTRY_BYTES = 96
+# Approximate memory per further word of a key and its temporaries.
+WORD_ENTRY_BYTES = 24
+# Number of keys decoded to n-gram strings at once.
+DECODE_BLOCK_SIZE = 65536
+
+
+def _reduce_runs(class_ids, keys, counts, first):
+    """
+    Sums the counts of equal (class_id, key) pairs and keeps their earliest first occurrence.
+    """
+    if len(keys) == 0:
+        return class_ids, keys, counts, first
+    words = keys.shape[1]
+    # Bits actually used by one-word keys, which is often less than the bits reserved for them.
+    shift = int(keys[:, 0].max()).bit_length() if words == 1 else 64
+    if shift < 64 and int(class_ids.max()) < (1 << (64 - shift)):
+        # Sort a single uint64 with the class id above the key.
+        pairs = (class_ids.astype(np.uint64) << np.uint64(shift)) | keys[:, 0]
+        order = np.argsort(pairs)
+        pairs = pairs[order]
+        boundaries = pairs[1:] != pairs[:-1]
+    else:
+        # np.lexsort sorts by its last column first.
+        order = np.lexsort([keys[:, w] for w in reversed(range(words))] + [class_ids])
+        sorted_class_ids = class_ids[order]
+        boundaries = sorted_class_ids[1:] != sorted_class_ids[:-1]
+        del sorted_class_ids
+        for w in range(words):
+            sorted_words = keys[order, w]
+            boundaries |= sorted_words[1:] != sorted_words[:-1]
+        del sorted_words
+    # The order inside a run does not matter: its first occurrence is the minimum position.
+    run_starts = np.flatnonzero(np.concatenate(([True], boundaries)))
+    run_heads = order[run_starts]
+    return (
+        class_ids[run_heads],
+        keys[run_heads],
+        np.add.reduceat(counts[order], run_starts),
+        np.minimum.reduceat(first[order], run_starts),
+    )
+
+
+def pad_units(ids, lengths, padding, start_id, end_id):
+    """
+    Lays out padded sentences: padding start ids, the ids of the sentence, padding end ids.
+
+    Parameters:
+      ids (np.ndarray): Unit ids of all sentences, concatenated.
+      lengths (np.ndarray): Number of units of every sentence.
+
+    Returns:
+      tuple: (units, padded_lengths) of the padded sentences.
+    """
+    padded_lengths = lengths + 2 * padding
+    offsets = np.arange(int(padded_lengths.sum()), dtype=np.int64) - np.repeat(
+        np.cumsum(padded_lengths) - padded_lengths, padded_lengths
+    )
+    sentence_lengths = np.repeat(lengths, padded_lengths)
+    units = np.full(len(offsets), start_id, dtype=np.uint64)
+    units[offsets >= padding + sentence_lengths] = end_id
+    units[(offsets >= padding) & (offsets < padding + sentence_lengths)] = ids
+    return units, padded_lengths
+
+
+def window_positions(lengths, n):
+    """
+    Returns the start position of every n-gram window of concatenated sentences with the
+    given lengths, and the number of windows of every sentence.
+    """
+    # Only windows that start at most len - n units into their sentence are kept,
+    # which masks out the windows crossing sentence boundaries.
+    windows = np.maximum(lengths - n + 1, 0)
+    sentence_starts = np.cumsum(lengths) - lengths
+    window_offsets = np.cumsum(windows) - windows
+    positions = np.arange(int(windows.sum()), dtype=np.int64) + np.repeat(
+        sentence_starts - window_offsets, windows
+    )
+    return positions, windows
+
+
+def key_words(n, unit_bits):
+    """
+    Returns the number of uint64 words of the key of an n-gram with unit_bits bits per unit.
+    """
+    return -(-n // (64 // unit_bits))
+
+
+def pack_keys(unit_column, n, size, unit_bits):
+    """
+    Packs the units of size n-grams big-endian into keys, 64 // unit_bits units per word.
+
+    Parameters:
+      unit_column (callable): Returns the j-th unit of every n-gram as a uint64 array.
+      n (int): N-gram size.
+      size (int): Number of n-grams.
+      unit_bits (int): Bits of a unit.
+
+    Returns:
+      np.ndarray: uint64 array of shape (size, key_words(n, unit_bits)).
+    """
+    units_per_word = 64 // unit_bits
+    # Fortran order keeps the words of a column contiguous while they are filled.
+    keys = np.zeros((size, key_words(n, unit_bits)), dtype=np.uint64, order="F")
+    for j in range(n):
+        word = keys[:, j // units_per_word]
+        word <<= np.uint64(unit_bits)
+        word |= unit_column(j)
+    return keys
+
+
+def _count_windows(units, lengths, class_ids, n, unit_bits, model_counts):
+    """
+    Counts the n-gram windows of a batch of padded sentences into model_counts.
+
+    Parameters:
+      units (np.ndarray): Unsigned integer units of all padded sentences, concatenated.
+      lengths (np.ndarray): Number of units of every padded sentence.
+      class_ids (np.ndarray): Class id of every sentence.
+      n (int): N-gram size.
+      unit_bits (int): Bits of a unit in the packed keys.
+      model_counts (PackedCounts): Counts the windows are added to.
+    """
+    positions, windows = window_positions(lengths, n)
+    total = len(positions)
+
+    keys = pack_keys(lambda j: units[positions + j], n, total, unit_bits)
+    first = np.arange(model_counts.seen, model_counts.seen + total, dtype=np.int64)
+    model_counts.add(
+        *_reduce_runs(
+            np.repeat(class_ids, windows),
+            keys,
+            np.ones(total, dtype=np.int64),
+            first,
+        )
+    )
+    model_counts.seen += total
+
+
+class PackedCounts:
+    """
+    N-gram counts stored as NumPy arrays of class ids, packed keys (rows of uint64 words),
+    counts and first-occurrence positions. Subclasses define how a key is turned into an
+    n-gram.
+    """
+
+    def __init__(self):
+        self.n = None
+        self.unit_bits = None
+        self.seen = 0  # Number of n-gram windows counted so far.
+        self.parts = []
+        self.size = 0
+        self.compacted_size = 0
+
+    def add(self, class_ids, keys, counts, first):
+        self.parts.append((class_ids, keys, counts, first))
+        self.size += len(keys)
+        if self.size > 2 * max(self.compacted_size, 1 << 16):
+            self.compact()
+
+    def compact(self):
+        if len(self.parts) > 1:
+            columns = list(zip(*self.parts))
+            self.parts = []
+            # Concatenate column by column, so the parts of a column are freed before the next.
+            arrays = []
+            while columns:
+                arrays.append(np.concatenate(columns.pop(0)))
+            self.parts = [_reduce_runs(*arrays)]
+        self.size = self.compacted_size = sum(len(part[1]) for part in self.parts)
+
+    def __len__(self):
+        # Upper bound until the parts are compacted.
+        return self.size
+
+    def items(self):
+        """
+        Yields ((class_id, ngram), count) in order of first occurrence.
+        """
+        self.compact()
+        if not self.parts:
+            return
+        class_ids, keys, counts, first = self.parts[0]
+        order = np.argsort(first)
+        decode_keys = self.key_decoder()
+        for start in range(0, len(order), DECODE_BLOCK_SIZE):
+            block = order[start : start + DECODE_BLOCK_SIZE]
+            ngrams = decode_keys(keys[block])
+            yield from zip(zip(class_ids[block].tolist(), ngrams), counts[block].tolist())
+
+    def key_decoder(self):
+        """
+        Returns a function that returns the n-grams of an array of packed keys.
+        """
+        raise NotImplementedError
+
+
+class PackedByteCounts(PackedCounts):
+    """
+    Byte n-gram counts; the keys are the n-gram bytes.
+    """
+
+    def key_decoder(self):
+        n = self.n
+        return lambda keys: [key.to_bytes(n, "big") for key in keys[:, 0].tolist()]
+
+
+class InternedCounts(PackedCounts):
+    """
+    Code point or token n-gram counts; the keys are packed ids of the units in vocabulary,
+    and an n-gram is its units joined by separator.
+    """
+
+    def __init__(self, separator):
+        super().__init__()
+        self.separator = separator
+        # Maps every unit to its id; the ids are assigned in insertion order.
+        self.vocabulary = {}
+
+    def intern(self, units):
+        """
+        Returns the ids of a list of units as a uint64 array, adding new units to the
+        vocabulary.
+        """
+        vocabulary = self.vocabulary
+        # Only the distinct units of the batch are looked up in Python.
+        for unit in dict.fromkeys(units):
+            if unit not in vocabulary:
+                vocabulary[unit] = len(vocabulary)
+        if len(vocabulary) > 1 << self.unit_bits:
+            if self.unit_bits >= MAX_UNIT_BITS:
+                raise ValueError(
+                    f"The training data has more than {1 << MAX_UNIT_BITS} distinct units, "
+                    "which is more than the NumPy engine supports; use --engine python."
+                )
+            self.repack(MAX_UNIT_BITS)
+        return np.fromiter(map(vocabulary.__getitem__, units), dtype=np.uint64, count=len(units))
+
+    def repack(self, unit_bits):
+        """
+        Re-packs the keys counted so far with unit_bits bits per unit id.
+        """
+        parts = []
+        for class_ids, keys, counts, first in self.parts:
+            unit_ids = self.unit_ids(keys)
+            keys = pack_keys(lambda j: unit_ids[:, j], self.n, len(keys), unit_bits)
+            parts.append((class_ids, keys, counts, first))
+        self.parts = parts
+        self.unit_bits = unit_bits
+
+    def unit_ids(self, keys):
+        """
+        Splits packed keys into an array with the n unit ids of every key.
+        """
+        n = self.n
+        units_per_word = 64 // self.unit_bits
+        mask = np.uint64((1 << self.unit_bits) - 1)
+        ids = np.empty((len(keys), n), dtype=np.uint64)
+        for j in range(n):
+            word = j // units_per_word
+            # The last word holds the remaining units, so its first unit is shifted less.
+            word_units = min(units_per_word, n - word * units_per_word)
+            shift = np.uint64((word_units - 1 - j % units_per_word) * self.unit_bits)
+            ids[:, j] = (keys[:, word] >> shift) & mask
+        return ids
+
+    def key_decoder(self):
+        vocabulary = np.array(list(self.vocabulary), dtype=object)
+        join = self.separator.join
+
+        def decode_keys(keys):
+            units = vocabulary[self.unit_ids(keys)]
+            if self.n == 1:
+                return units[:, 0].tolist()
+            return [join(row) for row in units.tolist()]
+
+        return decode_keys
+
+
+class NumpyByteCounter:
+    """
+    Counting backend for byte n-grams with n <= 8, see the module docstring.
+    """
+
+    batch_size = BATCH_SENTENCES
+
+    def __init__(self, start_token, end_token):
+        self.start_token = start_token
+        self.end_token = end_token
+
+    def new_counts(self):
+        return PackedByteCounts()
+
+    def count(self, examples, n, model_counts):
+        if n > MAX_N:
+            raise ValueError(f"The NumPy engine supports n <= {MAX_N}, got {n}.")
+        model_counts.n = n
+        model_counts.unit_bits = 8
+        start = self.start_token * (n - 1)
+        end = self.end_token * (n - 1)
+        for batch in iter_batches(examples, BATCH_SENTENCES):
+            padded = [start + sentence.encode("utf-8") + end for _, sentence in batch]
+            data = np.frombuffer(b"".join(padded), dtype=np.uint8)
+            lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+            _count_windows(data, lengths, _class_id_array(batch), n, 8, model_counts)
+
+    def merge(self, model_counts, partial_counts):
+        for class_ids, keys, counts, first in partial_counts.parts:
+            model_counts.add(class_ids, keys, counts, first + model_counts.seen)
+        model_counts.seen += partial_counts.seen
+        model_counts.n = partial_counts.n
+        model_counts.unit_bits = partial_counts.unit_bits
+        return model_counts
+
+    def entry_bytes(self, model_counts):
+        return ENTRY_BYTES
+
+
+def _class_id_array(batch):
+    return np.fromiter((class_id for class_id, _ in batch), dtype=np.int64, count=len(batch))
+
+
+class NumpyInternedCounter:
+    """
+    Counting backend for n-grams of interned units, see the module docstring. Subclasses
+    define how a batch of sentences is split into unit ids.
+
+    Parameters:
+      start_token, end_token (str): Padding units.
+    """
+
+    batch_size = INTERNED_BATCH_SENTENCES
+    separator = None
+
+    def __init__(self, start_token, end_token):
+        self.start_token = start_token
+        self.end_token = end_token
+
+    def new_counts(self):
+        return InternedCounts(self.separator)
+
+    def sentence_units(self, sentences, model_counts):
+        """
+        Returns the unit ids of all sentences, concatenated, and the number of units of
+        every sentence.
+        """
+        raise NotImplementedError
+
+    def count(self, examples, n, model_counts):
+        if n > MAX_N:
+            raise ValueError(f"The NumPy engine supports n <= {MAX_N}, got {n}.")
+        model_counts.n = n
+        model_counts.unit_bits = min(MAX_UNIT_BITS, 64 // n)
+        padding = n - 1
+        start_id, end_id = model_counts.intern([self.start_token, self.end_token]).tolist()
+        for batch in iter_batches(examples, INTERNED_BATCH_SENTENCES):
+            ids, lengths = self.sentence_units([sentence for _, sentence in batch], model_counts)
+            units, padded_lengths = pad_units(ids, lengths, padding, start_id, end_id)
+            _count_windows(
+                units,
+                padded_lengths,
+                _class_id_array(batch),
+                n,
+                model_counts.unit_bits,
+                model_counts,
+            )
+
+    def merge(self, model_counts, partial_counts):
+        if partial_counts.n is None:
+            return model_counts
+        model_counts.n = n = partial_counts.n
+        if model_counts.unit_bits is None:
+            model_counts.unit_bits = partial_counts.unit_bits
+        elif partial_counts.unit_bits > model_counts.unit_bits:
+            model_counts.repack(partial_counts.unit_bits)
+        # Map the unit ids of the partial counts to the ids of model_counts.
+        remap = model_counts.intern(list(partial_counts.vocabulary))
+        for class_ids, keys, counts, first in partial_counts.parts:
+            unit_ids = remap[partial_counts.unit_ids(keys)]
+            keys = pack_keys(lambda j: unit_ids[:, j], n, len(keys), model_counts.unit_bits)
+            model_counts.add(class_ids, keys, counts, first + model_counts.seen)
+        model_counts.seen += partial_counts.seen
+        return model_counts
+
+    def entry_bytes(self, model_counts):
+        words = key_words(model_counts.n, model_counts.unit_bits) if model_counts.n else 1
+        return ENTRY_BYTES + WORD_ENTRY_BYTES * (words - 1)
+
+
+class NumpyCodepointCounter(NumpyInternedCounter):
+    """
+    Interned counting backend for code point n-grams. The code points of a batch are read
+    from its UTF-32 encoding, so only the distinct code points are looked up in Python.
+    """
+
+    separator = ""
+
+    def sentence_units(self, sentences, model_counts):
+        codepoints = np.frombuffer("".join(sentences).encode("utf-32-le"), dtype=np.uint32)
+        distinct, inverse = np.unique(codepoints, return_inverse=True)
+        ids = model_counts.intern([chr(c) for c in distinct.tolist()])[inverse.ravel()]
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        return ids, lengths
+
+
+class NumpyTokenCounter(NumpyInternedCounter):
+    """
+    Interned counting backend for whitespace token n-grams.
+    """
+
+    separator = " "
+
+    def sentence_units(self, sentences, model_counts):
+        tokens = [sentence.split() for sentence in sentences]
+        ids = model_counts.intern(list(itertools.chain.from_iterable(tokens)))
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        return ids, lengths
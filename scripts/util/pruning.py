@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Pruning of model counts before serialization.
+
+Three filters are applied in this order, each to the tuples kept by the previous one:
+  - min_count: drops the (class_id, ngram) tuples seen fewer than min_count times.
+  - feature selection: scores every n-gram by how much it tells the classes apart (chi-square
+    or information gain over the n-gram counts) and keeps the num_features best n-grams in
+    all classes (requires NumPy and the n-gram vocabulary in memory).
+  - top_k: keeps the top_k most frequent n-grams of every class; ties at the cut-off are
+    kept in iteration order.
+
+PrunedCounts re-iterates the source counts for each filter that needs a statistic of the
+whole model, so it works with dictionaries and with the sorted runs of ExternalCounts, and
+yields the kept tuples in the order of the source. While the tuples are written it collects
+the tuple counts and serialized sizes of the report printed by the builders.
+"""
+
+import heapq
+
+from util.model_io import COUNT, HEADER
+
+FEATURE_SELECTION_METHODS = ("chi2", "ig")
+# Number of n-grams scored at once by feature selection.
+SCORE_BLOCK_ROWS = 1 << 16
+
+
+def _tuple_size(ngram):
+    if isinstance(ngram, str):
+        ngram = ngram.encode("utf-8")
+    return HEADER.size + len(ngram) + COUNT.size
+
+
+def _chi2_scores(matrix, class_totals, total):
+    """
+    Returns the maximum over classes of the chi-square statistic of every n-gram (row).
+    """
+    import numpy as np
+
+    ngram_totals = matrix.sum(axis=1, keepdims=True)
+    a = matrix
+    b = ngram_totals - a
+    c = class_totals - a
+    d = total - ngram_totals - class_totals + a
+    denominator = ngram_totals * (total - ngram_totals) * class_totals * (total - class_totals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 = total * (a * d - b * c) ** 2 / denominator
+    return np.nan_to_num(chi2, nan=0.0, posinf=0.0).max(axis=1)
+
+
+def _information_gain_scores(matrix, class_totals, total):
+    """
+    Returns the mutual information between the class and an n-gram occurrence being the
+    n-gram of the row.
+    """
+    import numpy as np
+
+    p_class = class_totals / total
+    p_ngram = matrix.sum(axis=1, keepdims=True) / total
+    p_joint = matrix / total
+    p_joint_rest = p_class - p_joint
+    with np.errstate(divide="ignore", invalid="ignore"):
+        present = p_joint * np.log(p_joint / (p_class * p_ngram))
+        absent = p_joint_rest * np.log(p_joint_rest / (p_class * (1 - p_ngram)))
+    return np.nan_to_num(present, nan=0.0).sum(axis=1) + np.nan_to_num(absent, nan=0.0).sum(
+        axis=1
+    )
+
+
+def select_features(items, method, num_features):
+    """
+    Scores the n-grams of a stream of ((class_id, ngram), count) items with chi-square
+    ("chi2") or information gain ("ig") and returns the set of the num_features best
+    n-grams. Ties are broken by first occurrence.
+    """
+    import numpy as np
+
+    vocabulary = {}
+    rows = []
+    class_ids = []
+    counts = []
+    for (class_id, ngram), count in items:
+        rows.append(vocabulary.setdefault(ngram, len(vocabulary)))
+        class_ids.append(class_id)
+        counts.append(count)
+    if len(vocabulary) <= num_features:
+        return set(vocabulary)
+
+    rows = np.array(rows, dtype=np.int64)
+    class_ids = np.array(class_ids, dtype=np.int64)
+    counts = np.array(counts, dtype=np.float64)
+    num_classes = int(class_ids.max()) + 1
+    class_totals = np.bincount(class_ids, weights=counts, minlength=num_classes)
+    total = class_totals.sum()
+    score_function = _chi2_scores if method == "chi2" else _information_gain_scores
+
+    # Score the dense [n-grams, classes] count matrix in blocks of rows to bound its size.
+    order = np.argsort(rows, kind="stable")
+    rows, class_ids, counts = rows[order], class_ids[order], counts[order]
+    scores = np.empty(len(vocabulary), dtype=np.float64)
+    for start in range(0, len(vocabulary), SCORE_BLOCK_ROWS):
+        end = min(start + SCORE_BLOCK_ROWS, len(vocabulary))
+        lo, hi = np.searchsorted(rows, [start, end])
+        matrix = np.zeros((end - start, num_classes), dtype=np.float64)
+        matrix[rows[lo:hi] - start, class_ids[lo:hi]] = counts[lo:hi]
+        scores[start:end] = score_function(matrix, class_totals, total)
+
+    best = np.argsort(-scores, kind="stable")[:num_features]
+    ngrams = list(vocabulary)
+    return {ngrams[i] for i in best.tolist()}
+
+
+def top_k_thresholds(items, top_k):
+    """
+    Returns, for every class, the count of its top_k-th most frequent n-gram and how many
+    n-grams with exactly that count are kept.
+    """
+    heaps = {}
+    for (class_id, _), count in items:
+        heap = heaps.setdefault(class_id, [])
+        if len(heap) < top_k:
+            heapq.heappush(heap, count)
+        elif count > heap[0]:
+            heapq.heapreplace(heap, count)
+    thresholds = {}
+    for class_id, heap in heaps.items():
+        threshold = heap[0] if len(heap) == top_k else 0
+        thresholds[class_id] = [threshold, sum(1 for count in heap if count == threshold)]
+    return thresholds
+
+
+class PrunedCounts:
+    """
+    Wraps model counts (a dictionary or an object with items()) and yields only the tuples
+    kept by the pruning filters, see the module docstring.
+
+    After items() has been consumed, input_tuples/input_bytes and output_tuples/output_bytes
+    hold the number and serialized size of the tuples before and after pruning, and
+    class_tuples maps every class id to its (input, output) tuple counts.
+    """
+
+    def __init__(
+        self, model_counts, min_count=1, top_k=None, feature_selection=None, num_features=None
+    ):
+        self.model_counts = model_counts
+        self.min_count = min_count
+        self.top_k = top_k
+        self.feature_selection = feature_selection
+        self.num_features = num_features
+        self.is_sorted = getattr(model_counts, "is_sorted", False)
+        self.input_tuples = self.input_bytes = 0
+        self.output_tuples = self.output_bytes = 0
+        self.class_tuples = {}
+
+    def __len__(self):
+        return len(self.model_counts)
+
+    def _min_count_items(self):
+        min_count = self.min_count
+        for item in self.model_counts.items():
+            if item[1] >= min_count:
+                yield item
+
+    def _selected_items(self, features):
+        for item in self._min_count_items():
+            if features is None or item[0][1] in features:
+                yield item
+
+    def items(self):
+        features = None
+        if self.feature_selection:
+            features = select_features(
+                self._min_count_items(), self.feature_selection, self.num_features
+            )
+        thresholds = None
+        if self.top_k:
+            thresholds = top_k_thresholds(self._selected_items(features), self.top_k)
+
+        self.input_tuples = self.input_bytes = 0
+        self.output_tuples = self.output_bytes = 0
+        self.class_tuples = {}
+        min_count = self.min_count
+        for (class_id, ngram), count in self.model_counts.items():
+            size = _tuple_size(ngram)
+            self.input_tuples += 1
+            self.input_bytes += size
+            class_tuples = self.class_tuples.setdefault(class_id, [0, 0])
+            class_tuples[0] += 1
+            if count < min_count or (features is not None and ngram not in features):
+                continue
+            if thresholds is not None:
+                threshold = thresholds[class_id]
+                if count < threshold[0]:
+                    continue
+                if count == threshold[0]:
+                    if threshold[1] == 0:
+                        continue
+                    threshold[1] -= 1
+            self.output_tuples += 1
+            self.output_bytes += size
+            class_tuples[1] += 1
+            yield (class_id, ngram), count
+
+    def describe(self):
+        """
+        Returns a short description of the enabled filters.
+        """
+        filters = []
+        if self.min_count > 1:
+            filters.append(f"min count {self.min_count}")
+        if self.feature_selection:
+            filters.append(f"{self.feature_selection} top {self.num_features} n-grams")
+        if self.top_k:
+            filters.append(f"top {self.top_k} n-grams per class")
+        return ", ".join(filters) or "no pruning"
+
+
+def _percent(part, whole):
+    return 100.0 * part / whole if whole else 100.0
+
+
+def print_size_report(pruned_counts, class_names=None):
+    """
+    Prints the tuple counts and serialized sizes before and after pruning.
+
+    Parameters:
+      pruned_counts (PrunedCounts): Counts whose items() has been consumed.
+      class_names (dict): Optional mapping of class id to language code.
+    """
+    p = pruned_counts
+    print(f"Model size report ({p.describe()}):")
+    print(
+        f"  Tuples: {p.input_tuples} -> {p.output_tuples} "
+        f"({_percent(p.output_tuples, p.input_tuples):.1f}%)"
+    )
+    print(
+        f"  Size:   {p.input_bytes / 1e6:.2f} MB -> {p.output_bytes / 1e6:.2f} MB "
+        f"({_percent(p.output_bytes, p.input_bytes):.1f}%)"
+    )
+    for class_id in sorted(p.class_tuples):
+        before, after = p.class_tuples[class_id]
+        name = (class_names or {}).get(class_id, "")
+        label = f"{class_id} ({name})" if name else f"{class_id}"
+        print(f"  Class {label}: {before} -> {after} tuples")
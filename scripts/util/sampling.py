@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Seeded stratified sampling of training data with a cap on the examples of every class.
+
+Every item gets a priority from a seeded hash of its text, and a class keeps the items with
+the max_per_class smallest priorities: a bottom-k reservoir per class. Since the hashes are
+uniform, the kept items are a uniform sample of their class, and the sample depends only on
+the seed and the multiset of items, not on their order or on how the input is split between
+workers. The reservoirs only hold priorities (not the items), so sampling takes two streaming
+passes: the first one fills the reservoirs, and their largest priorities are the thresholds
+of a StratifiedSample that filters the items in the second one.
+
+Items with identical text share their priority, so they are kept or dropped together, and a
+class may keep a few more than max_per_class items if duplicates fall on its threshold.
+"""
+
+import collections
+import hashlib
+import heapq
+import multiprocessing
+
+from util.helpers import SkippedLines
+
+
+def sample_priority(text, seed):
+    """
+    Returns the 64-bit sampling priority of text (a str) for seed. The hash is keyed
+    differently from the train/test split of split_dataset.py, so both are independent.
+    """
+    key = f"sample-{seed}".encode("utf-8")
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8, key=key).digest()
+    return int.from_bytes(digest, "big")
+
+
+class StratifiedReservoir:
+    """
+    Bottom-k reservoir of the sampling priorities of every class.
+
+    Parameters:
+      max_per_class (int): Number of items kept per class.
+      seed (int): Seed of the priorities.
+    """
+
+    def __init__(self, max_per_class, seed=0):
+        self.max_per_class = max_per_class
+        self.seed = seed
+        # Max-heaps of the kept priorities (negated), including duplicates.
+        self.heaps = {}
+
+    def add(self, label, text):
+        self.add_priority(label, sample_priority(text, self.seed))
+
+    def add_priority(self, label, priority):
+        heap = self.heaps.get(label)
+        if heap is None:
+            heap = self.heaps[label] = []
+        if len(heap) >= self.max_per_class and priority > -heap[0]:
+            return
+        heapq.heappush(heap, -priority)
+        if len(heap) > self.max_per_class:
+            self._evict_largest(heap)
+
+    def _evict_largest(self, heap):
+        # Removes the copies of the largest priority if enough items remain without them.
+        largest = heapq.heappop(heap)
+        copies = [largest]
+        while heap and heap[0] == largest:
+            copies.append(heapq.heappop(heap))
+        if len(heap) < self.max_per_class:
+            for priority in copies:
+                heapq.heappush(heap, priority)
+
+    def merge(self, other):
+        """
+        Adds the kept priorities of another reservoir with the same seed, e.g. of a worker.
+        """
+        for label, heap in other.heaps.items():
+            for priority in heap:
+                self.add_priority(label, -priority)
+
+    def counts(self):
+        """
+        Returns the number of kept items per class.
+        """
+        return collections.Counter({label: len(heap) for label, heap in self.heaps.items()})
+
+    def sample(self):
+        """
+        Returns the StratifiedSample that keeps the items of the reservoir.
+        """
+        thresholds = {label: -heap[0] for label, heap in self.heaps.items() if heap}
+        return StratifiedSample(thresholds, self.seed)
+
+
+class StratifiedSample:
+    """
+    Filter of the items kept by a StratifiedReservoir: those whose priority is at most the
+    threshold of their class. Items of classes without a threshold are kept.
+    """
+
+    def __init__(self, thresholds, seed=0):
+        self.thresholds = thresholds
+        self.seed = seed
+
+    def keeps(self, label, text):
+        threshold = self.thresholds.get(label)
+        return threshold is None or sample_priority(text, self.seed) <= threshold
+
+    def filter(self, examples):
+        """
+        Yields the kept (label, text) pairs of examples.
+        """
+        keeps = self.keeps
+        for label, text in examples:
+            if keeps(label, text):
+                yield label, text
+
+
+class SampledSource:
+    """
+    Source of training examples (a TrainingFile or CorpusCache) restricted to a
+    StratifiedSample. The examples of every class are still counted in class_counts before
+    they are filtered, so the priors remain those of the full data.
+    """
+
+    def __init__(self, source, sample):
+        self.source = source
+        self.sample = sample
+
+    def chunks(self, num_chunks):
+        return self.source.chunks(num_chunks)
+
+    def iter_examples(self, start=0, end=None, class_counts=None, skipped=None, progress=None):
+        examples = self.source.iter_examples(start, end, class_counts, skipped, progress)
+        return self.sample.filter(examples)
+
+
+def _fill_reservoir(task, progress=None):
+    source, start, end, max_per_class, seed = task
+    reservoir = StratifiedReservoir(max_per_class, seed)
+    # The skipped lines are reported by the counting pass.
+    skipped = SkippedLines(max_warnings=0)
+    for class_id, sentence in source.iter_examples(start, end, None, skipped, progress):
+        reservoir.add(class_id, sentence)
+    return reservoir
+
+
+def sample_source(source, max_per_class, seed=0, workers=1, stats=None):
+    """
+    Samples at most max_per_class examples of every class of a source of training examples,
+    reading it once (in byte-range or index chunks with workers > 1).
+
+    Parameters:
+      source: TrainingFile or CorpusCache with the examples.
+      max_per_class (int): Number of examples kept per class.
+      seed (int): Seed of the sample.
+      workers (int): Number of processes reading the source.
+      stats (RunStats): Optional stats of the run; progress lines are printed if given.
+
+    Returns:
+      tuple: (SampledSource of the kept examples, Counter of kept examples per class ID).
+    """
+    if workers <= 1:
+        progress = stats.progress("Sampling") if stats else None
+        reservoir = _fill_reservoir((source, 0, None, max_per_class, seed), progress)
+    else:
+        tasks = [
+            (source, start, end, max_per_class, seed) for start, end in source.chunks(workers)
+        ]
+        reservoir = StratifiedReservoir(max_per_class, seed)
+        progress = stats.progress("Sampling", total=len(tasks), unit="chunks") if stats else None
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for i, partial in enumerate(pool.imap(_fill_reservoir, tasks)):
+                reservoir.merge(partial)
+                if progress is not None:
+                    progress.update(i + 1)
+    return SampledSource(source, reservoir.sample()), reservoir.counts()
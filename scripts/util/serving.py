@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Building blocks of the classification service (serve_models.py): an LRU cache of recent
+inputs, latency and throughput statistics, and a micro-batcher that collects concurrent
+requests into one vectorized classify call.
+
+All of them are used from a single asyncio event loop and are not thread-safe.
+"""
+
+import asyncio
+import collections
+import hashlib
+import time
+
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_MAX_BATCH_SIZE = 256
+# Seconds a request may wait for other requests to join its batch.
+DEFAULT_MAX_DELAY = 0.005
+# Number of most recent requests the latency percentiles and the recent throughput cover.
+DEFAULT_LATENCY_WINDOW = 10000
+
+
+class LRUCache:
+    """
+    Mapping of at most capacity keys; when it is full, adding a key evicts the least recently
+    used one. A capacity of 0 disables the cache.
+    """
+
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value of key and marks it as most recently used, or default.
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def cache_key(model_name, text):
+    """
+    Returns the LRU cache key of a (model, text) pair: a 128-bit digest, so the memory of a
+    full cache does not depend on the length of the cached texts.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.digest()
+
+
+def percentile(sorted_values, q):
+    """
+    Returns the q-th percentile (0 to 100) of sorted_values by the nearest-rank method, or 0.0
+    if there are no values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class LatencyStats:
+    """
+    Request counts, latencies and throughput. The percentiles and the recent throughput are
+    computed over the last window requests.
+    """
+
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        # (finish time, latency in seconds) of the last window requests.
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, latency, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.recent.append((time.perf_counter(), latency))
+
+    def as_dict(self):
+        now = time.perf_counter()
+        uptime = now - self.started
+        latencies = sorted(latency for _, latency in self.recent)
+        recent_seconds = now - self.recent[0][0] if self.recent else 0.0
+        return {
+            "uptime_seconds": round(uptime, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "throughput": {
+                "requests_per_second": round(self.requests / uptime, 2) if uptime > 0 else 0.0,
+                "recent_requests_per_second": (
+                    round(len(self.recent) / recent_seconds, 2) if recent_seconds > 0 else 0.0
+                ),
+            },
+            "latency_ms": {
+                "samples": len(latencies),
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+        }
+
+
+class MicroBatcher:
+    """
+    Collects the texts submitted by concurrent requests and classifies them in batches.
+
+    A batch starts with the oldest waiting text and is closed when it has max_batch_size
+    texts or max_delay seconds after it started, whichever comes first; texts that arrive
+    while a batch is being classified wait for the next one. Duplicate texts of a batch are
+    classified once. If classifying a batch raises, its texts are classified one at a time,
+    so only the requests of a failing text get its exception.
+
+    Parameters:
+      classify (callable): Function returning one result per text of a list of texts, such as
+        NaiveBayesModel.classify. It runs in executor (default: the loop's default executor),
+        so the event loop keeps serving requests meanwhile.
+      max_batch_size (int): Maximum number of texts per classify call.
+      max_delay (float): Seconds a batch waits for more texts.
+    """
+
+    def __init__(
+        self,
+        classify,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_delay=DEFAULT_MAX_DELAY,
+        executor=None,
+    ):
+        self.classify = classify
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.queue = asyncio.Queue()
+        self.full = asyncio.Event()
+        self.task = None
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+
+    def start(self):
+        """
+        Starts the batching task on the running event loop.
+        """
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, text):
+        """
+        Returns the result of text once its batch is classified.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((text, future))
+        if self.queue.qsize() >= self.max_batch_size:
+            self.full.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.max_delay > 0 and self.queue.qsize() < self.max_batch_size - 1:
+                self.full.clear()
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Requests whose client went away are not classified.
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.classify, texts)
+                outcomes = [(result, None) for result in results]
+            except Exception:
+                outcomes = await loop.run_in_executor(self.executor, self.classify_each, texts)
+            by_text = dict(zip(texts, outcomes))
+            for text, future in batch:
+                if not future.done():
+                    result, error = by_text[text]
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+            self.batches += 1
+            self.texts += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+    def classify_each(self, texts):
+        """
+        Classifies texts one at a time.
+
+        Returns:
+          list: A (result, None) or (None, exception) pair per text.
+        """
+        outcomes = []
+        for text in texts:
+            try:
+                outcomes.append((self.classify([text])[0], None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def as_dict(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "queued": self.queue.qsize(),
+        }
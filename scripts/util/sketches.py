@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Vectorized cardinality sketches over 64-bit hashes (requires NumPy).
+
+HyperLogLog keeps 2^precision one-byte registers per row and estimates the number of
+distinct hashes added to every row with a relative standard error of about
+1.04 / sqrt(2^precision), using the improved raw estimator of Ertl ("New cardinality
+estimation algorithms for HyperLogLog sketches", 2017), which needs no bias correction
+tables and is unbiased from small to large cardinalities.
+
+BottomKSample keeps the k smallest distinct hashes together with a row of values for each.
+Since the hashes are uniform, the kept entries are a uniform sample of the distinct items,
+and an item that ends up in the sample has been in it since its first occurrence.
+"""
+
+import math
+
+import numpy as np
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+MIX_MULTIPLIER_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_MULTIPLIER_2 = np.uint64(0x94D049BB133111EB)
+
+
+def mix64(values):
+    """
+    Hashes an array of uint64 values with the SplitMix64 finalizer.
+    """
+    z = values.astype(np.uint64) + GOLDEN_GAMMA
+    z = (z ^ (z >> np.uint64(30))) * MIX_MULTIPLIER_1
+    z = (z ^ (z >> np.uint64(27))) * MIX_MULTIPLIER_2
+    return z ^ (z >> np.uint64(31))
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y = 1.0
+    z = 1.0 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1.0 - x) ** 2 * y
+        if z == previous:
+            return z / 3.0
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketches of several rows (for example one per class) in one register array.
+    """
+
+    def __init__(self, rows, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"The precision must be between 4 and 18, got {precision}.")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = np.zeros((rows, self.size), dtype=np.uint8)
+
+    @property
+    def relative_error(self):
+        """
+        Relative standard error of the estimates.
+        """
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, rows, hashes):
+        """
+        Adds hashes[i] to row rows[i].
+        """
+        if len(hashes) == 0:
+            return
+        q = 64 - self.precision
+        index = (hashes >> np.uint64(q)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)
+        # The rank is the position of the highest set bit of the remaining q bits.
+        _, exponent = np.frexp(rest.astype(np.float64))
+        rank = np.where(rest == 0, q + 1, 65 - np.minimum(exponent, 64)).astype(np.uint8)
+        np.maximum.at(self.registers.ravel(), rows.astype(np.int64) * self.size + index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimates(self):
+        """
+        Returns the estimated number of distinct hashes of every row.
+        """
+        return np.array([self._estimate(row) for row in self.registers])
+
+    def _estimate(self, registers):
+        q = 64 - self.precision
+        m = self.size
+        histogram = np.bincount(registers, minlength=q + 2).tolist()
+        if histogram[0] == m:
+            return 0.0
+        z = m * _tau(1.0 - histogram[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * _sigma(histogram[0] / m)
+        return m * m / (2.0 * math.log(2.0) * z)
+
+
+class BottomKSample:
+    """
+    The k smallest distinct hashes added so far, each with a row of width int64 values.
+    """
+
+    def __init__(self, k, width):
+        self.k = k
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.values = np.zeros((0, width), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, hashes, values):
+        """
+        Adds hashes with the rows of values; values may be a function that returns the rows
+        of a boolean mask of hashes, so they are only computed for the candidates.
+        """
+        mask = None
+        if len(self.hashes) >= self.k:
+            mask = hashes < self.hashes[-1]
+            if not mask.any():
+                return
+            hashes = hashes[mask]
+        if callable(values):
+            values = values(mask)
+        elif mask is not None:
+            values = values[mask]
+        hashes = np.concatenate((self.hashes, hashes))
+        values = np.concatenate((self.values, values))
+        # np.unique returns the first occurrence of every hash, sorted by hash.
+        self.hashes, first = np.unique(hashes, return_index=True)
+        self.hashes = self.hashes[: self.k]
+        self.values = values[first[: self.k]]